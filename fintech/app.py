@@ -1,44 +1,221 @@
 from fastapi import FastAPI, requests
+from fastapi.responses import PlainTextResponse
+from starlette.datastructures import MutableHeaders
+from starlette.routing import Match
+import importlib
 import random
 import string
 import time
 import logging
-from routers import portfolio, ticker_info, graphs
+from routers import portfolio, ticker_info, graphs, export
+from routers.helpers.input import input_file, refresh_scheduler
+from routers.graphs import graph_renderer, mail_queue
+from routers.helpers.logs import setup_logging, CallCounter, upstream_calls, StaleData, stale_data
+from routers.helpers.serialization import FastJSONResponse
+from routers.helpers.metrics import registry, request_duration, requests_total, requests_in_progress
+from routers.helpers.settings import settings
+from routers.helpers.upstream import UpstreamUnavailable, gateway
+from routers.helpers.market_data import MarketDataClient, MarketDataProvider, market_data_connections
 
-app = FastAPI(title="Syneto Labs Project - Fintech Time Machine", version="0.1")
+# routes that return plain values get them serialized by orjson too
+app = FastAPI(title="Syneto Labs Project - Fintech Time Machine", version="0.1",
+              default_response_class=FastJSONResponse)
 
 
-# setting the routers for portfolio operations, various ticker info and graphs
+# setting the routers for portfolio operations, various ticker info, graphs and history exports
 app.include_router(portfolio.router)
 app.include_router(ticker_info.router)
 app.include_router(graphs.router)
+app.include_router(export.router)
 
 
-# setup logger
-logging.basicConfig(filename='../resources/logger.txt', level=logging.INFO,
-                    format='%(asctime)s | %(levelname)s: %(message)s ',
-                    datefmt='%d/%m/%Y %I:%M:%S %p')
+# load the portfolio once, it is kept in memory from now on
+@app.on_event("startup")
+def load_portfolio():
+    input_file.read()
 
 
-# middleware that runs for every request (command) that comes
-@app.middleware("http")
-async def log_requests(request: requests.Request, call_next):
-    # generating a random unique ID, so we can trace which logs come from the same requests
-    request_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+# the heavy libraries are not imported with the app (importing it stays fast, for the workers and the tests alike),
+# they are imported here instead, before the first request needs them. With FAST_STARTUP set they are left to the
+# first request.
+warm_up_modules = ("pandas", "yfinance", "yagmail")
 
-    logging.info(f"Request ID = {request_id} came, start path: {request.url.path}, method: {request.method}, "
-                 f"parameters: {request.query_params}")
 
-    start_time = time.time()
+@app.on_event("startup")
+def warm_up_imports():
+    if settings.fast_startup:
+        logging.info("Fast startup, skipping the warm-up imports.")
+        return
 
-    response = await call_next(request)
+    for module in warm_up_modules:
+        importlib.import_module(module)
 
-    process_time = (time.time() - start_time) * 1000
 
-    # fomat the process time so it has 2 decimals
-    formatted_process_time = '{0:.2f}'.format(process_time)
+# the market data comes from yfinance, or from the pooled HTTP client when MARKET_DATA_URL is set (before anything is
+# fetched, the refresh scheduler starts after this)
+@app.on_event("startup")
+def use_market_data_client():
+    if not settings.market_data_url:
+        return
 
-    logging.info(f"Request ID = {request_id} got its response. Completed in {formatted_process_time}ms, "
-                 f"status_code = {response.status_code}\n")
+    client = MarketDataClient(settings.market_data_url,
+                              max_connections=settings.market_data_connections or market_data_connections,
+                              http2=settings.market_data_http2)
+    gateway.provider = MarketDataProvider(client)
 
-    return response
+    logging.info(f"Fetching market data from {client.base_url} (HTTP/2: {client.http2}).")
+
+
+# prefetch the portfolio's metadata and recent history in the background, then keep them from expiring
+@app.on_event("startup")
+def start_refresh_scheduler():
+    refresh_scheduler.start()
+
+
+@app.on_event("shutdown")
+def stop_refresh_scheduler():
+    refresh_scheduler.stop()
+
+
+# after the refresh scheduler, which may still be fetching
+@app.on_event("shutdown")
+def close_market_data_client():
+    if isinstance(gateway.provider, MarketDataProvider):
+        gateway.provider.close()
+
+
+# warm graph rendering worker processes, so the first graphs don't wait for them to start
+@app.on_event("startup")
+def start_graph_renderer():
+    graph_renderer.start()
+
+
+@app.on_event("shutdown")
+def stop_graph_renderer():
+    graph_renderer.shutdown()
+
+
+# emails already queued get their chance to go out
+@app.on_event("shutdown")
+def stop_mail_queue():
+    mail_queue.stop()
+
+
+# setup logger: json lines written by a background thread, rotated every 10MB
+log_file = '../resources/logger.txt'
+log_rotation = "size"
+log_max_bytes = 10 * 1024 * 1024
+log_backups = 5
+
+# levels of single loggers (the portfolio lookups are debug logs) and the share of INFO records of a logger we keep
+log_levels = {"fintech.portfolio": logging.INFO, "fintech.requests": logging.INFO}
+log_sampling = {"fintech.requests": 1.0}
+
+request_logger = logging.getLogger("fintech.requests")
+
+
+@app.on_event("startup")
+def start_logging():
+    app.state.log_listener = setup_logging(log_file, rotation=log_rotation, max_bytes=log_max_bytes,
+                                           backups=log_backups, levels=log_levels, sampling=log_sampling)
+
+
+# flushes whatever is still queued
+@app.on_event("shutdown")
+def stop_logging():
+    app.state.log_listener.stop()
+
+
+# upstream timed out or its circuit is open, and there was nothing stored to answer instead: the client is told when to
+# try again rather than kept waiting
+@app.exception_handler(UpstreamUnavailable)
+async def upstream_unavailable(request: requests.Request, error: UpstreamUnavailable):
+    logging.warning(f"Upstream unavailable for {request.url.path}: {error}")
+
+    return FastJSONResponse(status_code=503, content="Market data is unavailable right now, try again later.",
+                            headers={"Retry-After": str(error.retry_after)})
+
+
+# GET endpoint for the metrics, in the Prometheus text format
+@app.get("/metrics", tags=["Metrics"])
+async def get_metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+# the path template of the route a request goes to (/fintech/ticker/{ticker}/market-cap), so the metrics get one
+# series per route instead of one per ticker
+def route_of(request: requests.Request) -> str:
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+
+        if match == Match.FULL:
+            return route.path
+
+    return "unmatched"
+
+
+# middleware that runs for every request (command) that comes, writing one structured log line per request and
+# recording its latency in the metrics. A plain ASGI middleware: the response goes to the server message by message as
+# the app sends it, so a streamed response (the history export) keeps the server's backpressure and sees the client
+# disconnect, which @app.middleware("http") (BaseHTTPMiddleware) would buffer away in between.
+class RequestLogMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request = requests.Request(scope)
+
+        # generating a random unique ID, so we can trace which logs come from the same requests
+        request_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+
+        # counts the upstream calls made for this request, anywhere down the call stack
+        calls = CallCounter()
+        upstream_calls.set(calls)
+
+        # and the stale data it gets answered while upstream is unavailable
+        stale = StaleData()
+        stale_data.set(stale)
+
+        route = route_of(request)
+        status = 500
+
+        async def send_response(message):
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+                # a stale answer says how stale (X-Stale-Data: metadata=310, age in seconds) and isn't to be reused
+                # without asking
+                if stale.ages:
+                    headers = MutableHeaders(scope=message)
+                    headers["X-Stale-Data"] = stale.header()
+                    headers["Cache-Control"] = "no-cache"
+
+            await send(message)
+
+        start_time = time.perf_counter()
+
+        try:
+            with requests_in_progress.track_in_progress(method=request.method, route=route):
+                await self.app(scope, receive, send_response)
+        finally:
+            # until the whole response went out, streamed ones included
+            duration = time.perf_counter() - start_time
+            process_time = duration * 1000
+
+            request_duration.observe(duration, method=request.method, route=route)
+            requests_total.inc(method=request.method, route=route, status=status)
+
+            request_logger.info("request", extra={"request_id": request_id, "method": request.method,
+                                                  "path": request.url.path, "query": str(request.query_params),
+                                                  "status": status,
+                                                  "duration_ms": round(process_time, 2),
+                                                  "upstream_calls": calls.count})
+
+
+app.add_middleware(RequestLogMiddleware)
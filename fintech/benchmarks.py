@@ -0,0 +1,307 @@
+# Offline micro-benchmarks of the portfolio, ticker info and graph paths. The upstream gateway's provider (yfinance)
+# is replaced by a seeded synthetic market, so two runs with the same settings measure exactly the same work and never
+# touch the network.
+#
+#   python benchmarks.py --output results.json
+#   python benchmarks.py --output results.json --baseline baseline.json --threshold 0.25
+#
+# With --baseline every benchmark is compared to the stored run and the script exits with 1 when one of them got
+# slower than the threshold allows.
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+import zlib
+from datetime import date, datetime
+from unittest.mock import patch
+import numpy
+import pandas
+from fastapi.testclient import TestClient
+from app import app
+from routers.helpers.graph_cache import GraphCache
+from routers.helpers.helpers import Input, TickerHistory
+from routers.helpers.input import input_file, metadata_cache, portfolio_index, history_store
+from routers.helpers.renderer import GraphRenderer
+from routers.helpers.upstream import TokenBucket, gateway
+
+countries = ("United States", "Germany", "Japan", "United Kingdom", "France")
+sectors = ("Technology", "Healthcare", "Energy", "Financial Services", "Consumer Defensive", "Industrials")
+exchanges = ("NMS", "NYQ", "GER", "JPX", "LSE")
+
+# the last day of the synthetic market, fixed so the data doesn't depend on when the benchmarks run
+last_day = date(2020, 12, 31)
+
+
+# seeded synthetic stand-in for the yfinance provider of the upstream gateway: every ticker gets its own random walk of
+# daily bars, metadata and quarterly dividends, all derived from the seed and the ticker's name
+class SyntheticMarket:
+    def __init__(self, seed: int = 42, years: int = 20, dividends_per_year: int = 4):
+        self.seed = seed
+        self.years = years
+        self.dividends_per_year = dividends_per_year
+
+        self._bars = {}
+
+    def _random(self, ticker: str) -> numpy.random.Generator:
+        return numpy.random.default_rng([self.seed, zlib.crc32(ticker.encode())])
+
+    def ticker_names(self, count: int) -> list:
+        return [f"T{number:05d}" for number in range(count)]
+
+    def info(self, ticker: str) -> dict:
+        random = self._random(ticker)
+
+        return {
+            "symbol": ticker,
+            "country": countries[random.integers(len(countries))],
+            "sector": sectors[random.integers(len(sectors))],
+            "exchange": exchanges[random.integers(len(exchanges))],
+            "marketCap": int(random.lognormal(23, 2)),
+            "forwardPE": float(random.uniform(5, 60)),
+            "lastDividendValue": float(random.uniform(0.1, 2)),
+        }
+
+    def bars(self, ticker: str) -> pandas.DataFrame:
+        if ticker not in self._bars:
+            random = self._random(ticker)
+            days = pandas.bdate_range(date(last_day.year - self.years, 1, 1), last_day, name="Date")
+
+            close = 100 * numpy.exp(numpy.cumsum(random.normal(0, 0.02, len(days))))
+            spread = close * random.uniform(0, 0.03, len(days))
+
+            self._bars[ticker] = pandas.DataFrame({"Open": close + random.uniform(-1, 1, len(days)) * spread,
+                                                   "High": close + spread, "Low": close - spread, "Close": close,
+                                                   "Adj Close": close,
+                                                   "Volume": random.integers(10 ** 5, 10 ** 7, len(days))},
+                                                  index=days)
+
+        return self._bars[ticker]
+
+    def history(self, ticker: str, start=None, end=None, **kwargs) -> pandas.DataFrame:
+        bars = self.bars(ticker)
+
+        return bars[(bars.index >= pandas.Timestamp(start)) & (bars.index < pandas.Timestamp(end))]
+
+    def dividends(self, ticker: str) -> pandas.Series:
+        random = self._random(ticker)
+        days = pandas.date_range(date(last_day.year - self.years, 1, 1), last_day,
+                                 periods=self.years * self.dividends_per_year, tz="America/New_York")
+
+        return pandas.Series(random.uniform(0.1, 2, len(days)), index=days, name="Dividends")
+
+    def download(self, tickers: list, start, end, interval: str = "1d") -> pandas.DataFrame:
+        frames = [self.history(ticker, start, end) for ticker in tickers]
+
+        return pandas.concat(frames, axis=1, keys=tickers).swaplevel(axis=1)
+
+
+# runs function `number` times per round, for `rounds` rounds, and returns seconds per call
+def measure(function, rounds: int = 5, number: int = 1) -> dict:
+    timings = []
+
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+
+        for _ in range(number):
+            function()
+
+        timings.append((time.perf_counter() - start_time) / number)
+
+    return {"median": statistics.median(timings), "min": min(timings), "rounds": rounds, "number": number}
+
+
+class Benchmarks:
+    def __init__(self, market: SyntheticMarket, directory: str, rounds: int = 5):
+        self.market = market
+        self.directory = directory
+        self.rounds = rounds
+        self.results = {}
+
+    def record(self, name: str, function, number: int = 1, rounds: int = None):
+        self.results[name] = measure(function, rounds or self.rounds, number)
+        print(f"{name:<60} {self.results[name]['median'] * 1000:10.3f} ms")
+
+    def write_portfolio(self, name: str, tickers: list) -> str:
+        path = os.path.join(self.directory, f"{name}.txt")
+
+        with open(path, "w") as portfolio:
+            portfolio.writelines(f"{ticker}\n" for ticker in tickers)
+
+        return path
+
+    def portfolio_store(self, sizes):
+        for size in sizes:
+            tickers = self.market.ticker_names(size)
+            portfolio = Input(self.write_portfolio(f"portfolio_{size}", tickers))
+            portfolio.read()
+
+            self.record(f"input.check_ticker[size={size}]",
+                        lambda: [portfolio.check_ticker(ticker) for ticker in tickers[::max(1, size // 100)]],
+                        number=10)
+
+            added = [f"NEW{number:05d}" for number in range(20)]
+
+            def add_and_delete():
+                for ticker in added:
+                    portfolio.add(ticker)
+                for ticker in added:
+                    portfolio.delete(ticker)
+
+            self.record(f"input.add_delete_20[size={size}]", add_and_delete)
+
+    def graphs(self, years_list):
+        renderer = GraphRenderer(workers=1)
+        renderer.start()
+
+        tickers = self.market.ticker_names(3)
+
+        try:
+            for years in years_list:
+                start = date(last_day.year - years + 1, 1, 1).isoformat()
+                end = last_day.isoformat()
+
+                def render(cache_directory):
+                    graph_cache = GraphCache(cache_directory)
+                    history = TickerHistory(tickers, start, end, history_store)
+                    return asyncio.run(history.graph(graph_cache, renderer))
+
+                # a new cache directory every time, so every graph is rendered
+                cold_runs = itertools.count()
+                self.record(f"graph.render[years={years}]",
+                            lambda: render(os.path.join(self.directory, f"graphs_{years}_{next(cold_runs)}")))
+
+                warm_directory = os.path.join(self.directory, f"graphs_{years}_warm")
+                render(warm_directory)
+                self.record(f"graph.cached[years={years}]", lambda: render(warm_directory), number=10)
+        finally:
+            renderer.shutdown()
+
+    def serialization(self, client: TestClient):
+        ticker = self.market.ticker_names(1)[0]
+
+        for layout in ("map", "columns"):
+            self.record(f"route.dividends[layout={layout}]",
+                        lambda: client.get(f"/fintech/ticker/{ticker}/dividends?layout={layout}"), number=10)
+
+            for period in ("1y", "max"):
+                self.record(f"route.high_low[period={period},layout={layout}]",
+                            lambda: client.get(f"/fintech/ticker/{ticker}/high-low?period={period}&layout={layout}"),
+                            number=10)
+
+    def portfolio_filters(self, client: TestClient):
+        filters = {"market_cap_min": "1000000000", "country": "United%20States", "exchange": "NMS",
+                   "sector": "Technology", "sort": "-market_cap"}
+
+        # every combination of the filters, the unfiltered listing included
+        for count in range(len(filters) + 1):
+            for names in itertools.combinations(filters, count):
+                query = "&".join(f"{name}={filters[name]}" for name in names)
+                self.record(f"route.tickers[{','.join(names) or 'none'}]",
+                            lambda: client.get(f"/fintech/portfolio/tickers?{query}"), number=10)
+
+    def run(self, portfolio_sizes, graph_years, portfolio_tickers: int) -> dict:
+        tickers = self.market.ticker_names(portfolio_tickers)
+        source = self.write_portfolio("portfolio", tickers)
+
+        # the synthetic market answers right away, waiting for the rate limit or for a batch to fill up would only
+        # measure the sleeps
+        with patch.object(gateway, "provider", self.market), \
+                patch.object(gateway, "bucket", TokenBucket(rate=10 ** 9, capacity=10 ** 9)), \
+                patch.object(gateway, "batch_window", 0), \
+                patch.object(input_file, "source", source), \
+                patch.object(metadata_cache, "shared", None), \
+                patch.object(history_store, "directory", os.path.join(self.directory, "history")):
+            input_file.read()
+            metadata_cache.clear()
+            portfolio_index.clear()
+
+            client = TestClient(app)
+
+            self.portfolio_store(portfolio_sizes)
+            self.serialization(client)
+            self.portfolio_filters(client)
+            self.graphs(graph_years)
+
+        input_file.read()
+
+        return self.results
+
+
+# compares a run to a baseline run: a benchmark regressed when its median got slower by more than `threshold` (0.2
+# meaning 20%). Returns the regressed benchmarks' names.
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+
+    print(f"\n{'benchmark':<60} {'baseline':>12} {'current':>12} {'change':>8}")
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        before = baseline[name]["median"]
+        after = result["median"]
+        change = after / before - 1 if before else 0.0
+        regressed = change > threshold
+
+        if regressed:
+            regressions.append(name)
+
+        print(f"{name:<60} {before * 1000:10.3f}ms {after * 1000:10.3f}ms {change:+8.1%}{'  REGRESSION' * regressed}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the fintech API")
+    parser.add_argument("--output", default="benchmark_results.json", help="where the results are written")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown counted as a regression (0.2 = 20%%)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--tickers", type=int, default=200, help="tickers in the portfolio the routes work on")
+    parser.add_argument("--years", type=int, default=20, help="years of daily bars every ticker has")
+    parser.add_argument("--dividends", type=int, default=4, help="dividends per year")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--portfolio-sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--graph-years", type=int, nargs="+", default=[1, 5, 20])
+    arguments = parser.parse_args()
+
+    market = SyntheticMarket(arguments.seed, arguments.years, arguments.dividends)
+
+    with tempfile.TemporaryDirectory(prefix="fintech-benchmarks-") as directory:
+        results = Benchmarks(market, directory, arguments.rounds).run(arguments.portfolio_sizes,
+                                                                      [years for years in arguments.graph_years
+                                                                       if years <= arguments.years],
+                                                                      arguments.tickers)
+
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {name: value for name, value in vars(arguments).items() if name not in ("output", "baseline")},
+        "results": results,
+    }
+
+    with open(arguments.output, "w") as output:
+        json.dump(report, output, indent=2)
+
+    print(f"\nResults written to {arguments.output}")
+
+    if arguments.baseline:
+        with open(arguments.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = compare(results, baseline["results"], arguments.threshold)
+
+        if regressions:
+            print(f"\n{len(regressions)} benchmarks regressed by more than {arguments.threshold:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+from .helpers.input import input_file, history_store
+from .helpers.serialization import FastJSONResponse, ChunkedResponse, export_header, export_rows, export_media_types
+from .helpers.workers import in_context
+from fastapi import APIRouter, Query, Request
+from starlette.concurrency import run_in_threadpool
+from datetime import date, timedelta
+import logging
+import urllib.parse
+
+# setup fastAPI router for exporting the history of saved tickers
+router = APIRouter(prefix="/fintech/export")
+
+# how many rows go out in one chunk of the response
+export_chunk_rows = 1000
+
+
+# GET endpoint that streams the daily history of one or more saved tickers between two dates (both included), as
+# ndjson (one json object per line, default) or csv. Rows go out a chunk at a time straight from the history store,
+# ticker after ticker, so a long range never sits in memory whole; once the client disconnects nothing more is read
+# or fetched upstream.
+@router.get("/tickers/{ticker_list}/history", tags=["Export"])
+async def export_history(request: Request, ticker_list: str, start: str, end: str = None,
+                         export_format: str = Query("ndjson", alias="format")):
+    if export_format not in export_media_types:
+        return FastJSONResponse(status_code=400,
+                                content=f"The format can only be one of: {', '.join(export_media_types)}")
+
+    ticker_list = urllib.parse.unquote(ticker_list).upper().replace(",", " ").split()
+    ticker_list = list(dict.fromkeys(ticker_list))
+
+    if not ticker_list:
+        return FastJSONResponse(status_code=400, content="There has to be at least 1 ticker.")
+
+    not_saved = [ticker for ticker in ticker_list if not input_file.check_ticker(ticker)]
+
+    if not_saved:
+        return FastJSONResponse(status_code=404, content=f"Tickers not found in the portfolio: {' '.join(not_saved)}")
+
+    try:
+        start_date = date.fromisoformat(start)
+        end_date = date.fromisoformat(end) if end else date.today()
+    except ValueError as e:
+        logging.error(str(e))
+        return FastJSONResponse(status_code=400, content=str(e))
+
+    if end_date < start_date:
+        return FastJSONResponse(status_code=400, content="Invalid input - start date cannot be after end date.")
+
+    async def rows():
+        yield export_header(export_format)
+
+        for ticker in ticker_list:
+            if await request.is_disconnected():
+                break
+
+            # may have to go upstream for the days the store doesn't have yet
+            window = await run_in_threadpool(in_context(history_store.window, ticker, start_date,
+                                                        end_date + timedelta(days=1)))
+
+            for first in range(0, window.shape[1], export_chunk_rows):
+                if await request.is_disconnected():
+                    break
+
+                yield export_rows(ticker, window[:, first:first + export_chunk_rows], export_format)
+
+        if await request.is_disconnected():
+            logging.info(f"The client went away, stopped exporting the history of {ticker_list}.")
+
+    file_name = f"{'_'.join(ticker_list)}_{start_date}_{end_date}.{export_format}"
+
+    return ChunkedResponse(rows(), media_type=export_media_types[export_format],
+                           headers={"Content-Disposition": f"attachment; filename=\"{file_name}\""})
@@ -1,9 +1,12 @@
-from .helpers.input import input_file
+from .helpers.input import input_file, history_store
 from .helpers.helpers import TickerHistory, EmailSender
-import yagmail
+from .helpers.graph_cache import GraphCache
+from .helpers.renderer import GraphRenderer
+from .helpers.mailer import MailQueue
+from .helpers.metrics import registry
 from fastapi import APIRouter
-from fastapi import Depends
-from fastapi.responses import JSONResponse
+from fastapi import Depends, Query, Request
+from .helpers.serialization import FastJSONResponse
 from datetime import date
 import urllib.parse
 
@@ -11,10 +14,41 @@ import urllib.parse
 # setup fastAPI router and tickers portfolio input file
 router = APIRouter(prefix="/fintech/graphs")
 
+# rendered graphs are cached on disk, within this many bytes
+graphs_directory = "../resources/graphs"
+graph_cache_max_bytes = 256 * 1024 * 1024
+
+graph_cache = GraphCache(graphs_directory, graph_cache_max_bytes)
+registry.register_cache("graphs", graph_cache.stats)
+
+# graphs render on their own worker processes: how many, how many graphs may wait for them and for how long (seconds)
+render_workers = 2
+render_queue_size = 16
+render_timeout = 30
+
+graph_renderer = GraphRenderer(render_workers, render_queue_size, render_timeout)
+
+# emails are sent in the background by this many workers, each reusing its SMTP connection for batches of emails
+mail_workers = 2
+mail_batch_size = 10
+mail_max_attempts = 5
+
+mail_queue = MailQueue(EmailSender.connect, mail_workers, mail_batch_size, mail_max_attempts)
+
+# what the history route answers with: the rendered graph, or the data to draw it from (see TickerHistory.chart_data)
+graph_formats = ("png", "data")
+
 
 # GET endpoint for a history graph of the price (close index) between two dates for maximum 5 existent tickers
+# Long ranges are downsampled to about one point per pixel: downsample can be "lttb" (default), "minmax" or "none"
+# format=data answers the close series as binary chart data instead of a png, for clients that draw charts themselves
+# Both carry an ETag of the data they are drawn from, If-None-Match / If-Modified-Since get a 304 before any rendering
 @router.get("/tickers/{ticker_list}/history/", tags=["History graphs"])
-async def get_tickers_shared_history_graph(ticker_list: str, start: str, end: str = None):
+async def get_tickers_shared_history_graph(request: Request, ticker_list: str, start: str, end: str = None,
+                                           downsample: str = "lttb", graph_format: str = Query("png", alias="format")):
+    if graph_format not in graph_formats:
+        return FastJSONResponse(status_code=400, content=f"The format can only be one of: {', '.join(graph_formats)}")
+
     # format the list obtained with %20 and other url specific characters
     ticker_list = ticker_list.upper()
     ticker_list = ticker_list.removesuffix(" ")
@@ -26,46 +60,57 @@ async def get_tickers_shared_history_graph(ticker_list: str, start: str, end: st
     # check if we have more than 5 tickers and at least one
     given_tickers_number = len(ticker_list)
     if (1 <= given_tickers_number <= 5) is False:
-        return JSONResponse(status_code=400, content="There has to be at least 1 ticker, and maximum 5.")
+        return FastJSONResponse(status_code=400, content="There has to be at least 1 ticker, and maximum 5.")
 
     # if end date doesn't exist, set it to today
     if end is None:
         end = date.today().strftime('%Y-%m-%d')
 
-    # tickers already added to portfolio will go here
-    final_ticker_list = []
-
-    # i'll use these for naming the resulted graph specifically
-    graph_name_tickers = ""
-    underscore = ""
-
-    for ticker in ticker_list:
-        # see if the ticker is added to the portfolio
-        ticker_exists = input_file.check_ticker(ticker)
-        if ticker_exists:
-            final_ticker_list.append(ticker)
-            graph_name_tickers = graph_name_tickers + underscore + ticker
-            underscore = "_"
+    # tickers already added to portfolio will go here, sorted so the same tickers in a different order make the same
+    # graph (and hit the same cached one)
+    final_ticker_list = sorted({ticker for ticker in ticker_list if input_file.check_ticker(ticker)})
 
     valid_tickers_number = len(final_ticker_list)
 
     if valid_tickers_number:
-        history_object = TickerHistory(final_ticker_list, start, end)
-        graph = history_object.graph(graph_name_tickers)
+        history_object = TickerHistory(final_ticker_list, start, end, history_store, downsample)
+
+        if graph_format == "data":
+            return await history_object.chart_data(request)
+
+        graph = await history_object.graph(graph_cache, graph_renderer, request)
 
         return graph
 
     else:
-        return JSONResponse(status_code=400, content="None of tickers given is added to the portfolio")
+        return FastJSONResponse(status_code=400, content="None of tickers given is added to the portfolio")
 
 
+# POST endpoint that emails the history graph. The email is only queued (202 with the job's id), it is sent in the
+# background; its status can be followed at /fintech/graphs/emails/{job_id}
 @router.post("/tickers/{ticker_list}/history/send_graph/", tags=["History graphs"])
 async def email_graph(email: str, graph=Depends(get_tickers_shared_history_graph)):
     if graph.status_code != 200:
         return graph
 
-    sender = EmailSender(email, "Your graph bro", "Here's the graph for a couple of tickers. Enjoy!",
-                         yagmail.inline(graph.path))
-    sender.send_mail()
+    if graph.media_type != "image/png":
+        return FastJSONResponse(status_code=400, content="Only png graphs can be emailed.")
+
+    sender = EmailSender(email, "Your graph bro", "Here's the graph for a couple of tickers. Enjoy!", None)
+    job = mail_queue.submit(sender, graph.path)
+
+    response = FastJSONResponse(status_code=202, content={"job_id": job.id, "status": job.status})
+    response.headers["Location"] = f"{router.prefix}/emails/{job.id}"
+
+    return response
+
+
+# GET endpoint for the delivery status of a queued email: queued, sending, retrying, sent or failed
+@router.get("/emails/{job_id}", tags=["History graphs"])
+async def get_email_status(job_id: str):
+    job_status = mail_queue.status(job_id)
+
+    if job_status is None:
+        return FastJSONResponse(status_code=404, content="Email job not found.")
 
-    return JSONResponse(status_code=200, content="Email sent successfully.")
+    return FastJSONResponse(content=job_status)
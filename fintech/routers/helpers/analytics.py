@@ -0,0 +1,106 @@
+import numpy
+
+# trading days in a year, returns and volatility are annualized with it
+trading_days = 252
+
+
+# mean and sample standard deviation of every column, skipping the NaNs (without numpy's warnings for columns that
+# have less than two values, those just get NaN)
+def column_mean_std(values: numpy.ndarray):
+    valid = ~numpy.isnan(values)
+    counts = valid.sum(axis=0)
+    filled = numpy.where(valid, values, 0.0)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        mean = filled.sum(axis=0) / counts
+        deviations = numpy.where(valid, values - mean, 0.0)
+        std = numpy.sqrt((deviations ** 2).sum(axis=0) / (counts - 1))
+
+    return numpy.where(counts > 0, mean, numpy.nan), numpy.where(counts > 1, std, numpy.nan)
+
+
+# Pearson correlation of every pair of columns, each pair over the rows where both have a value (like
+# DataFrame.corr()), computed for all the pairs at once with matrix products
+def pairwise_correlation(values: numpy.ndarray) -> numpy.ndarray:
+    valid = (~numpy.isnan(values)).astype(numpy.float64)
+    filled = numpy.where(valid > 0, values, 0.0)
+
+    # [i, j]: over the rows where both i and j have a value
+    counts = valid.T @ valid
+    sums = filled.T @ valid
+    squares = (filled ** 2).T @ valid
+    products = filled.T @ filled
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        covariance = counts * products - sums * sums.T
+        variance = counts * squares - sums ** 2
+        correlation = covariance / numpy.sqrt(variance * variance.T)
+
+    correlation[counts < 2] = numpy.nan
+
+    return numpy.clip(correlation, -1, 1)
+
+
+# statistics of the tickers in a history frame (the TickerHistory / HistoryStore.download shape, (column, ticker)
+# columns), all computed at once over the aligned price matrix of the tickers:
+# cumulative return, mean daily return, annualized volatility, max drawdown, Sharpe ratio and dividend yield per
+# ticker, plus the correlation matrix of their daily returns. Prices are the dividend adjusted closes; the dividends
+# are worked out from the ratio of adjusted to plain closes, which changes on every ex-dividend day.
+def portfolio_analytics(history: "pandas.DataFrame", risk_free_rate: float = 0.0, daily_returns: bool = False) -> dict:
+    close_frame = history["Close"]
+    tickers = [str(ticker) for ticker in close_frame.columns]
+
+    days = close_frame.index
+
+    close = close_frame.ffill().to_numpy(dtype=numpy.float64)
+    adjusted = history["Adj Close"].fillna(close_frame).ffill().to_numpy(dtype=numpy.float64)
+
+    # an empty range still answers every ticker, with no values
+    if len(days) == 0:
+        close = adjusted = numpy.full((1, len(tickers)), numpy.nan)
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        returns = adjusted[1:] / adjusted[:-1] - 1
+
+        # first and last price of every ticker in the range
+        first = adjusted[numpy.argmax(~numpy.isnan(adjusted), axis=0), numpy.arange(len(tickers))]
+        cumulative_return = adjusted[-1] / first - 1
+
+        mean_return, std_return = column_mean_std(returns)
+        volatility = std_return * numpy.sqrt(trading_days)
+        sharpe_ratio = (mean_return * trading_days - risk_free_rate) / volatility
+
+        max_drawdown = numpy.fmin.reduce(adjusted / numpy.fmax.accumulate(adjusted, axis=0) - 1, axis=0)
+
+        # adjustment factors only change on ex-dividend days (and by rounding), dividend = previous close * (1 - drop)
+        factor = adjusted / close
+        drop = 1 - factor[:-1] / factor[1:]
+        dividends = numpy.where(numpy.abs(drop) > 1e-6, close[:-1] * drop, 0.0)
+
+        years = max((days[-1] - days[0]).days, 1) / 365.25 if len(days) > 1 else numpy.nan
+        dividend_yield = dividends.sum(axis=0) / years / close[-1]
+
+    metrics = {}
+    for position, ticker in enumerate(tickers):
+        metrics[ticker] = {
+            "cumulative_return": float(cumulative_return[position]),
+            "mean_daily_return": float(mean_return[position]),
+            "annualized_volatility": float(volatility[position]),
+            "max_drawdown": float(max_drawdown[position]),
+            "sharpe_ratio": float(sharpe_ratio[position]),
+            "dividend_yield": float(dividend_yield[position]),
+        }
+
+    analytics = {
+        "tickers": tickers,
+        "metrics": metrics,
+        "correlation": pairwise_correlation(returns).tolist(),
+    }
+
+    if daily_returns:
+        analytics["daily_returns"] = {
+            "dates": [day.isoformat() for day in days[1:].date],
+            "returns": {ticker: returns[:, position].tolist() for position, ticker in enumerate(tickers)},
+        }
+
+    return analytics
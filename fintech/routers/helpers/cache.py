@@ -0,0 +1,304 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import stale_answer
+
+
+# a miss that is being loaded right now; other callers asking for the same key wait on it instead of calling the
+# loader themselves
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+    def resolve(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+
+        if self.error is not None:
+            raise self.error
+
+        return self.value
+
+
+# process-wide key/value cache used for data we fetch upstream (yfinance ticker metadata for example).
+# Every entry lives for `ttl` seconds, the cache holds at most `max_size` entries (the least recently used one is
+# evicted first), and concurrent misses for the same key are deduplicated: only one caller runs the loader.
+# With a `stale_ttl`, an expired entry is still answered for that many more seconds while it gets loaded again in the
+# background (stale-while-revalidate), so callers only wait on the loader for keys they never asked for before.
+# With a `shared` store (a SharedStore, see shared.py) the loaded values are also written there, and a value another
+# process loaded recently enough is taken from there instead of calling the loader.
+# When loading fails with one of the `fallback_on` exceptions (upstream being unavailable), the last value we know of
+# the key is answered instead, however old, and the request is marked as having got stale data.
+class TTLCache:
+    def __init__(self, loader, ttl: float = 300, max_size: int = 512, name: str = "cache", stale_ttl: float = 0,
+                 shared=None, fallback_on: tuple = ()):
+        self.loader = loader
+        self.ttl = ttl
+        self.max_size = max_size
+        self.name = name
+        self.stale_ttl = stale_ttl
+        self.shared = shared
+        self.fallback_on = fallback_on
+
+        # counters, read them through stats()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.shared_hits = 0
+        self.fallbacks = 0
+        self.evictions = 0
+
+        # key -> (time it was stored at, value), kept in least recently used order
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+
+        # the background reloads of stale entries run here, created on the first one
+        self._reloader = None
+
+    # returns the cached value for a key, loading it (once, no matter how many callers ask) when missing or expired
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            age = time.monotonic() - entry[0] if entry is not None else None
+
+            if entry is not None and age < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            # expired, but still good enough to answer while a fresh value gets loaded in the background
+            if entry is not None and age < self.ttl + self.stale_ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.stale_hits += 1
+
+                if key not in self._in_flight:
+                    flight = self._in_flight[key] = _Flight()
+                    self._reload_in_background(key, flight)
+
+                return entry[1]
+
+            self.misses += 1
+
+            flight = self._in_flight.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = _Flight()
+                self._in_flight[key] = flight
+
+        try:
+            # somebody else is already loading this key, we just wait for their result
+            if not leader:
+                return flight.wait()
+
+            return self._load(key, flight)
+        except self.fallback_on as e:
+            return self._last_known(key, e)
+
+    # the last value we had for a key, from this process or the shared store, when loading it failed with error
+    # (raised again when there is none)
+    def _last_known(self, key, error: Exception):
+        with self._lock:
+            entry = self._entries.get(key)
+
+        if entry is not None:
+            age, value = time.monotonic() - entry[0], entry[1]
+        else:
+            try:
+                shared_entry = self.shared.get(key) if self.shared is not None else None
+            except Exception as e:
+                logging.warning(f"Reading {key} from the shared {self.name} cache failed: {e}")
+                shared_entry = None
+
+            if shared_entry is None:
+                raise error
+
+            age, value = time.time() - shared_entry[0], shared_entry[1]
+
+        with self._lock:
+            self.fallbacks += 1
+
+        logging.warning(f"Loading {key} into the {self.name} cache failed ({error}), answering the value from "
+                        f"{age:.0f}s ago.")
+        stale_answer(self.name, age)
+
+        return value
+
+    # loads a key again right away, fresh or not (a refresh scheduler keeping entries from expiring, for example).
+    # A value in the shared store younger than max_age seconds is taken instead of calling the loader.
+    def refresh(self, key, max_age: float = 0):
+        with self._lock:
+            flight = self._in_flight.get(key)
+            leader = flight is None
+
+            if leader:
+                flight = _Flight()
+                self._in_flight[key] = flight
+
+        if not leader:
+            return flight.wait()
+
+        return self._load(key, flight, max_age)
+
+    # runs the loader for a key whose flight we lead (unless the shared store has a value younger than max_age, ttl by
+    # default), stores the value and hands it to the waiting callers
+    def _load(self, key, flight: _Flight, max_age: float = None):
+        try:
+            shared_entry = self._from_shared(key, self.ttl if max_age is None else max_age)
+
+            if shared_entry is not None:
+                stored_at, value = shared_entry
+            else:
+                value = self.loader(key)
+                stored_at = time.monotonic()
+                self._to_shared(key, value)
+        except Exception as e:
+            with self._lock:
+                if self._in_flight.get(key) is flight:
+                    del self._in_flight[key]
+
+            flight.resolve(error=e)
+            raise
+
+        with self._lock:
+            if shared_entry is not None:
+                self.shared_hits += 1
+            else:
+                self.loads += 1
+
+            # if the key got invalidated while we were loading it, the result is not stored
+            if self._in_flight.get(key) is flight:
+                del self._in_flight[key]
+                self._store(key, value, stored_at)
+
+        flight.resolve(value=value)
+
+        for listener in self._listeners:
+            try:
+                listener(key, value)
+            except Exception as e:
+                logging.error(f"Listener of the {self.name} cache failed for {key}: {e}")
+
+        return value
+
+    # (time.monotonic() it was stored at, value) of a key in the shared store, when it is younger than max_age seconds
+    def _from_shared(self, key, max_age: float):
+        if self.shared is None or max_age <= 0:
+            return None
+
+        try:
+            entry = self.shared.get(key)
+        except Exception as e:
+            logging.warning(f"Reading {key} from the shared {self.name} cache failed: {e}")
+            return None
+
+        if entry is None:
+            return None
+
+        age = time.time() - entry[0]
+
+        if age >= max_age:
+            return None
+
+        return time.monotonic() - age, entry[1]
+
+    def _to_shared(self, key, value):
+        if self.shared is None:
+            return
+
+        try:
+            self.shared.put(key, value)
+        except Exception as e:
+            logging.warning(f"Writing {key} to the shared {self.name} cache failed: {e}")
+
+    # needs self._lock to be held
+    def _reload_in_background(self, key, flight: _Flight):
+        if self._reloader is None:
+            self._reloader = ThreadPoolExecutor(max_workers=2, thread_name_prefix=f"{self.name}-reload")
+
+        def reload():
+            try:
+                self._load(key, flight)
+            except Exception as e:
+                # the stale value stays until the next try
+                logging.warning(f"Reloading {key} in the {self.name} cache failed: {e}")
+
+        self._reloader.submit(reload)
+
+    # registers a callback(key, value), called every time a value is freshly loaded
+    def subscribe(self, listener):
+        self._listeners.append(listener)
+
+    # puts a value into the cache directly, without going through the loader
+    def put(self, key, value):
+        with self._lock:
+            self._store(key, value)
+
+    # drops a key, so the next get() goes upstream again
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._in_flight.pop(key, None)
+
+        if self.shared is not None:
+            try:
+                self.shared.delete(key)
+            except Exception as e:
+                logging.warning(f"Deleting {key} from the shared {self.name} cache failed: {e}")
+
+        logging.info(f"Invalidated {key} from the {self.name} cache.")
+
+    # empties this process' entries, the shared store keeps its own
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._in_flight.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+
+            return {
+                "name": self.name,
+                "size": len(self._entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "loads": self.loads,
+                "shared_hits": self.shared_hits,
+                "fallbacks": self.fallbacks,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+            }
+
+    # needs self._lock to be held
+    def _store(self, key, value, stored_at: float = None):
+        self._entries[key] = (time.monotonic() if stored_at is None else stored_at, value)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            return entry is not None and time.monotonic() - entry[0] < self.ttl
+
+    def __len__(self):
+        return len(self._entries)
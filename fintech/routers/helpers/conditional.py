@@ -0,0 +1,93 @@
+import hashlib
+from datetime import date, datetime, time, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi.responses import Response
+
+# how long (seconds) clients and caches may reuse an answer without asking again, per kind of data:
+# history that can't change anymore (the range ended), history that still gets today's bar, dividends (they change a
+# few times a year) and live metadata
+closed_history_max_age = 7 * 24 * 3600
+open_history_max_age = 60
+dividends_max_age = 3600
+metadata_max_age = 60
+
+# the headers a 304 repeats from the full answer
+not_modified_headers = ("etag", "last-modified", "cache-control", "vary")
+
+
+# strong ETag of a representation, from whatever identifies it: the data's fingerprint, the options it is rendered
+# with... (bytes, anything with a tobytes() like NumPy arrays, or anything else as its string)
+def make_etag(*parts) -> str:
+    digest = hashlib.sha256()
+
+    for part in parts:
+        if isinstance(part, bytes):
+            digest.update(part)
+        else:
+            digest.update(part.tobytes() if hasattr(part, "tobytes") else str(part).encode())
+        digest.update(b"\0")
+
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+# the start of a day, as a Last-Modified time: data that stopped changing on that day
+def day_start(day: date) -> datetime:
+    return datetime.combine(day, time(), tzinfo=timezone.utc)
+
+
+# ETag, Last-Modified and Cache-Control of an answer
+def cache_headers(etag: str, last_modified: datetime = None, max_age: int = 0) -> dict:
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={max_age}" if max_age else "no-cache"}
+
+    if last_modified is not None:
+        headers["Last-Modified"] = formatdate(last_modified.timestamp(), usegmt=True)
+
+    return headers
+
+
+# whether the client already has this representation: If-None-Match (compared weakly, as RFC 7232 wants for GET)
+# decides when it is sent, If-Modified-Since only without it. Only GET and HEAD are conditional.
+def is_not_modified(request, etag: str, last_modified: datetime = None) -> bool:
+    if request is None or request.method not in ("GET", "HEAD"):
+        return False
+
+    if_none_match = request.headers.get("if-none-match")
+
+    if if_none_match is not None:
+        if if_none_match.strip() == "*":
+            return True
+
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return any(tag.removeprefix("W/") == etag.removeprefix("W/") for tag in tags)
+
+    if_modified_since = request.headers.get("if-modified-since")
+
+    if if_modified_since is None or last_modified is None:
+        return False
+
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+
+    # HTTP dates have whole seconds
+    return last_modified.replace(microsecond=0) <= since
+
+
+def not_modified(headers: dict) -> Response:
+    return Response(status_code=304, headers={name: value for name, value in headers.items()
+                                              if name.lower() in not_modified_headers})
+
+
+# the caching headers of an answer, and the 304 to return right away when the client is up to date (None when it needs
+# the full answer, which should then carry the headers)
+def conditional(request, etag: str, last_modified: datetime = None, max_age: int = 0):
+    headers = cache_headers(etag, last_modified, max_age)
+
+    if is_not_modified(request, etag, last_modified):
+        return headers, not_modified(headers)
+
+    return headers, None
@@ -0,0 +1,112 @@
+import numpy
+
+# the ways a series can be downsampled before it is drawn
+downsample_modes = ("none", "lttb", "minmax")
+
+
+# how many points are worth drawing on a figure: about one per pixel of its width
+def point_budget(options: dict) -> int:
+    return int(options["figsize"][0] * options["dpi"])
+
+
+# Largest-Triangle-Three-Buckets: keeps the first and the last point, and from each of the n_out - 2 buckets in between
+# the point making the largest triangle with the point kept from the previous bucket and the average of the next one.
+# Returns the indices of the kept points.
+def lttb(x, y, n_out: int) -> numpy.ndarray:
+    n = len(x)
+
+    if n_out >= n or n_out < 3:
+        return numpy.arange(n)
+
+    x = numpy.asarray(x, dtype=numpy.float64)
+    y = numpy.asarray(y, dtype=numpy.float64)
+
+    # the points between the first and the last one, split into n_out - 2 buckets of (almost) the same size
+    edges = numpy.linspace(1, n - 1, n_out - 1).astype(numpy.int64)
+    counts = numpy.diff(edges)
+
+    # every bucket's average, all at once
+    averages_x = numpy.add.reduceat(x[1:n - 1], edges[:-1] - 1) / counts
+    averages_y = numpy.add.reduceat(y[1:n - 1], edges[:-1] - 1) / counts
+
+    # the last bucket is followed by the last point
+    averages_x = numpy.append(averages_x[1:], x[-1])
+    averages_y = numpy.append(averages_y[1:], y[-1])
+
+    kept = numpy.empty(n_out, dtype=numpy.int64)
+    kept[0] = 0
+    kept[-1] = n - 1
+    previous = 0
+
+    for bucket in range(n_out - 2):
+        low, high = edges[bucket], edges[bucket + 1]
+
+        # twice the area of the triangles, for every point of the bucket
+        areas = numpy.abs((x[previous] - averages_x[bucket]) * (y[low:high] - y[previous]) -
+                          (x[previous] - x[low:high]) * (averages_y[bucket] - y[previous]))
+
+        previous = low + int(numpy.argmax(areas))
+        kept[bucket + 1] = previous
+
+    return kept
+
+
+# keeps the lowest and the highest point of each of n_out / 2 buckets (plus the first and the last point), so no peak
+# gets lost. Returns the indices of the kept points, in order.
+def min_max(y, n_out: int) -> numpy.ndarray:
+    n = len(y)
+    buckets = n_out // 2
+
+    if n_out >= n or buckets < 1:
+        return numpy.arange(n)
+
+    y = numpy.asarray(y, dtype=numpy.float64)
+
+    # equal buckets as the rows of a matrix, the last one padded so the min and max of every row come in one go
+    size = -(-n // buckets)
+    padded = numpy.full(buckets * size, numpy.nan)
+    padded[:n] = y
+    rows = padded.reshape(buckets, size)
+
+    # a row can be fully padding when the buckets don't divide the points evenly
+    full_rows = ~numpy.all(numpy.isnan(rows), axis=1)
+    rows = rows[full_rows]
+    offsets = numpy.flatnonzero(full_rows) * size
+
+    lowest = offsets + numpy.nanargmin(rows, axis=1)
+    highest = offsets + numpy.nanargmax(rows, axis=1)
+
+    return numpy.unique(numpy.concatenate(([0, n - 1], lowest, highest)))
+
+
+# downsamples every column of a (dates x tickers) close matrix on its own, skipping the days a ticker has no price
+# (with mode "none" they are kept, so they still show as gaps). Returns one (dates, values) pair per column.
+def downsample_columns(dates, columns, mode: str, points: int) -> list:
+    dates = numpy.asarray(dates)
+    columns = numpy.asarray(columns, dtype=numpy.float64)
+
+    if columns.ndim == 1:
+        columns = columns[:, None]
+
+    # the area computations need plain numbers for the x axis
+    x = dates.astype("datetime64[ns]").astype(numpy.int64) if numpy.issubdtype(dates.dtype, numpy.datetime64) \
+        else dates
+
+    series = []
+
+    for column in columns.T:
+        if mode == "none":
+            series.append((dates, column))
+            continue
+
+        valid = ~numpy.isnan(column)
+        column_dates, column_x, column = dates[valid], x[valid], column[valid]
+
+        if mode == "lttb":
+            kept = lttb(column_x, column, points)
+        else:
+            kept = min_max(column, points)
+
+        series.append((column_dates[kept], column[kept]))
+
+    return series
@@ -0,0 +1,189 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+
+# name of the files we write: <request key>_<data fingerprint>.png
+cached_graph_name = re.compile(r"^([0-9a-f]{16})_([0-9a-f]{16})\.png$")
+
+
+# cache of the rendered history graphs, on disk. A graph is keyed by its normalized request (sorted tickers, dates,
+# rendering options) and a fingerprint of the data it was drawn from, so a graph is only rendered again when the data
+# behind it changed. The directory is kept under `max_bytes`, evicting the least recently used graphs first.
+class GraphCache:
+    def __init__(self, directory: str, max_bytes: int = 256 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        # counters, read them through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # file name -> size in bytes, in least recently used order
+        self._files = OrderedDict()
+        self._bytes = 0
+        # request key -> file name of the latest graph rendered for it
+        self._latest = {}
+
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_key(tickers, start_date, end_date, options: dict = None) -> str:
+        request = {"tickers": sorted(tickers), "start": str(start_date), "end": str(end_date),
+                   "options": options or {}}
+
+        return hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()[:16]
+
+    # fingerprint of the data a graph is drawn from (a DataFrame, or anything with a tobytes())
+    @staticmethod
+    def fingerprint(data) -> str:
+        digest = hashlib.sha256()
+
+        if hasattr(data, "to_numpy"):
+            digest.update(data.index.to_numpy().tobytes())
+            digest.update(data.to_numpy().tobytes())
+        else:
+            digest.update(data.tobytes())
+
+        return digest.hexdigest()[:16]
+
+    # name of the file a graph is cached in, it tells the request and the data the graph was drawn from apart
+    @staticmethod
+    def file_name(request_key: str, fingerprint: str) -> str:
+        return f"{request_key}_{fingerprint}.png"
+
+    # path of the cached graph for a request, or None. Without a fingerprint the latest graph rendered for the request
+    # is returned, which is only right when the data behind it can't change anymore (closed date ranges)
+    def get(self, request_key: str, fingerprint: str = None):
+        with self._lock:
+            self._ensure_loaded()
+
+            if fingerprint is None:
+                file_name = self._latest.get(request_key)
+            else:
+                file_name = self.file_name(request_key, fingerprint)
+
+            if file_name not in self._files:
+                # another worker process may have rendered it into the same directory
+                if fingerprint is None or not self._adopt(file_name):
+                    return None
+
+            self._files.move_to_end(file_name)
+            self.hits += 1
+
+        path = os.path.join(self.directory, file_name)
+
+        # keep the access time on disk too, it is the order we rebuild the cache in after a restart
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    # stores a freshly rendered graph, returns its path
+    def put(self, request_key: str, fingerprint: str, png: bytes) -> str:
+        file_name = self.file_name(request_key, fingerprint)
+        path = os.path.join(self.directory, file_name)
+
+        with self._lock:
+            self._ensure_loaded()
+            self.misses += 1
+
+            # written under a temporary name first (one per process and thread), so nobody reads half a graph
+            temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temporary_path, "wb") as graph_file:
+                graph_file.write(png)
+            os.replace(temporary_path, path)
+
+            self._bytes -= self._files.pop(file_name, 0)
+            self._files[file_name] = len(png)
+            self._bytes += len(png)
+            self._latest[request_key] = file_name
+
+            self._evict(keep=file_name)
+
+        logging.info(f"Cached graph {file_name} ({len(png)} bytes).")
+
+        return path
+
+    def stats(self) -> dict:
+        with self._lock:
+            self._ensure_loaded()
+            requests = self.hits + self.misses
+
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "files": len(self._files),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+            }
+
+    # needs self._lock to be held. Picks up the graphs already on disk (oldest access first), including the ones
+    # saved before there was a cache, so they count against the budget too
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".png"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, file_name, size in sorted(files):
+            self._files[file_name] = size
+            self._bytes += size
+
+            match = cached_graph_name.match(file_name)
+            if match:
+                self._latest[match.group(1)] = file_name
+
+        self._loaded = True
+        self._evict()
+
+    # needs self._lock to be held. Counts in a graph found on disk, returns False if there is none
+    def _adopt(self, file_name: str) -> bool:
+        try:
+            size = os.path.getsize(os.path.join(self.directory, file_name))
+        except FileNotFoundError:
+            return False
+
+        self._files[file_name] = size
+        self._bytes += size
+        self._evict(keep=file_name)
+
+        return True
+
+    # needs self._lock to be held
+    def _evict(self, keep: str = None):
+        while self._bytes > self.max_bytes and self._files:
+            file_name, size = next(iter(self._files.items()))
+
+            if file_name == keep:
+                break
+
+            del self._files[file_name]
+            self._bytes -= size
+            self.evictions += 1
+
+            match = cached_graph_name.match(file_name)
+            if match and self._latest.get(match.group(1)) == file_name:
+                del self._latest[match.group(1)]
+
+            try:
+                os.remove(os.path.join(self.directory, file_name))
+            except FileNotFoundError:
+                pass
+
+            logging.info(f"Evicted graph {file_name} from the graph cache.")
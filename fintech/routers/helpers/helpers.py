@@ -1,111 +1,371 @@
+import contextlib
+import fcntl
 import logging
+import os
 import re
+import threading
+import time
 from datetime import date
-from fastapi.responses import JSONResponse
-from fastapi.responses import FileResponse
+import numpy
+from .serialization import FastJSONResponse, encode_chart_data, chart_data_media_type
+from fastapi.responses import FileResponse, Response
 from fastapi import HTTPException
-import yfinance
-from matplotlib import pyplot
-import yagmail
-from dotenv import dotenv_values
+from starlette.concurrency import run_in_threadpool
+from .renderer import RenderBusy, RenderTimeout
+from .upstream import gateway
+from .workers import in_context
+from .downsample import downsample_modes, downsample_columns, point_budget
+from .conditional import conditional, make_etag, day_start, closed_history_max_age, open_history_max_age
+from .settings import settings
+
+
+# logger of the portfolio lookups, its level can be set on its own (see app.py)
+portfolio_logger = logging.getLogger("fintech.portfolio")
 
 
 # class that holds functions related to the input file: reading, adding, checking if a ticker is saved,
-# creating an yfinance object with prior check as it is very used in endpoints
+# fetching the market data of a saved ticker (through the upstream gateway) with prior check, as it is very used in
+# endpoints.
+# The portfolio is loaded from disk once and then kept in memory (an insertion ordered set), so checking a ticker never
+# touches the disk. Adds and deletes are appended to a journal file next to the portfolio file, which gets folded back
+# into the portfolio file (compacted) once it holds enough entries.
+# Several worker processes can share the files: changes are made under an exclusive lock file (reads under a shared
+# one), and every worker picks up the others' changes by replaying the new part of the journal, at most
+# `sync_interval` seconds late for lookups and always before a change of its own.
 class Input:
-    def __init__(self, file_source):
+    # number of journal entries after which the journal is compacted into the portfolio file
+    compaction_threshold = 1000
+
+    # how often (in seconds) lookups check the files for other workers' changes
+    sync_interval = 1.0
+
+    def __init__(self, file_source, metadata_cache=None):
         self.source = file_source
-        self.lines = []
 
-    # read the portfolio file, storing the lines
+        # shared cache of the tickers' yfinance .info metadata, see input.py
+        self.metadata_cache = metadata_cache
+
+        # ticker -> None, a dict being an ordered set
+        self._tickers = {}
+        self._journal_entries = 0
+        self._exists = False
+        self._loaded = False
+
+        # what we have read of the files: (inode, mtime, size) of the portfolio file and bytes of the journal
+        self._source_signature = None
+        self._journal_offset = 0
+        self._synced_at = 0.0
+
+        # add/delete can come from overlapping requests (and threads), they are serialized by this lock
+        self._lock = threading.RLock()
+
+        # how many times this process holds the lock file, it is only locked (and unlocked) by the outermost one
+        self._file_lock_depth = 0
+
+    # the journal holds one "+TICKER" or "-TICKER" line for every add/delete since the last compaction
+    @property
+    def journal(self):
+        return f"{self.source}.journal"
+
+    # lock file taken by every process that reads or changes the portfolio
+    @property
+    def lock_file(self):
+        return f"{self.source}.lock"
+
+    # (re)load the portfolio from disk: the portfolio file, with the journal replayed on top of it
     def read(self):
-        try:
-            with open(self.source, "r") as tickers_file:
-                # get all of the file's lines
-                self.lines = tickers_file.readlines()
+        with self._lock:
+            with self._file_lock(exclusive=False):
+                self._load()
 
-                # give info to lhe logger
-                logging.info(f"Did read from file: {self.source}")
+            self._compact_if_needed()
 
-        except FileNotFoundError:
+    # returns the saved tickers, in the order they were added
+    def tickers(self) -> list:
+        self._ensure_loaded()
+
+        if not self._exists:
             logging.error(f"Input file {self.source} does not exist.")
             raise HTTPException(status_code=404, detail="No portfolio input found.")
 
-    # adding a new ticker, with existence check
-    def add(self, ticker: str) -> JSONResponse:
-        with open(self.source, "a+", encoding='utf-8') as tickers_file:
-            # set the file pointer to the beginning, so we can check existing elements
-            tickers_file.seek(0)
+        return list(self._tickers)
 
-            self.lines = tickers_file.readlines()
+    # adding a new ticker, with existence check
+    def add(self, ticker: str) -> FastJSONResponse:
+        with self._lock, self._file_lock(exclusive=True):
+            # another worker may have changed the portfolio in the meantime
+            self._sync()
 
             # see if the ticker already exists
             if self.check_ticker(ticker):
                 logging.warning(f"Add of ticker {ticker} denied, already exists in {self.source}")
-                return JSONResponse(status_code=400, content="Ticker already exists.")
+                return FastJSONResponse(status_code=400, content="Ticker already exists.")
 
-            tickers_file.write(f"{ticker}\n")
+            self._append_to_journal(f"+{ticker}")
+            self._tickers[ticker] = None
+            self._compact_if_needed()
 
         logging.info(f"Added {ticker} ticker to {self.source}")
 
-        return JSONResponse(content="Ticker added successfully!")
+        return FastJSONResponse(content="Ticker added successfully!")
 
     # delete an existent portfolio ticker
     def delete(self, ticker):
-        deleted_something = False
+        with self._lock, self._file_lock(exclusive=True):
+            self._sync()
 
-        # read the and make sure everything is okay
-        self.read()
+            # make sure everything is okay
+            self.tickers()
 
-        # iter through the lines list and write the ones that aren't the one we want to delete
-        with open(self.source, "w") as tickers_file:
-            for line in self.lines:
-                if line.rstrip() != ticker:
-                    tickers_file.write(line)
-                else:
-                    # mark that we deleted it
-                    deleted_something = True
+            deleted_something = ticker in self._tickers
+
+            if deleted_something:
+                self._append_to_journal(f"-{ticker}")
+                del self._tickers[ticker]
+                self._compact_if_needed()
 
         if deleted_something:
             logging.info(f"Deleted ticker {ticker} successfully.")
-            return JSONResponse(status_code=200, content="Ticker deleted")
+            return FastJSONResponse(status_code=200, content="Ticker deleted")
         else:
             logging.info(f"Deletion of ticker {ticker} unsuccessful. Ticker not found. Nothing changed.")
-            return JSONResponse(status_code=404, content="Ticker not found in file. ")
+            return FastJSONResponse(status_code=404, content="Ticker not found in file. ")
 
     # method for checking if a ticker exists, returns true/false
     def check_ticker(self, ticker: str):
-        self.read()
+        self._ensure_loaded()
 
-        for line in self.lines:
-            if line.rstrip() == ticker:
-                logging.info(f"Checked ticker {ticker}. It is part of the portfolio.")
-                return True
+        # lookups are debug logs, formatted lazily: with debug disabled they cost nothing
+        if ticker in self._tickers:
+            portfolio_logger.debug("Checked ticker %s. It is part of the portfolio.", ticker)
+            return True
 
-        logging.info(f"Checked ticker {ticker}. Not part of the portfolio.")
+        portfolio_logger.debug("Checked ticker %s. Not part of the portfolio.", ticker)
         return False
 
-    # returns a YFinance Ticker Object, checks if it is saved too
-    def ticker_object(self, ticker: str) -> yfinance.ticker.Ticker:
-        ticker = ticker.upper()
+    # writes the in-memory portfolio to the portfolio file (atomically, through a temporary file) and empties the
+    # journal. Replaying a journal over a portfolio file that already contains it changes nothing, so a crash between
+    # the two steps is harmless.
+    def compact(self):
+        with self._lock, self._file_lock(exclusive=True):
+            self._sync()
+
+            temporary_source = f"{self.source}.{os.getpid()}.tmp"
+
+            with open(temporary_source, "w", encoding='utf-8') as tickers_file:
+                tickers_file.writelines(f"{ticker}\n" for ticker in self._tickers)
+                tickers_file.flush()
+                os.fsync(tickers_file.fileno())
+
+            os.replace(temporary_source, self.source)
+
+            open(self.journal, "w").close()
+            self._journal_entries = 0
+            self._journal_offset = 0
+            self._source_signature = self._signature(self.source)
+            self._exists = True
+
+        logging.info(f"Compacted the journal of {self.source}.")
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.read()
+        elif time.monotonic() - self._synced_at >= self.sync_interval:
+            with self._lock, self._file_lock(exclusive=False):
+                self._sync()
+
+    # needs self._lock to be held. Locks the lock file for the other processes, shared (readers) or exclusive (a
+    # writer). Without a directory to put it in there is nothing to protect yet.
+    @contextlib.contextmanager
+    def _file_lock(self, exclusive: bool):
+        if self._file_lock_depth:
+            self._file_lock_depth += 1
+            try:
+                yield
+            finally:
+                self._file_lock_depth -= 1
+            return
+
+        try:
+            lock_file = open(self.lock_file, "a")
+        except FileNotFoundError:
+            yield
+            return
+
+        with lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            self._file_lock_depth = 1
+
+            try:
+                yield
+            finally:
+                self._file_lock_depth = 0
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # (inode, modification time, size) of a file, or None when it doesn't exist
+    @staticmethod
+    def _signature(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    # needs self._lock and the lock file to be held. Reads the portfolio file and the whole journal
+    def _load(self):
+        tickers = {}
+        exists = False
+
+        self._source_signature = self._signature(self.source)
+
+        try:
+            with open(self.source, "r") as tickers_file:
+                for line in tickers_file:
+                    if line.strip():
+                        tickers[line.strip()] = None
+
+            exists = True
+        except FileNotFoundError:
+            pass
+
+        self._tickers = tickers
+        self._journal_entries = 0
+        self._journal_offset = 0
+
+        exists = self._replay_journal() or exists
+
+        self._exists = exists
+        self._loaded = True
+        self._synced_at = time.monotonic()
+
+        portfolio_logger.info("Did read from file: %s (%d tickers, %d journal entries)", self.source,
+                              len(tickers), self._journal_entries)
+
+    # needs self._lock and the lock file to be held. Applies the journal entries after what we have read of it,
+    # returns False when there is no journal
+    def _replay_journal(self) -> bool:
+        try:
+            with open(self.journal, "rb") as journal_file:
+                journal_file.seek(self._journal_offset)
+                data = journal_file.read()
+        except FileNotFoundError:
+            return False
+
+        # only whole lines, one still being written is read next time
+        complete = data.rfind(b"\n") + 1
+
+        for line in data[:complete].decode("utf-8").splitlines():
+            line = line.strip()
+
+            # a line cut short by a crash has nothing after the operation, skip it
+            if len(line) < 2:
+                continue
+
+            if line[0] == "+":
+                self._tickers.setdefault(line[1:], None)
+            elif line[0] == "-":
+                self._tickers.pop(line[1:], None)
+
+            self._journal_entries += 1
+
+        self._journal_offset += complete
+
+        return True
+
+    # needs self._lock and the lock file to be held. Catches up with the changes other processes made: the new part
+    # of the journal is replayed, and everything is read again when the portfolio file was compacted in the meantime
+    def _sync(self):
+        if not self._loaded:
+            self._load()
+            return
+
+        journal_size = self._signature(self.journal)
 
+        if self._signature(self.source) != self._source_signature or \
+                (journal_size[2] if journal_size else 0) < self._journal_offset:
+            self._load()
+            return
+
+        if journal_size and journal_size[2] > self._journal_offset:
+            self._exists = self._replay_journal() or self._exists
+
+        self._synced_at = time.monotonic()
+
+    # needs self._lock and the exclusive lock file to be held, with the journal replayed up to its end
+    def _append_to_journal(self, entry: str):
+        line = f"{entry}\n".encode("utf-8")
+
+        with open(self.journal, "ab") as journal_file:
+            journal_file.write(line)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        self._journal_entries += 1
+        self._journal_offset += len(line)
+        self._exists = True
+
+    # needs self._lock to be held, and the in-memory portfolio to already contain the journaled change
+    def _compact_if_needed(self):
+        if self._journal_entries >= self.compaction_threshold:
+            self.compact()
+
+    # raises a 404 if the ticker is not saved in the portfolio
+    def check_saved(self, ticker: str):
         if self.check_ticker(ticker) is False:
             logging.error(f"Ticker {ticker} not found in {self.source}. Could not check attributes.")
             raise HTTPException(status_code=404, detail="Ticker not found. Please save it into the portfolio before "
                                                         "querying it.")
 
-        ticker_object = yfinance.Ticker(ticker)
+    # returns the dividends of a saved ticker, a Series indexed by date
+    def ticker_dividends(self, ticker: str):
+        ticker = ticker.upper()
+
+        self.check_saved(ticker)
+
+        return gateway.dividends(ticker)
+
+    # returns the (cached) .info metadata of a saved ticker, without building a new Ticker object on every request
+    def ticker_info(self, ticker: str) -> dict:
+        ticker = ticker.upper()
+
+        self.check_saved(ticker)
 
-        return ticker_object
+        if self.metadata_cache is None:
+            return gateway.info(ticker)
 
+        return self.metadata_cache.get(ticker)
 
-# can download historical details about one or more tickers between two dates
+
+# can download historical details about one or more tickers between two dates, reading them through the local
+# history store (see history.py) so only the days it doesn't have yet are downloaded
 class TickerHistory:
-    def __init__(self, ticker_list, start_date, end_date):
+    # options the graphs are rendered with, part of their cache key
+    default_graph_options = {"figsize": (16, 9), "dpi": 100, "marker": "."}
+
+    def __init__(self, ticker_list, start_date, end_date, history_store, downsample: str = "lttb"):
         self.ticker_list = ticker_list
         self.start_date = start_date
         self.end_date = end_date
-        self.history_details = yfinance.download(self.ticker_list, start=start_date, end=end_date)
+        self.history_store = history_store
+        self._history_details = None
+
+        # long ranges are downsampled to about a point per pixel before drawing, see downsample.py
+        if downsample not in downsample_modes:
+            error = f"Invalid downsample mode {downsample}, it should be one of: {', '.join(downsample_modes)}"
+            logging.error(error)
+            raise HTTPException(status_code=400, detail=error)
+
+        self.graph_options = dict(self.default_graph_options, downsample=downsample)
+
+    # downloaded on first use, a cached graph doesn't need it. These stay float64 frames rather than compact series: the
+    # tickers are aligned on one date axis, and the graph fingerprints and chart data hash the full-precision closes.
+    @property
+    def history_details(self):
+        if self._history_details is None:
+            self._history_details = self.history_store.download(self.ticker_list, self.start_date, self.end_date)
+
+        return self._history_details
 
     # We need to validate the date types (dates strings may not be suitable/in good order).
     # Doing that with the constructor.
@@ -144,45 +404,110 @@ class TickerHistory:
     def number_of_tickers(self):
         return len(self.ticker_list)
 
-    def graph(self, graph_name_tickers: str):
-        history = self.history_details
+    # the end date is excluded, so when it isn't after today every bar in the range is final and so is the graph
+    def is_closed(self):
+        return self.end_date <= date.today()
 
+    @property
+    def title(self):
+        # string that concatenates the ticker list so we can show them off nicely in the title
+        tickers_string = " ".join(self.ticker_list)
+
+        return f"{tickers_string} history between {self.start_date} and {self.end_date}"
+
+    # Last-Modified and Cache-Control max-age of the answers: a closed range stopped changing when it ended and can be
+    # kept for long, an open one gets today's bar again every now and then
+    def cache_validity(self):
+        if self.is_closed():
+            return day_start(self.end_date), closed_history_max_age
+
+        return None, open_history_max_age
+
+    # returns the history graph, from the graph cache when the same graph was already rendered from the same data,
+    # otherwise rendered on the graph renderer's worker processes. The ETag comes from the cached graph's name (the
+    # request and the data's fingerprint), so a client that has the graph already gets a 304 before any rendering.
+    async def graph(self, graph_cache, renderer, request=None) -> Response:
+        request_key = graph_cache.request_key(self.ticker_list, self.start_date, self.end_date, self.graph_options)
+        last_modified, max_age = self.cache_validity()
+
+        # a closed range is served without even looking at the data
+        if self.is_closed():
+            graph_path = graph_cache.get(request_key)
+
+            if graph_path:
+                headers, not_modified = conditional(request, make_etag("png", os.path.basename(graph_path)),
+                                                    last_modified, max_age)
+
+                return not_modified or self.png_response(graph_path, headers)
+
+        # the history may have to be downloaded, that is blocking work
+        history = await run_in_threadpool(in_context(lambda: self.history_details))
         close = history["Close"]
+        fingerprint = graph_cache.fingerprint(close)
 
-        figure, axis = pyplot.subplots(figsize=(16, 9))
+        headers, not_modified = conditional(request, make_etag("png", graph_cache.file_name(request_key, fingerprint)),
+                                            last_modified, max_age)
 
-        axis.plot(close.index, close, marker='.', mew='1')
+        if not_modified:
+            return not_modified
 
-        # string that concatenates the ticker list so we can show them off nicely in the title
-        tickers_string = " ".join(self.ticker_list)
+        graph_path = graph_cache.get(request_key, fingerprint)
 
-        pyplot.title(f"{tickers_string} history between {self.start_date} and {self.end_date}")
-        pyplot.xlabel("Date")
-        pyplot.ylabel("Close index")
-        pyplot.grid()
+        if graph_path is None:
+            series = downsample_columns(close.index.to_numpy(), close.to_numpy(), self.graph_options["downsample"],
+                                        point_budget(self.graph_options))
 
-        graph_name = f"../resources/graphs/{graph_name_tickers}_history_{self.start_date}_{self.end_date}.png"
+            try:
+                png = await renderer.render(series, list(close.columns.values), self.title, self.graph_options)
+            except RenderBusy:
+                raise HTTPException(status_code=503, detail="Too many graphs are being rendered, try again later.")
+            except RenderTimeout:
+                raise HTTPException(status_code=504, detail="Rendering the graph took too long.")
 
-        # list of tickers contains more than one ticker
-        if self.number_of_tickers() > 1:
-            axis.legend(close.columns.values, loc="upper right")
+            graph_path = graph_cache.put(request_key, fingerprint, png)
+            logging.info(f"Saved new plot for tickers: {self.ticker_list}. Path: {graph_path}")
 
-        # only one ticker in the list, can't query close.columns so we're using the tickers string as it's suitable
-        else:
-            axis.legend([tickers_string], loc="upper right")
+        return self.png_response(graph_path, headers)
 
-        pyplot.savefig(graph_name)
+    # the file's own modification time says nothing about the data (reading a cached graph touches it too), only our
+    # Last-Modified is sent
+    @staticmethod
+    def png_response(graph_path: str, headers: dict) -> FileResponse:
+        response = FileResponse(graph_path, media_type="image/png", headers=headers, stat_result=os.stat(graph_path))
 
-        logging.info(f"Saved new plot for tickers: {self.ticker_list}. Path: {graph_name}")
-        return FileResponse(graph_name, media_type="image/png")
+        if "Last-Modified" not in headers:
+            del response.headers["last-modified"]
 
+        return response
 
-class EmailSender:
-    # private attributes
-    __config = dotenv_values("../bin/.env") # ../bin/.env
-    __sender_mail = __config["MAIL"]
-    __sender_password = __config["PASS"]
+    # returns what the graph would be drawn from, for clients drawing their own charts: the close series as compact
+    # binary chart data (see encode_chart_data), downsampled like the graph (on the union of the days every ticker
+    # keeps, so they share one date axis) and without rendering anything
+    async def chart_data(self, request=None) -> Response:
+        history = await run_in_threadpool(in_context(lambda: self.history_details))
+        close = history["Close"]
+
+        last_modified, max_age = self.cache_validity()
+        etag = make_etag("data", self.graph_options["downsample"], self.title, close.index.to_numpy(), close.to_numpy())
+        headers, not_modified = conditional(request, etag, last_modified, max_age)
+
+        if not_modified:
+            return not_modified
+
+        series = downsample_columns(close.index.to_numpy(), close.to_numpy(), self.graph_options["downsample"],
+                                    point_budget(self.graph_options))
+        kept_dates = numpy.unique(numpy.concatenate([dates for dates, _ in series]))
+        close = close.loc[kept_dates]
+
+        header = {"tickers": [str(ticker) for ticker in close.columns], "start": self.start_date.isoformat(),
+                  "end": self.end_date.isoformat(), "title": self.title}
+
+        return Response(encode_chart_data(header, close.index.to_numpy(), close.to_numpy()),
+                        media_type=chart_data_media_type, headers=headers)
 
+
+# the account and SMTP server it sends from come from the settings (see settings.py), read when the first email is sent
+class EmailSender:
     def __init__(self, to, subject, body, img):
         self.receiver = to
         self.subject = subject
@@ -202,9 +527,18 @@ class EmailSender:
             logging.error(f"Email of receiver, {email}, is invalid. Send failed.")
             raise HTTPException(status_code=400, detail="Invalid receiver mail given!")
 
-    def send_mail(self):
-        yag = yagmail.SMTP(self.__sender_mail, self.__sender_password)
+    # opens an authenticated SMTP connection, it can be reused for many emails
+    @classmethod
+    def connect(cls) -> "yagmail.SMTP":
+        import yagmail
 
-        logging.info(f"An email with the plot has been sent to {self.receiver}.")
+        return yagmail.SMTP(settings.mail_sender, settings.mail_password, host=settings.smtp_host,
+                            port=settings.smtp_port, smtp_ssl=settings.smtp_ssl)
+
+    # sends the email over the given connection, or over a new one
+    def send_mail(self, connection: "yagmail.SMTP" = None):
+        yag = connection or self.connect()
 
         yag.send(to=self.receiver, subject=self.subject, contents=[self.body, self.img])
+
+        logging.info(f"An email with the plot has been sent to {self.receiver}.")
@@ -0,0 +1,340 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import numpy
+from .metrics import stale_answer
+from .series import CompactSeries, epoch
+from .workers import in_context
+
+# columns we keep for every ticker, in the order they are stored
+history_columns = ("Open", "High", "Low", "Close", "Adj Close", "Volume")
+
+# the oldest day we ever ask upstream for, period="max" starts here
+earliest_date = date(1970, 1, 2)
+
+# how many tickers of a download are read (and fetched) at the same time
+history_download_threads = 8
+
+
+# turns a yfinance period ("5d", "1mo", "ytd", "max"...) into a [start, end) date range ending today.
+# "1d" and "5d" are trading days, so for them the range is wider and last_bars says how many bars to keep.
+# Returns (start, end, last_bars), raises ValueError for an unknown period.
+def period_range(period: str, today: date = None):
+    today = today or date.today()
+    end = today + timedelta(days=1)
+
+    if period in ("1d", "5d"):
+        # enough calendar days to hold that many trading days, even around holidays
+        bars = int(period[:-1])
+        return today - timedelta(days=bars * 2 + 7), end, bars
+
+    if period == "ytd":
+        return date(today.year, 1, 1), end, None
+
+    if period == "max":
+        return earliest_date, end, None
+
+    import pandas
+
+    offsets = {"1mo": pandas.DateOffset(months=1), "3mo": pandas.DateOffset(months=3),
+               "6mo": pandas.DateOffset(months=6), "1y": pandas.DateOffset(years=1),
+               "2y": pandas.DateOffset(years=2), "5y": pandas.DateOffset(years=5),
+               "10y": pandas.DateOffset(years=10)}
+
+    if period not in offsets:
+        raise ValueError(f"Invalid period {period}, it should be one of: 1d, 5d, {', '.join(offsets)}, ytd, max")
+
+    return (pandas.Timestamp(today) - offsets[period]).date(), end, None
+
+
+# local on-disk store of the tickers' daily OHLCV history, so the same years of bars are not downloaded again and
+# again. Every ticker has one column-major .npy matrix (row 0 holds the dates as days since epoch, then one row per
+# column of history_columns) that is memory-mapped when read, plus a small json with the [start, end) date range that
+# was already fetched. A query only goes upstream for the part of its range that isn't covered yet (usually the newest
+# days) and merges it in.
+# Today's bar is not final, so it is fetched again, but at most every `today_ttl` seconds: in between, the bar we got
+# last is answered (a refresh scheduler can keep it fresh in the background, see scheduler.py).
+# The directory can be shared by several worker processes: a ticker is only read and filled while holding a lock file
+# in its directory, and when its bar of today was fetched is kept in the json, so every worker knows it.
+# When fetching fails with one of the `fallback_on` exceptions (upstream being unavailable), what is stored is answered
+# instead and the request is marked as having got stale data.
+# With a series_cache, series() keeps compact copies of the tickers' histories in memory (see series.py), so reading a
+# ticker again doesn't go to the disk as long as its stored history didn't change.
+class HistoryStore:
+    def __init__(self, directory: str, fetch, today_ttl: float = 0, fallback_on: tuple = (), series_cache=None):
+        self.directory = directory
+
+        # fetch(ticker, start, end) -> DataFrame with the history_columns, indexed by date, for [start, end)
+        self.fetch = fetch
+        self.today_ttl = today_ttl
+        self.fallback_on = fallback_on
+        self.series_cache = series_cache
+
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+        # created on the first download of several tickers
+        self._executor = None
+
+    # returns the daily history of a ticker for [start, end) as a DataFrame indexed by date
+    def history(self, ticker: str, start: date, end: date) -> "pandas.DataFrame":
+        return self._to_frame(self.window(ticker, start, end))
+
+    # returns the stored matrix of a ticker (dates row first, then history_columns) for [start, end), without copying
+    # it out of the memory map, so it can be read a few rows at a time. Today's bar is fetched again when the one we
+    # have is older than today_max_age seconds (today_ttl by default, 0 always fetches it).
+    def window(self, ticker: str, start: date, end: date, today_max_age: float = None) -> numpy.ndarray:
+        with self._ticker_lock(ticker):
+            matrix = self._up_to_date(ticker, start, end, today_max_age)
+
+        if matrix is None:
+            return numpy.empty((len(history_columns) + 1, 0), dtype=numpy.float64)
+
+        # binary search the date row
+        first = numpy.searchsorted(matrix[0], (start - epoch).days, side="left")
+        last = numpy.searchsorted(matrix[0], (end - epoch).days, side="left")
+
+        return matrix[:, first:last]
+
+    # returns the daily history of a ticker for [start, end) as a CompactSeries: a view of the ticker's series in the
+    # series cache when nothing needs to be fetched for the range and the stored history is still the one it was made
+    # from, otherwise read (and cached) again once the range is up to date
+    def series(self, ticker: str, start: date, end: date, today_max_age: float = None) -> CompactSeries:
+        key = self._meta_path(ticker)
+
+        with self._ticker_lock(ticker):
+            series = None
+
+            if self.series_cache is not None:
+                covered, today_fetched_at = self._read_meta(ticker)
+
+                if not self._spans_to_fetch(covered, today_fetched_at, start, end, today_max_age):
+                    series = self.series_cache.get(key, self._version(ticker))
+
+            if series is None:
+                matrix = self._up_to_date(ticker, start, end, today_max_age)
+
+                if matrix is None:
+                    return CompactSeries.empty()
+
+                series = CompactSeries.from_matrix(matrix)
+
+                if self.series_cache is not None:
+                    self.series_cache.put(key, self._version(ticker), series)
+
+        return series.between(start, end)
+
+    # same shape as yfinance.download for a list of tickers: the columns are (column, ticker) pairs. The tickers are
+    # read at the same time, so the ones missing the same days are fetched together (the gateway batches them into
+    # one upstream download) instead of one after the other.
+    def download(self, tickers: list, start: date, end: date) -> "pandas.DataFrame":
+        import pandas
+
+        if len(tickers) > 1:
+            with self._locks_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=history_download_threads,
+                                                        thread_name_prefix="history")
+
+            futures = [self._executor.submit(in_context(self.history, ticker, start, end)) for ticker in tickers]
+            frames = [future.result() for future in futures]
+        else:
+            frames = [self.history(ticker, start, end) for ticker in tickers]
+
+        return pandas.concat(frames, axis=1, keys=tickers).swaplevel(axis=1)
+
+    # the [start, end) spans of a query that are not covered yet, so the covered range always stays contiguous
+    @staticmethod
+    def missing_spans(covered, start: date, end: date) -> list:
+        # today's bar is not final yet, it always gets fetched again
+        end = min(end, date.today() + timedelta(days=1))
+
+        if start >= end:
+            return []
+
+        if covered is None:
+            return [(start, end)]
+
+        covered_start, covered_end = covered
+        spans = []
+
+        if start < covered_start:
+            spans.append((start, covered_start))
+
+        # also when the query starts after the covered range, so there is never a hole in it
+        if end > covered_end:
+            spans.append((covered_end, end))
+
+        return spans
+
+    # the spans of [start, end) to fetch: the missing ones, but not today's bar while the one we have is younger than
+    # today_max_age seconds
+    def _spans_to_fetch(self, covered, today_fetched_at, start: date, end: date, today_max_age: float = None) -> list:
+        if today_max_age is None:
+            today_max_age = self.today_ttl
+
+        spans = self.missing_spans(covered, start, end)
+
+        if covered and covered[1] == date.today() and today_fetched_at is not None \
+                and time.time() - today_fetched_at < today_max_age:
+            spans = [span for span in spans if span[0] != covered[1]]
+
+        return spans
+
+    # needs the ticker's lock to be held: the whole stored matrix of the ticker (None when there is none) once what
+    # [start, end) misses was fetched and merged in
+    def _up_to_date(self, ticker, start: date, end: date, today_max_age: float = None):
+        matrix, covered, today_fetched_at = self._read(ticker)
+
+        spans = self._spans_to_fetch(covered, today_fetched_at, start, end, today_max_age)
+
+        if spans:
+            try:
+                matrix, covered, _ = self._fill(ticker, matrix, covered, spans, today_fetched_at)
+            except self.fallback_on as e:
+                if matrix is None:
+                    raise
+
+                # as old as the last time something was fetched for the ticker
+                age = time.time() - os.path.getmtime(self._meta_path(ticker))
+                logging.warning(f"Fetching the {ticker} history failed ({e}), answering the stored history.")
+                stale_answer("history", age)
+
+        return matrix
+
+    def _fill(self, ticker, matrix, covered, spans, today_fetched_at=None):
+        fetched = [matrix] if matrix is not None else []
+
+        for span_start, span_end in spans:
+            logging.info(f"Fetching {ticker} history between {span_start} and {span_end} from upstream.")
+            fetched.append(self._to_matrix(self.fetch(ticker, span_start, span_end)))
+
+            if span_end > date.today():
+                today_fetched_at = time.time()
+
+        merged = numpy.concatenate(fetched, axis=1)
+
+        # newer fetches come last, so for a day we got twice we keep the last one
+        _, last_positions = numpy.unique(merged[0][::-1], return_index=True)
+        merged = merged[:, merged.shape[1] - 1 - last_positions]
+
+        starts = [span[0] for span in spans] + ([covered[0]] if covered else [])
+        ends = [span[1] for span in spans] + ([covered[1]] if covered else [])
+
+        # days up to today are covered, today itself is not final yet
+        covered = (min(starts), min(max(ends), date.today()))
+
+        self._write(ticker, merged, covered, today_fetched_at)
+
+        return merged, covered, today_fetched_at
+
+    def _read(self, ticker):
+        covered, today_fetched_at = self._read_meta(ticker)
+
+        if covered is None:
+            return None, None, None
+
+        try:
+            matrix = numpy.load(self._data_path(ticker), mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None, None, None
+
+        return matrix, covered, today_fetched_at
+
+    # the covered range of a ticker and when its bar of today was fetched, (None, None) when nothing is stored
+    def _read_meta(self, ticker):
+        try:
+            with open(self._meta_path(ticker), "r") as meta_file:
+                meta = json.load(meta_file)
+        except (FileNotFoundError, ValueError):
+            return None, None
+
+        return (date.fromisoformat(meta["start"]), date.fromisoformat(meta["end"])), meta.get("today_fetched_at")
+
+    # changes every time the ticker's history is written, the json being replaced last
+    def _version(self, ticker):
+        try:
+            meta_stat = os.stat(self._meta_path(ticker))
+        except FileNotFoundError:
+            return None
+
+        return meta_stat.st_ino, meta_stat.st_mtime_ns, meta_stat.st_size
+
+    # the data is written first and the covered range second, both through temporary files (named after the process
+    # and thread, so writers never share one) and atomic replaces, so a reader (or a crash) never sees a range that
+    # covers more than the data does
+    def _write(self, ticker, matrix, covered, today_fetched_at=None):
+        os.makedirs(self._ticker_directory(ticker), exist_ok=True)
+        suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+
+        data_path = self._data_path(ticker)
+        with open(f"{data_path}.{suffix}", "wb") as data_file:
+            numpy.save(data_file, numpy.ascontiguousarray(matrix, dtype=numpy.float64))
+        os.replace(f"{data_path}.{suffix}", data_path)
+
+        meta_path = self._meta_path(ticker)
+        with open(f"{meta_path}.{suffix}", "w") as meta_file:
+            json.dump({"start": covered[0].isoformat(), "end": covered[1].isoformat(),
+                       "today_fetched_at": today_fetched_at}, meta_file)
+        os.replace(f"{meta_path}.{suffix}", meta_path)
+
+    @staticmethod
+    def _to_matrix(frame: "pandas.DataFrame") -> numpy.ndarray:
+        index = frame.index
+
+        if getattr(index, "tz", None) is not None:
+            # the exchange's local date is the trading day
+            index = index.tz_localize(None)
+
+        days = index.values.astype("datetime64[D]").astype(numpy.int64)
+
+        matrix = numpy.empty((len(history_columns) + 1, len(frame)), dtype=numpy.float64)
+        matrix[0] = days
+
+        for row, column in enumerate(history_columns, start=1):
+            matrix[row] = frame[column].to_numpy(dtype=numpy.float64) if column in frame else numpy.nan
+
+        return matrix
+
+    # only the window is copied out of the memory map
+    @staticmethod
+    def _to_frame(window: numpy.ndarray) -> "pandas.DataFrame":
+        import pandas
+
+        window = numpy.array(window)
+        index = pandas.DatetimeIndex(window[0].astype(numpy.int64).astype("datetime64[D]"), name="Date")
+
+        return pandas.DataFrame({column: window[row] for row, column in enumerate(history_columns, start=1)},
+                                index=index)
+
+    # the threads of this process queue up on a lock, the processes on a lock file
+    @contextlib.contextmanager
+    def _ticker_lock(self, ticker):
+        with self._locks_lock:
+            lock = self._locks.setdefault(ticker, threading.Lock())
+
+        with lock:
+            os.makedirs(self._ticker_directory(ticker), exist_ok=True)
+
+            with open(os.path.join(self._ticker_directory(ticker), ".lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _ticker_directory(self, ticker):
+        return os.path.join(self.directory, ticker)
+
+    def _data_path(self, ticker):
+        return os.path.join(self._ticker_directory(ticker), "ohlcv.npy")
+
+    def _meta_path(self, ticker):
+        return os.path.join(self._ticker_directory(ticker), "covered.json")
@@ -0,0 +1,180 @@
+import bisect
+import threading
+import time
+
+
+# in-memory index over the metadata of the portfolio tickers, so the get_all_tickers filters are answered without
+# going upstream for every saved ticker. Categorical fields (country, sector, exchange) are hash maps from value to the
+# set of tickers having it, the market cap is a sorted array searched with binary search for range queries.
+# It is updated ticker by ticker, by add_ticker / delete_ticker and whenever fresh metadata is loaded.
+class PortfolioIndex:
+    categorical_fields = ("country", "sector", "exchange")
+
+    def __init__(self, max_age: float = 300):
+        # an entry older than this (seconds) is reported by missing(), so it gets fetched and indexed again
+        self.max_age = max_age
+
+        # ticker -> (time it was indexed at, position in the portfolio, indexed metadata)
+        self._records = {}
+        # field -> value -> set of tickers; the None value holds the tickers that don't have the field at all
+        self._by_field = {field: {} for field in self.categorical_fields}
+        # sorted (market cap, ticker) pairs, tickers without a market cap are kept apart
+        self._market_caps = []
+        self._without_market_cap = set()
+
+        self._next_position = 0
+        self._lock = threading.RLock()
+
+    # indexes (or re-indexes) a ticker from its yfinance .info metadata. position is its place in the portfolio,
+    # by default it keeps the one it had or goes after every other ticker
+    def update(self, ticker: str, ticker_info: dict, position: int = None):
+        with self._lock:
+            previous = self._records.get(ticker)
+
+            if position is None:
+                position = previous[1] if previous else self._next_position
+
+            self._next_position = max(self._next_position, position + 1)
+
+            if previous:
+                self._unindex(ticker, previous[2])
+
+            record = {field: ticker_info.get(field) or None for field in self.categorical_fields}
+            record["marketCap"] = ticker_info.get("marketCap") or None
+
+            for field in self.categorical_fields:
+                self._by_field[field].setdefault(record[field], set()).add(ticker)
+
+            if record["marketCap"] is None:
+                self._without_market_cap.add(ticker)
+            else:
+                bisect.insort(self._market_caps, (record["marketCap"], ticker))
+
+            self._records[ticker] = (time.monotonic(), position, record)
+
+    # only re-indexes tickers that are already part of the index (used when fresh metadata gets loaded)
+    def refresh(self, ticker: str, ticker_info: dict):
+        with self._lock:
+            if ticker in self._records:
+                self.update(ticker, ticker_info)
+
+    def remove(self, ticker: str):
+        with self._lock:
+            previous = self._records.pop(ticker, None)
+
+            if previous:
+                self._unindex(ticker, previous[2])
+
+    # keeps the index in step with the portfolio, which other workers may have changed: tickers that are not saved
+    # anymore are dropped, the others get their current position in it
+    def retain(self, tickers: list):
+        positions = {ticker: position for position, ticker in enumerate(tickers)}
+
+        with self._lock:
+            for ticker in [ticker for ticker in self._records if ticker not in positions]:
+                self.remove(ticker)
+
+            for ticker, (indexed_at, _, record) in self._records.items():
+                self._records[ticker] = (indexed_at, positions[ticker], record)
+
+            self._next_position = len(tickers)
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._by_field = {field: {} for field in self.categorical_fields}
+            self._market_caps = []
+            self._without_market_cap = set()
+            self._next_position = 0
+
+    # returns the tickers that are not indexed yet (or whose entry is too old), keeping their order
+    def missing(self, tickers) -> list:
+        now = time.monotonic()
+
+        with self._lock:
+            return [ticker for ticker in tickers
+                    if ticker not in self._records or now - self._records[ticker][0] >= self.max_age]
+
+    # returns the indexed tickers fitting all the given filters. The country has to match, but a ticker missing the
+    # sector, exchange or market cap field is not filtered out by it (the way the portfolio listing always worked).
+    # sort can be None (portfolio order), "market_cap" (ascending) or "-market_cap" (descending), offset and limit
+    # paginate the sorted result. Returns (total number of matches, requested page).
+    def query(self, market_cap_min: float = None, market_cap_max: float = None, country: str = None,
+              exchange: str = None, sector: str = None, sort: str = None, offset: int = 0, limit: int = None):
+        with self._lock:
+            candidate_sets = []
+
+            if country:
+                candidate_sets.append(self._by_field["country"].get(country, set()))
+
+            for field, value in (("sector", sector), ("exchange", exchange)):
+                if value:
+                    candidate_sets.append(self._by_field[field].get(value, set()) |
+                                          self._by_field[field].get(None, set()))
+
+            if market_cap_min or market_cap_max:
+                candidate_sets.append(self._market_cap_range(market_cap_min, market_cap_max) |
+                                      self._without_market_cap)
+
+            if candidate_sets:
+                # intersect starting from the smallest set, so we only walk over possible matches
+                candidate_sets.sort(key=len)
+                matches = set(candidate_sets[0])
+
+                for candidate_set in candidate_sets[1:]:
+                    matches.intersection_update(candidate_set)
+            else:
+                matches = set(self._records)
+
+            if sort in ("market_cap", "-market_cap"):
+                # tickers without a market cap always come last
+                with_cap = [ticker for ticker in matches if self._records[ticker][2]["marketCap"] is not None]
+                with_cap.sort(key=lambda ticker: self._records[ticker][2]["marketCap"],
+                              reverse=sort == "-market_cap")
+                without_cap = sorted(matches.difference(with_cap), key=lambda ticker: self._records[ticker][1])
+                ordered = with_cap + without_cap
+            else:
+                ordered = sorted(matches, key=lambda ticker: self._records[ticker][1])
+
+        end = None if limit is None else offset + limit
+
+        return len(ordered), ordered[offset:end]
+
+    # needs self._lock to be held; returns the tickers having min <= market cap <= max (a None bound is open)
+    def _market_cap_range(self, market_cap_min, market_cap_max) -> set:
+        low = 0
+        high = len(self._market_caps)
+
+        if market_cap_min:
+            low = bisect.bisect_left(self._market_caps, (market_cap_min,))
+
+        if market_cap_max:
+            # every pair with this market cap sorts before (market_cap_max, +infinity)
+            high = bisect.bisect_right(self._market_caps, (market_cap_max, chr(0x10FFFF)))
+
+        return {ticker for _, ticker in self._market_caps[low:high]}
+
+    # needs self._lock to be held
+    def _unindex(self, ticker: str, record: dict):
+        for field in self.categorical_fields:
+            tickers = self._by_field[field].get(record[field])
+
+            if tickers is not None:
+                tickers.discard(ticker)
+
+                if not tickers:
+                    del self._by_field[field][record[field]]
+
+        if record["marketCap"] is None:
+            self._without_market_cap.discard(ticker)
+        else:
+            position = bisect.bisect_left(self._market_caps, (record["marketCap"], ticker))
+
+            if position < len(self._market_caps) and self._market_caps[position] == (record["marketCap"], ticker):
+                del self._market_caps[position]
+
+    def __contains__(self, ticker):
+        return ticker in self._records
+
+    def __len__(self):
+        return len(self._records)
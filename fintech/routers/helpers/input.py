@@ -1,5 +1,86 @@
 # instantiating a class object for the so-called database, so we don't repeat it in every router
 from .helpers import Input
+from .cache import TTLCache
+from .workers import WorkerPool
+from .index import PortfolioIndex
+from .history import HistoryStore
+from .series import SeriesCache
+from .metrics import registry
+from .scheduler import RefreshScheduler, RefreshJob
+from .shared import SharedStore
+from .upstream import gateway, UpstreamUnavailable
+from datetime import date, timedelta
 
 portfolio_file = "../resources/tickers.txt"
-input_file = Input(portfolio_file)
\ No newline at end of file
+history_directory = "../resources/history"
+
+# sqlite database the workers of the app (uvicorn --workers) share their fetched metadata through
+shared_cache_file = "../resources/cache.sqlite3"
+
+# how long (seconds) a ticker's .info metadata is reused before going upstream again, and how many tickers we keep.
+# For metadata_stale_ttl more seconds it is still answered right away, while being loaded again in the background.
+metadata_ttl = 300
+metadata_stale_ttl = 3600
+metadata_max_size = 512
+
+# today's bar of a ticker's history is fetched again at most this often (seconds)
+history_today_ttl = 900
+
+# how much memory (bytes) the compact histories kept in memory may take, at 32 bytes a bar: 64MB hold 10 years of some
+# 800 tickers
+history_cache_bytes = 64 * 1024 * 1024
+
+# the portfolio's metadata and recent history (history_refresh_days back) are refreshed in the background every so
+# many seconds (with some jitter), at most refresh_rate refreshes per second; a bit more often than they expire, so
+# requests find them fresh
+metadata_refresh_interval = 240
+history_refresh_interval = 600
+history_refresh_days = 366
+refresh_rate = 5
+refresh_jitter = 0.1
+
+# how many tickers' metadata we fetch at the same time when listing the portfolio, and how long we wait for each one
+metadata_workers = 16
+metadata_timeout = 10
+
+
+# one metadata cache for the whole process, shared by the portfolio and ticker info routers. The metadata and the
+# history are fetched through the upstream gateway (see upstream.py), like all market data. While upstream is
+# unavailable both answer the last data they have.
+metadata_cache = TTLCache(gateway.info, ttl=metadata_ttl, max_size=metadata_max_size, name="metadata",
+                          stale_ttl=metadata_stale_ttl, shared=SharedStore(shared_cache_file, "metadata"),
+                          fallback_on=(UpstreamUnavailable,))
+
+# bounded pool the metadata fetches run on, so a big portfolio doesn't block the event loop
+metadata_pool = WorkerPool(max_workers=metadata_workers, timeout=metadata_timeout, name="metadata")
+
+# filter index over the portfolio's metadata, kept up to date every time the metadata of an indexed ticker is loaded
+portfolio_index = PortfolioIndex(max_age=metadata_ttl)
+metadata_cache.subscribe(portfolio_index.refresh)
+registry.register_cache("metadata", metadata_cache.stats)
+
+# daily OHLCV history of the tickers, kept on disk and only topped up from upstream, the most used ones also in memory
+history_cache = SeriesCache(history_cache_bytes, name="history")
+history_store = HistoryStore(history_directory, gateway.history, today_ttl=history_today_ttl,
+                             fallback_on=(UpstreamUnavailable,), series_cache=history_cache)
+registry.register_cache("history", history_cache.stats)
+
+input_file = Input(portfolio_file, metadata_cache)
+
+
+# a worker doesn't refresh what another worker just refreshed
+def refresh_ticker_metadata(ticker: str):
+    metadata_cache.refresh(ticker, max_age=metadata_ttl - metadata_refresh_interval)
+
+
+def refresh_ticker_history(ticker: str):
+    today = date.today()
+    history_store.window(ticker, today - timedelta(days=history_refresh_days), today + timedelta(days=1),
+                         today_max_age=history_today_ttl - history_refresh_interval)
+
+
+# keeps the portfolio's caches warm, started with the app
+refresh_scheduler = RefreshScheduler(input_file.tickers,
+                                     [RefreshJob("metadata", refresh_ticker_metadata, metadata_refresh_interval),
+                                      RefreshJob("history", refresh_ticker_history, history_refresh_interval)],
+                                     rate=refresh_rate, jitter=refresh_jitter)
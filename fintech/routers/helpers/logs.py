@@ -0,0 +1,134 @@
+import contextvars
+import json
+import logging
+import logging.handlers
+import queue
+import random
+from datetime import datetime
+
+# attributes every LogRecord has; anything else on a record came through `extra` and goes into the json line
+standard_record_attributes = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+# number of upstream (yfinance) calls made while handling the current request, see count_upstream_call()
+upstream_calls = contextvars.ContextVar("upstream_calls", default=None)
+
+
+# mutable counter the middleware puts in the request's context; worker threads get the same object through the
+# copied context, so their calls are counted too
+class CallCounter:
+    def __init__(self):
+        self.count = 0
+
+
+def count_upstream_call():
+    counter = upstream_calls.get()
+
+    if counter is not None:
+        counter.count += 1
+
+
+# the stale data (last known good values answered while upstream was unavailable) the current request got, see
+# mark_stale(). The middleware puts a StaleData in the request's context, like the CallCounter.
+stale_data = contextvars.ContextVar("stale_data", default=None)
+
+
+class StaleData:
+    def __init__(self):
+        # what the data is (metadata, history) -> age in seconds of the oldest one answered
+        self.ages = {}
+
+    def mark(self, source: str, age: float):
+        self.ages[source] = max(age, self.ages.get(source, 0))
+
+    # X-Stale-Data header value: "history=86400, metadata=310"
+    def header(self) -> str:
+        return ", ".join(f"{source}={int(age)}" for source, age in sorted(self.ages.items()))
+
+
+def mark_stale(source: str, age: float):
+    marker = stale_data.get()
+
+    if marker is not None:
+        marker.mark(source, age)
+
+
+# one json object per line: time, level, logger, message, plus the fields given through `extra`
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in standard_record_attributes:
+                line[key] = value
+
+        if record.exc_info:
+            line["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(line, default=str)
+
+
+# keeps only a share of a logger's records at INFO or below (warnings and errors always pass)
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: dict):
+        super().__init__()
+
+        # logger name -> share of its records we keep, between 0 and 1
+        self.rates = rates
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO:
+            return True
+
+        rate = self.rates.get(record.name)
+
+        return rate is None or random.random() < rate
+
+
+# puts records on the queue as they are: the message is only formatted later, by the writer thread
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+# routes every log record through a queue to a background thread that writes json lines to a rotating file, so
+# requests never wait on file I/O. rotation is "size" (every max_bytes) or "time" (every `when`, e.g. "midnight").
+# levels sets the level of single loggers, sampling the share of their INFO records that get written.
+# Returns the started listener, stop it at shutdown so the queue gets flushed.
+def setup_logging(path: str, level: int = logging.INFO, rotation: str = "size", max_bytes: int = 10 * 1024 * 1024,
+                  when: str = "midnight", backups: int = 5, levels: dict = None,
+                  sampling: dict = None) -> logging.handlers.QueueListener:
+    if rotation == "time":
+        file_handler = logging.handlers.TimedRotatingFileHandler(path, when=when, backupCount=backups,
+                                                                 encoding="utf-8")
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                            encoding="utf-8")
+
+    file_handler.setFormatter(JsonFormatter())
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+
+    if sampling:
+        queue_handler.addFilter(SamplingFilter(sampling))
+
+    root = logging.getLogger()
+    root.setLevel(level)
+
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    root.addHandler(queue_handler)
+
+    for logger_name, logger_level in (levels or {}).items():
+        logging.getLogger(logger_name).setLevel(logger_level)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+
+    return listener
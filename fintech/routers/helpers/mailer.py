@@ -0,0 +1,226 @@
+import logging
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from .metrics import email_send_duration
+
+
+# one email waiting to be (or already) delivered by the mail queue
+class MailJob:
+    def __init__(self, sender, attachment_path: str = None):
+        self.id = uuid.uuid4().hex
+        self.sender = sender
+        self.attachment_path = attachment_path
+        self.status = "queued"
+        self.attempts = 0
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+
+    def update(self, status: str, error: str = None):
+        self.status = status
+        self.error = error
+        self.updated_at = time.time()
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "status": self.status,
+            "receiver": self.sender.receiver,
+            "attempts": self.attempts,
+            "error": self.error,
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+
+# background email delivery: requests only enqueue a job, a pool of worker threads sends them. Every worker keeps its
+# own authenticated SMTP connection open between jobs, sends up to `batch_size` queued jobs over it in one go, and
+# retries failed jobs with exponential backoff (`backoff` seconds, doubled every attempt) up to `max_attempts` times.
+class MailQueue:
+    # the statuses after which a job doesn't change anymore
+    finished_statuses = ("sent", "failed")
+
+    def __init__(self, connect, workers: int = 2, batch_size: int = 10, max_attempts: int = 5,
+                 backoff: float = 2, max_jobs: int = 1000):
+        # connect() -> an SMTP connection (yagmail.SMTP or anything with the same send()/close())
+        self.connect = connect
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+
+        # how many finished jobs we remember for the status endpoint
+        self.max_jobs = max_jobs
+
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._threads = []
+        self._running = False
+        self._lock = threading.Lock()
+
+        # where the graphs are copied to until they are sent, the graph cache may evict the originals meanwhile
+        self._spool = None
+
+    # starts the worker threads, done on the first submit if nobody did it before
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+
+            self._running = True
+            self._threads = [threading.Thread(target=self._work, name=f"mailer-{number}", daemon=True)
+                             for number in range(self.workers)]
+
+        for thread in self._threads:
+            thread.start()
+
+    # lets the workers finish the batch they are sending and stops them
+    def stop(self, timeout: float = 10):
+        with self._lock:
+            if not self._running:
+                return
+
+            self._running = False
+
+        for _ in self._threads:
+            self._queue.put(None)
+
+        for thread in self._threads:
+            thread.join(timeout)
+
+        self._threads = []
+
+    # enqueues an EmailSender (its receiver already validated), with an image to inline in the email
+    def submit(self, sender, attachment_path: str = None) -> MailJob:
+        self.start()
+
+        if attachment_path:
+            if self._spool is None:
+                self._spool = tempfile.mkdtemp(prefix="fintech-mail-")
+
+            spooled_path = os.path.join(self._spool, f"{uuid.uuid4().hex}{os.path.splitext(attachment_path)[1]}")
+            shutil.copyfile(attachment_path, spooled_path)
+
+            import yagmail
+            sender.img = yagmail.inline(spooled_path)
+            attachment_path = spooled_path
+
+        job = MailJob(sender, attachment_path)
+
+        with self._lock:
+            self._jobs[job.id] = job
+            self._forget_finished_jobs()
+
+        self._queue.put(job)
+        logging.info(f"Queued email job {job.id} for {sender.receiver}.")
+
+        return job
+
+    # returns the state of a job as a dict, or None if we don't know it (anymore)
+    def status(self, job_id: str):
+        with self._lock:
+            job = self._jobs.get(job_id)
+
+            return job.to_dict() if job else None
+
+    def _work(self):
+        connection = None
+
+        while True:
+            job = self._queue.get()
+
+            if job is None:
+                break
+
+            # whatever else is already waiting goes out over the same connection
+            batch = [job]
+            while len(batch) < self.batch_size:
+                try:
+                    next_job = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                if next_job is None:
+                    # keep the stop signal for after this batch
+                    self._queue.put(None)
+                    break
+
+                batch.append(next_job)
+
+            for job in batch:
+                connection = self._send(job, connection)
+
+        if connection is not None:
+            self._close(connection)
+
+    # sends one job, returns the connection to use for the next one (None once it broke)
+    def _send(self, job: MailJob, connection):
+        job.attempts += 1
+        job.update("sending")
+
+        start_time = time.perf_counter()
+
+        try:
+            if connection is None:
+                connection = self.connect()
+
+            job.sender.send_mail(connection)
+        except Exception as e:
+            email_send_duration.observe(time.perf_counter() - start_time, outcome="error")
+            logging.error(f"Email job {job.id} failed (attempt {job.attempts}): {e}")
+
+            # the connection may be what broke, the next job opens a new one
+            if connection is not None:
+                self._close(connection)
+
+            if job.attempts >= self.max_attempts:
+                job.update("failed", str(e))
+                self._discard_attachment(job)
+            else:
+                job.update("retrying", str(e))
+
+                delay = self.backoff * 2 ** (job.attempts - 1)
+                retry = threading.Timer(delay, self._queue.put, args=(job,))
+                retry.daemon = True
+                retry.start()
+
+            return None
+
+        email_send_duration.observe(time.perf_counter() - start_time, outcome="ok")
+
+        job.update("sent")
+        self._discard_attachment(job)
+
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        try:
+            connection.close()
+        except Exception as e:
+            logging.warning(f"Closing an SMTP connection failed: {e}")
+
+    @staticmethod
+    def _discard_attachment(job: MailJob):
+        if job.attachment_path:
+            try:
+                os.remove(job.attachment_path)
+            except FileNotFoundError:
+                pass
+
+    # needs self._lock to be held; drops the oldest finished jobs once we remember too many
+    def _forget_finished_jobs(self):
+        if len(self._jobs) <= self.max_jobs:
+            return
+
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.status in self.finished_statuses]:
+            del self._jobs[job_id]
+
+            if len(self._jobs) <= self.max_jobs:
+                break
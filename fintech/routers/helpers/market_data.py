@@ -0,0 +1,209 @@
+import asyncio
+import importlib.util
+import threading
+from datetime import date, datetime, time, timezone
+from .history import history_columns
+
+# Yahoo Finance's API, the one yfinance talks to. It wants a cookie and crumb this client doesn't get, so in practice
+# MARKET_DATA_URL points it at a local stand-in or a proxy that handles them.
+market_data_base_url = "https://query2.finance.yahoo.com"
+
+# the connection pool of the client: at most this many connections open at once, this many idle ones kept alive for
+# keepalive_expiry seconds, and how long (seconds) one request may take
+market_data_connections = 20
+market_data_keepalive = 10
+market_data_keepalive_expiry = 30
+market_data_timeout = 10
+
+# the quoteSummary modules the .info fields the routers read come from (marketCap, forwardPE, lastDividendValue...)
+quote_summary_modules = ("price", "summaryDetail", "defaultKeyStatistics", "assetProfile")
+
+# the chart's quote columns, as the history columns they become
+chart_columns = {"open": "Open", "high": "High", "low": "Low", "close": "Close", "volume": "Volume"}
+
+
+def _timestamp(day: date) -> int:
+    return int(datetime.combine(day, time(), tzinfo=timezone.utc).timestamp())
+
+
+# the exchange's dates of a chart's timestamps, as the naive daily index yfinance gives its frames
+def _chart_dates(chart: dict) -> "pandas.DatetimeIndex":
+    import pandas
+
+    offset = chart["meta"].get("gmtoffset", 0)
+    timestamps = pandas.to_datetime([stamp + offset for stamp in chart.get("timestamp", [])], unit="s")
+
+    return pandas.DatetimeIndex(timestamps.normalize(), name="Date")
+
+
+# market data client on a pooled async HTTP client (httpx): keep-alive connections shared by every request, HTTP/2
+# when the h2 package is installed. It answers the shapes the routers read from yfinance: the .info dict, the dividends
+# Series and the daily bars as frames.
+# The pool belongs to the event loop it was first used on, the client is meant to stay on that loop.
+class MarketDataClient:
+    def __init__(self, base_url: str = market_data_base_url, max_connections: int = market_data_connections,
+                 max_keepalive: int = market_data_keepalive, keepalive_expiry: float = market_data_keepalive_expiry,
+                 timeout: float = market_data_timeout, http2: bool = True):
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self.timeout = timeout
+        self.http2 = http2 and importlib.util.find_spec("h2") is not None
+
+        # created on the first request, so building a client doesn't import httpx
+        self._client = None
+
+    def client(self) -> "httpx.AsyncClient":
+        if self._client is None:
+            import httpx
+
+            limits = httpx.Limits(max_connections=self.max_connections,
+                                  max_keepalive_connections=self.max_keepalive,
+                                  keepalive_expiry=self.keepalive_expiry)
+            self._client = httpx.AsyncClient(base_url=self.base_url, limits=limits, timeout=self.timeout,
+                                             http2=self.http2, headers={"User-Agent": "fintech-time-machine"})
+
+        return self._client
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # the json answer of a GET, None when upstream doesn't know what was asked for (404). Other failed answers raise
+    # httpx.HTTPStatusError.
+    async def _get(self, path: str, params: dict = None):
+        response = await self.client().get(path, params=params)
+
+        if response.status_code == 404:
+            return None
+
+        response.raise_for_status()
+
+        return response.json()
+
+    # the ticker's .info metadata: the quoteSummary modules merged into one dict of raw values. An unknown ticker has
+    # none (so no marketCap either, which is how adding it gets refused).
+    async def info(self, ticker: str) -> dict:
+        answer = await self._get(f"/v10/finance/quoteSummary/{ticker}",
+                                 {"modules": ",".join(quote_summary_modules)})
+        results = ((answer or {}).get("quoteSummary") or {}).get("result") or []
+
+        info = {}
+
+        for module in results[0].values() if results else ():
+            for field, value in module.items():
+                # numbers come as {"raw": 2.1e12, "fmt": "2.1T"}, missing ones as {}
+                if isinstance(value, dict):
+                    value = value.get("raw")
+
+                if value is not None:
+                    info[field] = value
+
+        return info
+
+    async def _chart(self, ticker: str, params: dict):
+        answer = await self._get(f"/v8/finance/chart/{ticker}", params)
+        results = ((answer or {}).get("chart") or {}).get("result") or []
+
+        return results[0] if results else None
+
+    # the ticker's dividends, a Series indexed by date, empty for an unknown ticker
+    async def dividends(self, ticker: str) -> "pandas.Series":
+        import pandas
+
+        chart = await self._chart(ticker, {"range": "max", "interval": "1mo", "events": "div"})
+        events = (chart or {}).get("events", {}).get("dividends", {})
+
+        offset = chart["meta"].get("gmtoffset", 0) if chart else 0
+        events = sorted(events.values(), key=lambda event: event["date"])
+        dates = pandas.to_datetime([event["date"] + offset for event in events], unit="s").normalize()
+
+        return pandas.Series([event["amount"] for event in events], index=pandas.DatetimeIndex(dates, name="Date"),
+                             name="Dividends", dtype=float)
+
+    # the daily bars of one ticker for [start, end) with the history_columns, None for an unknown ticker
+    async def history(self, ticker: str, start: date, end: date, interval: str = "1d"):
+        import pandas
+
+        chart = await self._chart(ticker, {"period1": _timestamp(start), "period2": _timestamp(end),
+                                           "interval": interval, "events": "div,split"})
+
+        if chart is None:
+            return None
+
+        quote = (chart.get("indicators", {}).get("quote") or [{}])[0]
+        adjusted = (chart.get("indicators", {}).get("adjclose") or [{}])[0]
+
+        # missing prices are nulls, NaN in the frame
+        frame = pandas.DataFrame({column: quote.get(field) or [] for field, column in chart_columns.items()},
+                                 index=_chart_dates(chart), dtype=float)
+        frame["Adj Close"] = pandas.Series(adjusted.get("adjclose") or frame["Close"].to_numpy(), index=frame.index,
+                                           dtype=float)
+
+        # bars without a single price (holidays the exchange still reports) are left out, like yfinance does
+        frame = frame[list(history_columns)].dropna(how="all", subset=["Open", "High", "Low", "Close"])
+
+        # a bar of the same day twice (today's live one next to the last close) keeps the newest
+        return frame[~frame.index.duplicated(keep="last")]
+
+    # the daily bars of several tickers, the columns being (column, ticker) pairs like yfinance.download. The tickers'
+    # charts are requested concurrently over the pooled connections, the unknown ones are left out.
+    async def download(self, tickers: list, start: date, end: date, interval: str = "1d") -> "pandas.DataFrame":
+        import pandas
+
+        histories = await asyncio.gather(*(self.history(ticker, start, end, interval) for ticker in tickers))
+        known = {ticker: history for ticker, history in zip(tickers, histories) if history is not None}
+
+        if not known:
+            return pandas.DataFrame(columns=pandas.MultiIndex.from_product([history_columns, []]),
+                                    index=pandas.DatetimeIndex([], name="Date"), dtype=float)
+
+        return pandas.concat(known, axis=1).swaplevel(axis=1)
+
+
+# the client as a provider of the upstream gateway (see upstream.py), whose calls are synchronous: they run on the
+# provider's own event loop thread, so all of them share one connection pool, and a download's tickers are fetched
+# concurrently on it instead of one thread each.
+class MarketDataProvider:
+    def __init__(self, client: MarketDataClient):
+        self.client = client
+
+        self._loop = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _run(self, coroutine):
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name="market-data", daemon=True)
+                self._thread.start()
+
+            loop = self._loop
+
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def info(self, ticker: str) -> dict:
+        return self._run(self.client.info(ticker))
+
+    def dividends(self, ticker: str):
+        return self._run(self.client.dividends(ticker))
+
+    def download(self, tickers: list, start, end, interval: str = "1d"):
+        return self._run(self.client.download(tickers, start, end, interval))
+
+    # closes the pooled connections and stops the loop thread
+    def close(self):
+        with self._lock:
+            loop, thread = self._loop, self._thread
+            self._loop = self._thread = None
+
+        if loop is None:
+            return
+
+        asyncio.run_coroutine_threadsafe(self.client.aclose(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
@@ -0,0 +1,263 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from .logs import count_upstream_call, mark_stale
+
+# upper bounds (seconds) of the latency histograms' buckets
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(pairs) -> str:
+    if not pairs:
+        return ""
+
+    escaped = ((name, str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+               for name, value in pairs)
+
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+# base of the in-process metrics: one value per combination of label values, kept in a dict under a lock, so
+# recording is a dict lookup and an addition
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    # (name suffix, label pairs, value) for every value of the metric
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+
+        for key, value in values:
+            yield "", tuple(zip(self.label_names, key)), value
+
+    # the metric in the Prometheus text format
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+        for suffix, pairs, value in self.samples():
+            lines.append(f"{self.name}{suffix}{format_labels(pairs)} {format_value(value)}")
+
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    # counts what is running inside the block
+    @contextmanager
+    def track_in_progress(self, **labels):
+        self.inc(**labels)
+
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+# every value is [count per bucket (the last one is +Inf), sum, count]; buckets are made cumulative only when rendered
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=default_buckets):
+        super().__init__(name, documentation, labels)
+
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        bucket = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            observations = self._values.get(key)
+
+            if observations is None:
+                observations = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            observations[0][bucket] += 1
+            observations[1] += value
+            observations[2] += 1
+
+    # observes how long the block takes, in seconds
+    @contextmanager
+    def time(self, **labels):
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, **labels)
+
+    def count(self, **labels) -> int:
+        observations = self._values.get(self._key(labels))
+
+        return observations[2] if observations else 0
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count)) for key, (counts, total, count) in self._values.items()]
+
+        for key, (counts, total, count) in values:
+            pairs = tuple(zip(self.label_names, key))
+
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield "_bucket", pairs + (("le", format_value(bound)),), cumulative
+
+            yield "_sum", pairs, total
+            yield "_count", pairs, count
+
+
+# the metrics the /metrics endpoint exposes. Caches are registered with their stats() function, which is only
+# called when the metrics are scraped.
+class Registry:
+    def __init__(self):
+        self._metrics = []
+        self._caches = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+
+        return metric
+
+    def counter(self, name: str, documentation: str, labels=()) -> Counter:
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels=()) -> Gauge:
+        return self.register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels=(), buckets=default_buckets) -> Histogram:
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    # stats() returns a dict with (at least) hits, misses, evictions and hit_ratio
+    def register_cache(self, name: str, stats):
+        self._caches[name] = stats
+
+    def _cache_metrics(self) -> list:
+        hits = Counter("fintech_cache_hits_total", "Cache lookups answered from the cache.", ["cache"])
+        misses = Counter("fintech_cache_misses_total", "Cache lookups that had to load the value.", ["cache"])
+        evictions = Counter("fintech_cache_evictions_total", "Entries evicted from the cache.", ["cache"])
+        hit_ratio = Gauge("fintech_cache_hit_ratio", "Share of the cache lookups answered from the cache.", ["cache"])
+        size_bytes = Gauge("fintech_cache_bytes", "Bytes held by the cache.", ["cache"])
+        max_bytes = Gauge("fintech_cache_max_bytes", "Bytes the cache may hold at most.", ["cache"])
+
+        for name, stats in self._caches.items():
+            cache_stats = stats()
+
+            hits.inc(cache_stats["hits"], cache=name)
+            misses.inc(cache_stats["misses"], cache=name)
+            evictions.inc(cache_stats["evictions"], cache=name)
+            hit_ratio.set(cache_stats["hit_ratio"], cache=name)
+
+            # only the caches kept under a memory (or disk) budget know their size in bytes
+            if "bytes" in cache_stats:
+                size_bytes.set(cache_stats["bytes"], cache=name)
+
+            if "max_bytes" in cache_stats:
+                max_bytes.set(cache_stats["max_bytes"], cache=name)
+
+        return [hits, misses, evictions, hit_ratio, size_bytes, max_bytes]
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self._metrics + self._cache_metrics():
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+# the process' registry and the metrics recorded all over the app
+registry = Registry()
+
+request_duration = registry.histogram("fintech_request_duration_seconds", "Time spent handling requests.",
+                                      ["method", "route"])
+requests_total = registry.counter("fintech_requests_total", "Requests handled, by response status.",
+                                  ["method", "route", "status"])
+requests_in_progress = registry.gauge("fintech_requests_in_progress", "Requests being handled right now.",
+                                      ["method", "route"])
+
+upstream_duration = registry.histogram("fintech_upstream_duration_seconds", "Time spent on calls to yfinance.",
+                                       ["operation"])
+upstream_calls_total = registry.counter("fintech_upstream_calls_total", "Calls made to yfinance, by outcome.",
+                                        ["operation", "outcome"])
+
+upstream_circuit_open = registry.gauge("fintech_upstream_circuit_open",
+                                       "1 while the circuit breaker of an upstream operation is open.", ["operation"])
+stale_answers_total = registry.counter("fintech_stale_answers_total",
+                                       "Last known good values answered while upstream was unavailable.", ["source"])
+
+render_duration = registry.histogram("fintech_graph_render_duration_seconds",
+                                     "Time spent rendering a graph, waiting for a worker included.", ["outcome"])
+email_send_duration = registry.histogram("fintech_email_send_duration_seconds", "Time spent sending an email.",
+                                         ["outcome"])
+
+
+# wraps a call to yfinance: counts it for the request's log line and records its latency and outcome
+@contextmanager
+def upstream_call(operation: str):
+    count_upstream_call()
+    start_time = time.perf_counter()
+    outcome = "error"
+
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        upstream_duration.observe(time.perf_counter() - start_time, operation=operation)
+        upstream_calls_total.inc(operation=operation, outcome=outcome)
+
+
+# records that the request got the last known good `source` data (age seconds old) instead of fresh data
+def stale_answer(source: str, age: float):
+    mark_stale(source, age)
+    stale_answers_total.inc(source=source)
@@ -0,0 +1,148 @@
+import asyncio
+import io
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from .metrics import render_duration
+
+
+# the renderer refuses new graphs while this many are already waiting or rendering
+class RenderBusy(Exception):
+    pass
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+# runs once in every worker process, so the first graph a worker draws doesn't pay for importing matplotlib
+def warm_up():
+    import matplotlib
+    matplotlib.use("Agg")
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    FigureCanvasAgg(Figure())
+
+
+# draws a history graph in a worker process and returns the png. It uses the object-oriented API on an Agg canvas,
+# never pyplot, so there is no global figure state to share or to leak.
+# series holds one (dates, values) pair per label.
+def render_history_graph(series: list, labels: list, title: str, options: dict) -> bytes:
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    figure = Figure(figsize=options["figsize"], dpi=options["dpi"])
+    FigureCanvasAgg(figure)
+
+    axis = figure.add_subplot()
+
+    for dates, values in series:
+        axis.plot(dates, values, marker=options["marker"], mew='1')
+
+    axis.set_title(title)
+    axis.set_xlabel("Date")
+    axis.set_ylabel("Close index")
+    axis.grid()
+    axis.legend(labels, loc="upper right")
+
+    png = io.BytesIO()
+    figure.savefig(png, format="png")
+
+    return png.getvalue()
+
+
+# renders graphs on a pool of worker processes, so rendering never blocks the event loop and several graphs render on
+# several cores at the same time. At most `max_queued` graphs wait or render at once, each one gets `timeout` seconds.
+# A render that runs out of time can't be stopped inside its worker, so the whole pool is recycled: its processes are
+# terminated and a fresh pool takes over, the graphs that were rendering on the old one start again on the new one.
+class GraphRenderer:
+    def __init__(self, workers: int = 2, max_queued: int = 16, timeout: float = 30):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.timeout = timeout
+
+        self._executor = None
+        self._pending = 0
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawned, not forked: the server process has threads running and forking those is unsafe
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, initializer=warm_up,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+
+        return self._executor
+
+    # starts the worker processes up front (called at startup), instead of on the first graph
+    def start(self):
+        for _ in range(self.workers):
+            self.executor.submit(warm_up)
+
+    # renders a graph on the pool, returns the png bytes
+    async def render(self, series: list, labels: list, title: str, options: dict) -> bytes:
+        return await self.run(render_history_graph, series, labels, title, options, name=title)
+
+    # runs function(*args) on the pool within the timeout and returns what it returns
+    async def run(self, function, *args, name: str = None):
+        name = name or function.__name__
+
+        if self._pending >= self.max_queued:
+            logging.warning(f"Graph renderer is busy, {self._pending} graphs are already queued.")
+            raise RenderBusy()
+
+        self._pending += 1
+        start_time = time.perf_counter()
+        deadline = time.monotonic() + self.timeout
+        outcome = "error"
+
+        try:
+            while True:
+                executor = self.executor
+                future = executor.submit(function, *args)
+
+                try:
+                    result = await asyncio.wait_for(asyncio.wrap_future(future), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    outcome = "timeout"
+                    logging.error(f"Rendering \"{name}\" took more than {self.timeout}s.")
+
+                    # still waiting for a worker it is just dropped, a running one keeps its worker busy
+                    if not future.cancel():
+                        self._recycle(executor)
+
+                    raise RenderTimeout()
+                except BrokenProcessPool:
+                    # the pool was recycled under it by another render that timed out, it goes to the new one
+                    if executor is self._executor or time.monotonic() >= deadline:
+                        raise
+
+                    continue
+
+                outcome = "ok"
+                return result
+        finally:
+            self._pending -= 1
+            render_duration.observe(time.perf_counter() - start_time, outcome=outcome)
+
+    # terminates the processes of a pool stuck on a render and starts a new pool in its place
+    def _recycle(self, executor: ProcessPoolExecutor):
+        if executor is not self._executor:
+            return
+
+        logging.warning("Recycling the graph renderer's worker processes.")
+        self._executor = None
+
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+
+        executor.shutdown(wait=False)
+        self.start()
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
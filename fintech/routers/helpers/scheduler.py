@@ -0,0 +1,95 @@
+import logging
+import random
+import threading
+import time
+
+
+# one kind of refresh the scheduler runs for every ticker of the portfolio, every `interval` seconds
+class RefreshJob:
+    def __init__(self, name: str, refresh, interval: float):
+        self.name = name
+
+        # refresh(ticker) loads the ticker's data again, upstream
+        self.refresh = refresh
+        self.interval = interval
+
+
+# background thread that keeps the caches of the portfolio's tickers warm: right after start every job runs once for
+# every ticker (warming the caches up after a restart), then again every job.interval seconds, give or take `jitter`
+# (a share of the interval) so the tickers don't all come due at the same moment. At most `rate` refreshes run per
+# second. The tickers are asked for on every pass, so newly added tickers are picked up and deleted ones dropped.
+class RefreshScheduler:
+    def __init__(self, tickers, jobs: list, rate: float = 5, jitter: float = 0.1, tick: float = 1):
+        # tickers() -> the tickers to keep warm
+        self.tickers = tickers
+        self.jobs = jobs
+        self.rate = rate
+        self.jitter = jitter
+
+        # how long the thread sleeps when nothing is due
+        self.tick = tick
+
+        # (job name, ticker) -> time.monotonic() it is due again at
+        self._due = {}
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="refresh-scheduler", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10):
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    # runs whatever is due once, returns the number of refreshes that ran
+    def run_pending(self) -> int:
+        try:
+            tickers = list(self.tickers())
+        except Exception as e:
+            logging.warning(f"Refresh scheduler could not list the tickers: {e}")
+            return 0
+
+        # forget the tickers that are gone
+        current = set(tickers)
+        for key in [key for key in self._due if key[1] not in current]:
+            del self._due[key]
+
+        refreshes = 0
+
+        for job in self.jobs:
+            for ticker in tickers:
+                if self._stopped.is_set():
+                    return refreshes
+
+                if self._due.get((job.name, ticker), 0) > time.monotonic():
+                    continue
+
+                try:
+                    job.refresh(ticker)
+                except Exception as e:
+                    logging.warning(f"Refreshing the {job.name} of {ticker} failed: {e}")
+
+                self._due[(job.name, ticker)] = time.monotonic() + job.interval * random.uniform(1 - self.jitter,
+                                                                                                1 + self.jitter)
+                refreshes += 1
+
+                # rate limit, so a big portfolio doesn't hit upstream all at once
+                self._stopped.wait(1 / self.rate)
+
+        return refreshes
+
+    def _run(self):
+        logging.info(f"Refresh scheduler started, warming up {len(self.jobs)} jobs.")
+
+        while not self._stopped.is_set():
+            if not self.run_pending():
+                self._stopped.wait(self.tick)
@@ -0,0 +1,134 @@
+import csv
+import io
+import itertools
+import struct
+import numpy
+import orjson
+from fastapi.responses import JSONResponse, Response
+from .history import history_columns
+
+month_names = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+# "01 Jan ", "02 Jan ", ... "31 Dec ": the start of every formatted date, looked up by month * 31 + day of month
+date_prefixes = numpy.array([f"{day:02d} {month} " for month in month_names for day in range(1, 32)], dtype=object)
+
+
+# the fields of an exported history row: ticker, date, open, high, low, close, adj_close, volume
+export_fields = ("ticker", "date") + tuple(column.lower().replace(" ", "_") for column in history_columns)
+
+# media types of the history export formats
+export_media_types = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+# binary chart data: b"FTCD", the length of a json header (uint32), the header (tickers, start, end, title, points),
+# the dates as int32 days since 1970-01-01, then one float32 array of values per ticker (NaN where it has no price).
+# Everything is little-endian and every array starts at a multiple of 4 bytes, so clients can view them in place.
+chart_data_magic = b"FTCD"
+chart_data_media_type = "application/vnd.fintech.chart-data"
+
+
+# json responses serialized by orjson, which also takes NumPy arrays and scalars as they are (NaN becomes null)
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+# a response streaming the chunks of an async iterator, sending each one only once the one before it went out.
+# Starlette's StreamingResponse races the stream against a disconnect listener with asyncio.wait on bare coroutines,
+# which Python 3.11 refuses, so the iterator watches for the client going away itself (Request.is_disconnected).
+class ChunkedResponse(Response):
+    def __init__(self, chunks, status_code: int = 200, headers: dict = None, media_type: str = None):
+        self.body_iterator = chunks
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = None
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+
+        async for chunk in self.body_iterator:
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+# the dates of a DatetimeIndex (or a datetime64 array) as "%d %b %Y" strings, without calling strftime on every single
+# one: the day, month and year are worked out on the whole array and the strings are put together from lookup tables.
+# A timezone aware index is formatted in its own timezone, like strftime would.
+def format_dates(index) -> list:
+    if len(index) == 0:
+        return []
+
+    if getattr(index, "tz", None) is not None:
+        index = index.tz_localize(None)
+
+    days = numpy.asarray(index).astype("datetime64[D]")
+    months = days.astype("datetime64[M]")
+    years = months.astype("datetime64[Y]")
+
+    day_of_month = (days - months).astype(numpy.int64)
+    month_of_year = (months - years).astype(numpy.int64)
+    year = years.astype(numpy.int64) + 1970
+
+    first_year = int(year.min())
+    year_strings = numpy.array([str(number) for number in range(first_year, int(year.max()) + 1)], dtype=object)
+
+    return (date_prefixes[month_of_year * 31 + day_of_month] + year_strings[year - first_year]).tolist()
+
+
+# the header line of an export, if the format has one
+def export_header(export_format: str) -> bytes:
+    if export_format == "csv":
+        return (",".join(export_fields) + "\r\n").encode()
+
+    return b""
+
+
+# encodes a window of a ticker's stored history matrix (see HistoryStore.window) as export rows, ndjson or csv.
+# Missing values become null (ndjson) or empty (csv).
+def export_rows(ticker: str, window: numpy.ndarray, export_format: str) -> bytes:
+    dates = numpy.datetime_as_string(window[0].astype(numpy.int64).astype("datetime64[D]")).tolist()
+    columns = [numpy.where(numpy.isnan(row), None, row).tolist() for row in window[1:]]
+
+    # volume is a whole number
+    columns[-1] = [None if volume is None else int(volume) for volume in columns[-1]]
+
+    rows = zip(itertools.repeat(ticker), dates, *columns)
+
+    if export_format == "csv":
+        lines = io.StringIO()
+        csv.writer(lines).writerows(rows)
+
+        return lines.getvalue().encode()
+
+    return b"".join(orjson.dumps(dict(zip(export_fields, row))) + b"\n" for row in rows)
+
+
+# dates: datetime64 array, columns: (dates x tickers) values
+def encode_chart_data(header: dict, dates, columns) -> bytes:
+    days = numpy.asarray(dates).astype("datetime64[D]").astype("<i4")
+    values = numpy.asarray(columns, dtype="<f4").reshape(len(days), -1)
+
+    header_bytes = orjson.dumps(dict(header, points=len(days)))
+    header_bytes += b" " * (-len(header_bytes) % 4)
+
+    return b"".join([chart_data_magic, struct.pack("<I", len(header_bytes)), header_bytes, days.tobytes(),
+                     numpy.ascontiguousarray(values.T).tobytes()])
+
+
+# the other way around: returns (header, dates as datetime64[D], (dates x tickers) float32 values)
+def decode_chart_data(payload: bytes):
+    if payload[:4] != chart_data_magic:
+        raise ValueError("Not chart data.")
+
+    header_length = struct.unpack_from("<I", payload, 4)[0]
+    header = orjson.loads(payload[8:8 + header_length])
+
+    points = header["points"]
+    offset = 8 + header_length
+
+    days = numpy.frombuffer(payload, dtype="<i4", count=points, offset=offset)
+    values = numpy.frombuffer(payload, dtype="<f4", count=points * len(header["tickers"]), offset=offset + 4 * points)
+
+    return header, days.astype("datetime64[D]"), values.reshape(len(header["tickers"]), points).T
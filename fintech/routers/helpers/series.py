@@ -0,0 +1,145 @@
+import threading
+from collections import OrderedDict
+from datetime import date
+import numpy
+
+epoch = date(1970, 1, 1)
+
+# the history columns (see history.py) as the attributes of a CompactSeries holding them, in the same order
+frame_columns = {"open": "Open", "high": "High", "low": "Low", "close": "Close", "adj_close": "Adj Close",
+                 "volume": "Volume"}
+
+
+# a ticker's daily bars in as little memory as they fit: the dates as int32 days since 1970-01-01 and the prices as
+# float32 (7 significant digits, plenty for a price), every column one contiguous array and no per-bar objects. The
+# volume stays float64, volumes don't fit in float32's 24 bits. Slicing by position or by date range gives views of
+# the same arrays, nothing is copied; only to_frame() builds pandas objects.
+class CompactSeries:
+    __slots__ = ("days", "open", "high", "low", "close", "adj_close", "volume")
+
+    price_dtype = numpy.float32
+
+    def __init__(self, days: numpy.ndarray, open: numpy.ndarray, high: numpy.ndarray, low: numpy.ndarray,
+                 close: numpy.ndarray, adj_close: numpy.ndarray, volume: numpy.ndarray):
+        self.days = days
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.adj_close = adj_close
+        self.volume = volume
+
+    # from a matrix of the history store (dates row first, then the history columns), copied out of it
+    @classmethod
+    def from_matrix(cls, matrix: numpy.ndarray) -> "CompactSeries":
+        prices = [numpy.array(row, dtype=cls.price_dtype) for row in matrix[1:6]]
+
+        return cls(numpy.array(matrix[0], dtype=numpy.int32), *prices, numpy.array(matrix[6], dtype=numpy.float64))
+
+    @classmethod
+    def empty(cls) -> "CompactSeries":
+        return cls.from_matrix(numpy.empty((len(frame_columns) + 1, 0)))
+
+    def __len__(self) -> int:
+        return len(self.days)
+
+    # the bars at these positions (a slice, series[-5:] are the last 5 bars)
+    def __getitem__(self, positions: slice) -> "CompactSeries":
+        return CompactSeries(*(getattr(self, attribute)[positions] for attribute in self.__slots__))
+
+    # the bars of [start, end), found by binary search on the dates
+    def between(self, start: date, end: date) -> "CompactSeries":
+        first, last = numpy.searchsorted(self.days, [(start - epoch).days, (end - epoch).days], side="left")
+
+        return self[first:last]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, attribute).nbytes for attribute in self.__slots__)
+
+    def dates(self) -> numpy.ndarray:
+        return self.days.astype("datetime64[D]")
+
+    # the bars as a DataFrame with the history columns, indexed by date, for the code that needs pandas
+    def to_frame(self) -> "pandas.DataFrame":
+        import pandas
+
+        return pandas.DataFrame({column: getattr(self, attribute) for attribute, column in frame_columns.items()},
+                                index=pandas.DatetimeIndex(self.dates(), name="Date"))
+
+
+# the compact series of the tickers' histories, held under a memory budget: adding one evicts the least recently used
+# ones until everything fits in max_bytes (a series bigger than the whole budget isn't kept). Every entry remembers the
+# version of the stored history it was made from and is only answered for that version, so a history another worker
+# (or thread) topped up in the meantime is read again.
+class SeriesCache:
+    def __init__(self, max_bytes: int, name: str = "series"):
+        self.max_bytes = max_bytes
+        self.name = name
+
+        # key -> (version, series), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        # counters, read them through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def put(self, key, version, series: CompactSeries):
+        size = series.nbytes
+
+        with self._lock:
+            self._discard(key)
+
+            if size > self.max_bytes:
+                return
+
+            while self._bytes + size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+
+            self._entries[key] = (version, series)
+            self._bytes += size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+
+            return {
+                "name": self.name,
+                "size": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / requests if requests else 0.0,
+            }
+
+    # needs self._lock to be held
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._bytes -= entry[1].nbytes
@@ -0,0 +1,113 @@
+import os
+import threading
+
+# where the secrets (email account...) are kept, relative to the fintech directory the app runs from
+env_file = "../bin/.env"
+
+# prefix of the environment variables that override the .env file, FINTECH_MAIL overrides MAIL for example
+environment_prefix = "FINTECH_"
+
+
+# the app's settings, read from the .env file once, on first use, so importing the app never touches the file (or
+# fails because it is missing). Environment variables win over the file, so every worker of a deployment can be
+# configured without one.
+class Settings:
+    def __init__(self, env_file: str, environment_prefix: str = environment_prefix):
+        self.env_file = env_file
+        self.environment_prefix = environment_prefix
+
+        self._values = None
+        self._lock = threading.Lock()
+
+    def values(self) -> dict:
+        if self._values is None:
+            with self._lock:
+                if self._values is None:
+                    self._values = self._read()
+
+        return self._values
+
+    def get(self, name: str, default=None):
+        return self.values().get(name, default)
+
+    # a setting that has to be there, raises a RuntimeError naming it otherwise
+    def require(self, name: str) -> str:
+        value = self.get(name)
+
+        if value is None:
+            raise RuntimeError(f"{name} is not set, neither in {self.env_file} nor as {self.environment_prefix}{name}.")
+
+        return value
+
+    def flag(self, name: str, default: bool = False) -> bool:
+        value = self.get(name)
+
+        if value is None:
+            return default
+
+        return value.strip().lower() in ("1", "true", "yes", "on")
+
+    # forgets what was read, the next get() reads everything again
+    def reload(self):
+        with self._lock:
+            self._values = None
+
+    def _read(self) -> dict:
+        # python-dotenv is only needed for this
+        from dotenv import dotenv_values
+
+        values = {name: value for name, value in dotenv_values(self.env_file).items() if value is not None}
+
+        for name, value in os.environ.items():
+            if name.startswith(self.environment_prefix):
+                values[name[len(self.environment_prefix):]] = value
+
+        return values
+
+    # the email account the graphs are sent from, and its SMTP server: gmail unless the settings say otherwise
+    # (SMTP_SSL=false for a plain local server)
+    @property
+    def mail_sender(self) -> str:
+        return self.require("MAIL")
+
+    @property
+    def mail_password(self) -> str:
+        return self.require("PASS")
+
+    @property
+    def smtp_host(self) -> str:
+        return self.get("SMTP_HOST", "smtp.gmail.com")
+
+    @property
+    def smtp_port(self):
+        return self.get("SMTP_PORT")
+
+    @property
+    def smtp_ssl(self) -> bool:
+        return self.flag("SMTP_SSL", True)
+
+    # FAST_STARTUP=true skips the warm-up at startup: the heavy libraries are then imported by the first request
+    # that needs them
+    @property
+    def fast_startup(self) -> bool:
+        return self.flag("FAST_STARTUP", False)
+
+    # MARKET_DATA_URL switches the market data from yfinance to the pooled HTTP client, against that URL: a stand-in
+    # for Yahoo Finance's API or a proxy to it that needs no authentication (the client doesn't get Yahoo's cookie and
+    # crumb), with at most MARKET_DATA_CONNECTIONS connections and HTTP/2 unless MARKET_DATA_HTTP2=false
+    @property
+    def market_data_url(self):
+        return self.get("MARKET_DATA_URL")
+
+    @property
+    def market_data_connections(self):
+        value = self.get("MARKET_DATA_CONNECTIONS")
+
+        return int(value) if value else None
+
+    @property
+    def market_data_http2(self) -> bool:
+        return self.flag("MARKET_DATA_HTTP2", True)
+
+
+settings = Settings(env_file)
@@ -0,0 +1,62 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# key/value store in an SQLite database, shared by every process that opens the same file (the uvicorn workers), so
+# what one of them fetched upstream the others can reuse. The database runs in WAL mode: readers never wait for the
+# writer and a writer only waits for another writer (up to `timeout` seconds). Values are stored as json, along with
+# the (wall clock) time they were stored at.
+class SharedStore:
+    def __init__(self, path: str, table: str = "entries", timeout: float = 5):
+        self.path = path
+        self.table = table
+        self.timeout = timeout
+
+        # sqlite connections can't be shared between threads, every thread opens its own
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+
+        if connection is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                               f"(key TEXT PRIMARY KEY, stored_at REAL NOT NULL, value TEXT NOT NULL)")
+
+            self._local.connection = connection
+
+        return connection
+
+    # returns (time.time() it was stored at, value) or None
+    def get(self, key):
+        row = self._connection().execute(f"SELECT stored_at, value FROM {self.table} WHERE key = ?",
+                                         (str(key),)).fetchone()
+
+        if row is None:
+            return None
+
+        return row[0], json.loads(row[1])
+
+    def put(self, key, value, stored_at: float = None):
+        self._connection().execute(f"INSERT OR REPLACE INTO {self.table} (key, stored_at, value) VALUES (?, ?, ?)",
+                                   (str(key), stored_at or time.time(), json.dumps(value, default=str)))
+
+    def delete(self, key):
+        self._connection().execute(f"DELETE FROM {self.table} WHERE key = ?", (str(key),))
+
+    def clear(self):
+        self._connection().execute(f"DELETE FROM {self.table}")
+
+    def close(self):
+        connection = getattr(self._local, "connection", None)
+
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
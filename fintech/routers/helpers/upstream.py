@@ -0,0 +1,374 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
+from .history import history_columns
+from .metrics import upstream_call, upstream_circuit_open
+
+# how many requests a second we make to the market data provider on average, and how many we may make in a burst
+upstream_rate = 5
+upstream_burst = 10
+
+# how long (seconds) a history fetch waits for others over the same range to join it in one download, and how many
+# tickers one download asks for at most
+upstream_batch_window = 0.05
+upstream_batch_size = 50
+
+# how long (seconds) we wait for an upstream call of each kind before giving up on it, and how many calls may be
+# running (or stuck) at the same time
+upstream_deadlines = {"info": 10, "dividends": 10, "history": 20}
+upstream_workers = 32
+
+# the circuit of an operation opens after this many failed or timed out calls in a row; while it is open the calls
+# fail right away, after reset_timeout seconds one call is let through to probe whether upstream is back
+upstream_failure_threshold = 5
+upstream_reset_timeout = 30
+
+
+# upstream can't answer right now: the call timed out or its circuit is open. The caches answer their last known
+# good values instead (see TTLCache and HistoryStore's fallback_on), the routes that have none answer 503.
+# Calls that failed upstream count as unavailable too, see UpstreamError.
+class UpstreamUnavailable(Exception):
+    # seconds after which it makes sense to try again
+    retry_after = upstream_reset_timeout
+
+
+class UpstreamTimeout(UpstreamUnavailable):
+    pass
+
+
+# the provider failed the call, the original error is its __cause__
+class UpstreamError(UpstreamUnavailable):
+    pass
+
+
+class CircuitOpen(UpstreamUnavailable):
+    pass
+
+
+# the market data provider behind the gateway, yfinance. A stand-in (a stub in the tests, the synthetic market of the
+# benchmarks) only needs the same three methods.
+class YFinanceProvider:
+    # the ticker's .info metadata
+    def info(self, ticker: str) -> dict:
+        import yfinance
+
+        return yfinance.Ticker(ticker).info
+
+    # the ticker's dividends, a Series indexed by date
+    def dividends(self, ticker: str):
+        import yfinance
+
+        return yfinance.Ticker(ticker).dividends
+
+    # the daily bars of the tickers for [start, end) in one call, the columns being (column, ticker) pairs
+    def download(self, tickers: list, start, end, interval: str = "1d"):
+        import pandas
+        import yfinance
+
+        frame = yfinance.download(tickers, start=start, end=end, interval=interval, auto_adjust=False, actions=False,
+                                  group_by="column", progress=False, threads=False)
+
+        # older yfinance versions answer a single ticker with plain columns
+        if not isinstance(frame.columns, pandas.MultiIndex):
+            frame.columns = pandas.MultiIndex.from_product([frame.columns, tickers])
+
+        return frame
+
+
+# token bucket: holds up to `capacity` tokens and gets `rate` new ones every second. acquire() takes tokens, waiting
+# for them when the bucket is empty, so the calls never go faster than `rate` a second on average.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    # returns the seconds we waited
+    def acquire(self, tokens: float = 1) -> float:
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+
+                # a request for more than the bucket holds goes through once the bucket is full
+                if self._tokens >= min(tokens, self.capacity):
+                    self._tokens -= tokens
+                    return waited
+
+                wait = (min(tokens, self.capacity) - self._tokens) / self.rate
+
+            time.sleep(wait)
+            waited += wait
+
+
+# circuit breaker of one kind of upstream call. Closed, calls go through; after failure_threshold failures in a row it
+# opens and calls fail right away with CircuitOpen; reset_timeout seconds later it is half open: a single call probes
+# upstream, closing the circuit again when it succeeds and opening it for another reset_timeout when it fails.
+class CircuitBreaker:
+    def __init__(self, operation: str, failure_threshold: int = upstream_failure_threshold,
+                 reset_timeout: float = upstream_reset_timeout):
+        self.operation = operation
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = "closed"
+        self.failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    # raises CircuitOpen when the call may not go upstream
+    def before_call(self):
+        with self._lock:
+            if self.state == "closed":
+                return
+
+            if self.state == "open" and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = "half-open"
+
+            if self.state == "half-open" and not self._probing:
+                self._probing = True
+                return
+
+            error = CircuitOpen(f"The upstream {self.operation} circuit is open.")
+            error.retry_after = max(1, int(self._opened_at + self.reset_timeout - time.monotonic()))
+            raise error
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logging.info(f"Upstream {self.operation} calls work again, closing the circuit.")
+                upstream_circuit_open.set(0, operation=self.operation)
+
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state == "half-open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logging.warning(f"Upstream {self.operation} calls failed {self.failures} times in a row, "
+                                    f"opening the circuit for {self.reset_timeout}s.")
+
+                self.state = "open"
+                self._opened_at = time.monotonic()
+                self._probing = False
+                upstream_circuit_open.set(1, operation=self.operation)
+
+
+# history fetches of the same range waiting to go upstream in one download: ticker -> Future of its frame
+class _Batch:
+    def __init__(self):
+        self.futures = {}
+        self.closed = threading.Event()
+
+
+# the one way market data is fetched. Identical calls made while one is in flight wait for that one instead of going
+# upstream again, history fetches of several tickers over the same range made within `batch_window` seconds are sent
+# as one download, and every request to the provider takes a token from the bucket first.
+# Every call gets the deadline of its kind: it runs on the gateway's own threads and the caller stops waiting for it
+# after that many seconds (UpstreamTimeout). Calls of a kind whose circuit is open fail right away (CircuitOpen).
+class UpstreamGateway:
+    def __init__(self, provider, rate: float = upstream_rate, burst: float = upstream_burst,
+                 batch_window: float = upstream_batch_window, batch_size: int = upstream_batch_size,
+                 deadlines: dict = None, workers: int = upstream_workers,
+                 failure_threshold: int = upstream_failure_threshold, reset_timeout: float = upstream_reset_timeout):
+        self.provider = provider
+        self.bucket = TokenBucket(rate, burst)
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.deadlines = dict(upstream_deadlines, **(deadlines or {}))
+        self.workers = workers
+
+        self.breakers = {operation: CircuitBreaker(operation, failure_threshold, reset_timeout)
+                         for operation in self.deadlines}
+
+        # created on the first call, so importing the gateway doesn't start any thread
+        self._executor = None
+
+        # counters, read them through stats()
+        self.calls = 0
+        self.coalesced = 0
+        self.batched = 0
+        self.throttled_seconds = 0.0
+        self.timeouts = 0
+        self.rejected = 0
+
+        # key of a call -> Future of its result
+        self._in_flight = {}
+
+        # (start, end, interval) -> the _Batch still accepting tickers
+        self._batches = {}
+        self._lock = threading.Lock()
+
+    def info(self, ticker: str) -> dict:
+        return self._coalesced(("info", ticker), lambda: self._call("info", self.provider.info, ticker))
+
+    def dividends(self, ticker: str):
+        return self._coalesced(("dividends", ticker), lambda: self._call("dividends", self.provider.dividends, ticker))
+
+    # the daily bars of one ticker for [start, end), with the history_columns, indexed by date
+    def history(self, ticker: str, start, end, interval: str = "1d"):
+        return self._coalesced(("history", ticker, start, end, interval),
+                               lambda: self._batched(ticker, start, end, interval))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "coalesced": self.coalesced,
+                "batched": self.batched,
+                "throttled_seconds": self.throttled_seconds,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "in_flight": len(self._in_flight),
+                "circuits": {operation: breaker.state for operation, breaker in self.breakers.items()},
+            }
+
+    # the first caller of a key runs call(), the ones arriving while it runs get its result (or its error)
+    def _coalesced(self, key, call):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+
+            if leader:
+                future = self._in_flight[key] = Future()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            result = call()
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    # one request to the provider: checks the circuit, waits for a token, then runs it within its deadline, counted
+    # and timed like every upstream call
+    def _call(self, operation: str, function, *args, tokens: float = 1):
+        breaker = self.breakers[operation]
+
+        try:
+            breaker.before_call()
+        except CircuitOpen:
+            with self._lock:
+                self.rejected += 1
+            raise
+
+        waited = self.bucket.acquire(tokens)
+
+        with self._lock:
+            self.calls += 1
+            self.throttled_seconds += waited
+
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="upstream")
+
+        if waited:
+            logging.info(f"Waited {waited:.2f}s for the upstream rate limit before a {operation} call.")
+
+        deadline = self.deadlines[operation]
+
+        try:
+            with upstream_call(operation):
+                # a call that doesn't make it stays on its thread until the library gives up, but nobody waits for it
+                try:
+                    result = self._executor.submit(function, *args).result(timeout=deadline)
+                except FutureTimeout:
+                    with self._lock:
+                        self.timeouts += 1
+
+                    raise UpstreamTimeout(f"The upstream {operation} call took more than {deadline}s.")
+        except UpstreamTimeout:
+            breaker.record_failure()
+            raise
+        except Exception as e:
+            breaker.record_failure()
+            raise UpstreamError(f"The upstream {operation} call failed: {e}") from e
+
+        breaker.record_success()
+
+        return result
+
+    # joins (or opens) the batch of the range; whoever opened it waits for the others and then sends it
+    def _batched(self, ticker: str, start, end, interval: str):
+        key = (start, end, interval)
+
+        with self._lock:
+            batch = self._batches.get(key)
+            leader = batch is None
+
+            if leader:
+                batch = self._batches[key] = _Batch()
+            else:
+                self.batched += 1
+
+            future = batch.futures[ticker] = Future()
+
+            # a full batch doesn't take anyone else
+            if len(batch.futures) >= self.batch_size:
+                self._close(key, batch)
+
+        if leader:
+            # sent as soon as it is full, or once the window is over
+            batch.closed.wait(self.batch_window)
+
+            with self._lock:
+                self._close(key, batch)
+
+            self._send(batch, start, end, interval)
+
+        return future.result()
+
+    # needs self._lock to be held
+    def _close(self, key, batch: _Batch):
+        batch.closed.set()
+
+        if self._batches.get(key) is batch:
+            del self._batches[key]
+
+    def _send(self, batch: _Batch, start, end, interval: str):
+        import pandas
+
+        tickers = list(batch.futures)
+
+        try:
+            # yfinance still requests every ticker of a download on its own, so each of them takes a token
+            frame = self._call("history", self.provider.download, tickers, start, end, interval, tokens=len(tickers))
+        except Exception as e:
+            for future in batch.futures.values():
+                future.set_exception(e)
+            return
+
+        present = set(frame.columns.get_level_values(1)) if len(frame.columns) else set()
+
+        for ticker, future in batch.futures.items():
+            if ticker in present:
+                # the download lines the tickers' dates up, the days a ticker has no bar are left out again
+                history = frame.xs(ticker, axis=1, level=1).dropna(how="all")
+            else:
+                history = pandas.DataFrame(columns=list(history_columns),
+                                           index=pandas.DatetimeIndex([], name="Date"), dtype=float)
+
+            future.set_result(history)
+
+
+gateway = UpstreamGateway(YFinanceProvider())
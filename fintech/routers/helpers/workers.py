@@ -0,0 +1,71 @@
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+
+# wraps a function so it runs in a copy of the caller's context (the request's log fields and counters) on whatever
+# thread it ends up on; executors don't carry the context over by themselves
+def in_context(function, *args):
+    return functools.partial(contextvars.copy_context().run, function, *args)
+
+
+# raised (well, reported) for a key whose fetch took longer than the pool's timeout
+class FetchTimeout(Exception):
+    pass
+
+
+# bounded pool of threads for the blocking upstream calls (yfinance) that async routes have to make, so they run
+# concurrently and off the event loop. At most `max_workers` calls run at the same time and every call gets `timeout`
+# seconds before it is reported as timed out.
+class WorkerPool:
+    def __init__(self, max_workers: int = 16, timeout: float = 10, name: str = "workers"):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.name = name
+        self._executor = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # created on first use, so importing the routers doesn't start any thread
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+
+        return self._executor
+
+    # runs a single blocking call on the pool and waits for it, without the timeout handling of map()
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+
+        return await loop.run_in_executor(self.executor, in_context(function, *args))
+
+    # calls fetch(key) for every key on the pool and yields (key, value, error) tuples in the order they complete.
+    # A failing or timing out key never fails the others: its error is yielded instead of a value.
+    async def map(self, fetch, keys):
+        loop = asyncio.get_running_loop()
+
+        # no more pending calls than the pool has threads, so the timeout only counts the time spent running
+        slots = asyncio.Semaphore(self.max_workers)
+
+        async def fetch_one(key):
+            async with slots:
+                try:
+                    value = await asyncio.wait_for(loop.run_in_executor(self.executor, in_context(fetch, key)),
+                                                   self.timeout)
+                except asyncio.TimeoutError:
+                    logging.warning(f"Fetching {key} took more than {self.timeout}s, giving up on it.")
+                    return key, None, FetchTimeout(key)
+                except Exception as e:
+                    logging.error(f"Fetching {key} failed: {e}")
+                    return key, None, e
+
+            return key, value, None
+
+        for next_result in asyncio.as_completed([fetch_one(key) for key in keys]):
+            yield await next_result
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
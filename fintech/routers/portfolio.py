@@ -1,85 +1,137 @@
-from .helpers.input import input_file
+from .helpers.input import input_file, metadata_cache, metadata_pool, portfolio_index, history_store, history_today_ttl
+from .helpers.workers import FetchTimeout, in_context
+from .helpers.helpers import TickerHistory
+from .helpers.analytics import portfolio_analytics
+from .helpers.cache import TTLCache
+from .helpers.metrics import registry
 from fastapi import APIRouter
-import yfinance
+from starlette.concurrency import run_in_threadpool
+from datetime import date
 import urllib.parse
-from fastapi.responses import JSONResponse
+from .helpers.serialization import FastJSONResponse
 import logging
 
 # setup fastAPI router and tickers portfolio input file
 router = APIRouter(prefix="/fintech/portfolio")
 
 
+# key: (tickers, start date, end date, risk free rate, daily returns wanted)
+def compute_analytics(key) -> dict:
+    tickers, start, end, risk_free_rate, daily_returns = key
+    history = TickerHistory(list(tickers), start.isoformat(), end.isoformat(), history_store)
+
+    return portfolio_analytics(history.history_details, risk_free_rate, daily_returns)
+
+
+# analytics are memoized per ticker set and date range, for as long as the history's bar of today is reused
+analytics_cache_size = 64
+analytics_cache = TTLCache(compute_analytics, ttl=history_today_ttl, max_size=analytics_cache_size, name="analytics")
+registry.register_cache("analytics", analytics_cache.stats)
+
+
 # GET endpoint that returns the portfolio (all available tickers)
-# The tickers can be filtered by: greater than a market cap, region (country), exchange, sector
+# The tickers can be filtered by: greater than a market cap, region (country), exchange, sector, sorted by market cap
+# ("market_cap" or "-market_cap" for descending) and paginated with offset/limit.
+# Filters are answered by the portfolio index; only tickers that aren't indexed yet get their metadata fetched
+# (concurrently, on the metadata worker pool). Tickers whose metadata could not be fetched in time (or at all) are left
+# out and listed in the X-Tickers-Timed-Out / X-Tickers-Failed headers. X-Total-Count holds the number of matches.
 @router.get("/tickers", tags=["Portfolio"])
 async def get_all_tickers(market_cap_min: float = None, market_cap_max: float = None,
                           country: str = None,
                           exchange: str = None,
-                          sector: str = None):
+                          sector: str = None,
+                          sort: str = None,
+                          offset: int = 0,
+                          limit: int = None):
+
+    if sort not in (None, "market_cap", "-market_cap"):
+        return FastJSONResponse(status_code=400, content="Tickers can only be sorted by market_cap or -market_cap.")
 
-    input_file.read()
+    if offset < 0 or (limit is not None and limit < 0):
+        return FastJSONResponse(status_code=400, content="Offset and limit can't be negative.")
 
-    file_lines = input_file.lines
+    tickers = input_file.tickers()
 
-    # here we will store every existent ticker that fits all filters
-    tickers_list = []
+    # no filters and no sorting, no need to know anything about the tickers
+    if not any([market_cap_min, market_cap_max, country, exchange, sector, sort]):
+        end = None if limit is None else offset + limit
+        response = FastJSONResponse(content=tickers[offset:end])
+        response.headers["X-Total-Count"] = str(len(tickers))
 
-    # taking each line content one by one, having each ticker
-    for ticker in file_lines:
-        # readlines() includes a \n in the end of each ticker, so we format to not have it anymore
-        ticker = ticker.rstrip()
-        ticker_info = yfinance.Ticker(ticker).info
+        return response
 
-        # check to see if actual ticker fits the filters
+    if country:
+        country = urllib.parse.unquote(country).removesuffix(" ")
 
-        # country filter (also  check if the ticker returned has the queried field in its structure, using .get)
-        if country:
-            country = urllib.parse.unquote(country)
-            country = country.removesuffix(" ")
+    if sector:
+        sector = urllib.parse.unquote(sector).removesuffix(" ")
 
-            if ticker_info.get("country") != country:
-                continue
+    if exchange:
+        # exchanges are all uppercase, so we may accept that the user is lazy and writes it lower
+        exchange = urllib.parse.unquote(exchange).removesuffix(" ").upper()
 
-        # sector filter
-        if sector and ticker_info.get("sector"):
-            sector = urllib.parse.unquote(sector)
-            sector = sector.removesuffix(" ")
+    timed_out = []
+    failed = []
+    positions = {ticker: position for position, ticker in enumerate(tickers)}
 
-            if ticker_info.get("sector") != sector:
-                continue
+    # the index only knows what this worker saw, another one may have deleted (or moved) tickers since
+    portfolio_index.retain(tickers)
 
-        if ticker_info.get("marketCap"):
-            market_cap = ticker_info["marketCap"]
-            # market cap filter
-            if market_cap_min:
-                if market_cap < market_cap_min:
-                    continue
+    # index the tickers we don't know about yet as soon as their metadata arrives
+    async for ticker, ticker_info, error in metadata_pool.map(metadata_cache.get, portfolio_index.missing(tickers)):
+        if isinstance(error, FetchTimeout):
+            timed_out.append(ticker)
+        elif error is not None:
+            failed.append(ticker)
+        else:
+            portfolio_index.update(ticker, ticker_info, positions[ticker])
 
-                if market_cap_max:
-                    # we're interested for in between values and we already know the minimum is fine
-                    if market_cap > market_cap_max:
-                        continue
+    total, tickers_list = portfolio_index.query(market_cap_min, market_cap_max, country, exchange, sector,
+                                                sort, offset, limit)
 
-            if market_cap_max:
-                # at this point we know there is no minimum requirement so we are only interested about max
-                if market_cap > market_cap_max:
-                    continue
+    response = FastJSONResponse(content=tickers_list)
+    response.headers["X-Total-Count"] = str(total)
 
-        # exchange filter
-        if exchange and ticker_info.get("exchange"):
-            exchange = urllib.parse.unquote(exchange)
-            exchange = exchange.removesuffix(" ")
+    if timed_out:
+        response.headers["X-Tickers-Timed-Out"] = ",".join(sorted(timed_out))
 
-            # exchanges are all uppercase, so we may accept that the user is lazy and writes it lower
-            exchange = exchange.upper()
+    if failed:
+        response.headers["X-Tickers-Failed"] = ",".join(sorted(failed))
+
+    return response
 
-            if ticker_info.get("exchange") != exchange:
-                continue
 
-        # finally, add the ticker if it passed all the filters
-        tickers_list.append(ticker)
+# GET endpoint for analytics of the saved tickers (all of them, or the ones given) between two dates, end excluded:
+# cumulative and mean daily return, annualized volatility, max drawdown, Sharpe ratio (against risk_free_rate) and
+# dividend yield per ticker, plus the correlation matrix of their daily returns. daily_returns=true adds the daily
+# returns themselves. See analytics.py.
+@router.get("/analytics", tags=["Portfolio"])
+async def get_analytics(start: str, end: str = None, tickers: str = None, risk_free_rate: float = 0.0,
+                        daily_returns: bool = False):
+    if tickers:
+        ticker_list = list(dict.fromkeys(urllib.parse.unquote(tickers).upper().replace(",", " ").split()))
+        not_saved = [ticker for ticker in ticker_list if not input_file.check_ticker(ticker)]
 
-    return JSONResponse(content=tickers_list)
+        if not_saved:
+            return FastJSONResponse(status_code=404,
+                                    content=f"Tickers not found in the portfolio: {' '.join(not_saved)}")
+    else:
+        ticker_list = input_file.tickers()
+
+    if not ticker_list:
+        return FastJSONResponse(status_code=400, content="There are no tickers to analyse.")
+
+    if end is None:
+        end = date.today().isoformat()
+
+    # validates the dates
+    history = TickerHistory(sorted(ticker_list), start, end, history_store)
+
+    key = (tuple(history.ticker_list), history.start_date, history.end_date, risk_free_rate, daily_returns)
+    analytics = await run_in_threadpool(in_context(analytics_cache.get, key))
+
+    return FastJSONResponse(content=dict(analytics, start=history.start_date.isoformat(),
+                                         end=history.end_date.isoformat()))
 
 
 # POST api endpoint for saving a ticker into the portfolio
@@ -88,17 +140,20 @@ async def add_ticker(ticker: str):
     # make sure that every ticker we add is all in uppercase, for consequence
     ticker = ticker.upper()
 
-    ticker_info = yfinance.Ticker(ticker).info
+    ticker_info = await metadata_pool.run(metadata_cache.get, ticker)
 
     # check if the ticker is valid
     try:
         ticker_info['marketCap']
     except KeyError:
         logging.error(f"Attempt of adding {ticker} failed: Invalid ticker")
-        return JSONResponse(status_code=403, content="Invalid ticker")
+        return FastJSONResponse(status_code=403, content="Invalid ticker")
 
     response = input_file.add(ticker)
 
+    if response.status_code == 200:
+        portfolio_index.update(ticker, ticker_info)
+
     return response
 
 
@@ -109,4 +164,8 @@ async def delete_ticker(ticker: str):
 
     response = input_file.delete(ticker)
 
+    # the ticker is gone from the portfolio, so we don't keep its metadata around either
+    metadata_cache.invalidate(ticker)
+    portfolio_index.remove(ticker)
+
     return response
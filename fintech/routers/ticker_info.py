@@ -1,91 +1,192 @@
-from .helpers.input import input_file
+from .helpers.input import input_file, history_store, metadata_cache, metadata_pool
+from .helpers.history import period_range
+from .helpers.serialization import FastJSONResponse, format_dates
+from .helpers.workers import FetchTimeout, in_context
+from .helpers.conditional import conditional, make_etag, day_start, dividends_max_age, metadata_max_age, \
+    open_history_max_age
 import logging
-from fastapi import APIRouter
-from fastapi.responses import JSONResponse
+import urllib.parse
+import numpy
+from fastapi import APIRouter, Request
+from starlette.concurrency import run_in_threadpool
 
 # setup fastAPI router and tickers portfolio input file
 router = APIRouter(prefix="/fintech/ticker")
 
+# the .info keys behind the single field routes, so the batch endpoint accepts the same names
+info_fields = {
+    "price-to-earnings": "forwardPE",
+    "market-cap": "marketCap",
+    "last-dividend-value": "lastDividendValue",
+}
+
+# shapes the date series routes answer in: {date: value} or one list per column
+response_layouts = ("map", "columns")
+
+# most tickers a single batch request may ask for
+batch_max_tickers = 200
+
+
+# answers a live metadata value, with an ETag of the value itself (a 304 when the client has it already)
+def metadata_response(request: Request, value):
+    headers, not_modified = conditional(request, make_etag("metadata", value), max_age=metadata_max_age)
+
+    return not_modified or FastJSONResponse(content=value, headers=headers)
+
+
+# GET endpoint for several fields of several saved tickers in one go, e.g.
+# /fintech/ticker/batch?tickers=TSLA,AAPL&fields=price-to-earnings,market-cap,dividendYield
+# Fields are the names of the single field routes or any .info key, all three single field routes by default. The
+# answer maps every ticker to its fields, a field the ticker doesn't have is null. Tickers whose metadata could not be
+# fetched in time (or at all) map to null and are listed in the X-Tickers-Timed-Out / X-Tickers-Failed headers, such a
+# partial answer is not to be cached.
+@router.get("/batch", tags=["Ticker info"])
+async def get_batch(request: Request, tickers: str, fields: str = None):
+    # comma or space separated, every ticker once, in the order given
+    tickers = urllib.parse.unquote(tickers).upper().replace(",", " ").split()
+    tickers = list(dict.fromkeys(tickers))
+
+    fields = urllib.parse.unquote(fields).replace(",", " ").split() if fields else list(info_fields)
+
+    if not tickers or not fields:
+        return FastJSONResponse(status_code=400, content="Give at least one ticker and one field.")
+
+    if len(tickers) > batch_max_tickers:
+        return FastJSONResponse(status_code=400, content=f"At most {batch_max_tickers} tickers can be asked at once.")
+
+    not_saved = [ticker for ticker in tickers if not input_file.check_ticker(ticker)]
+
+    if not_saved:
+        logging.error(f"Batch request for tickers that are not in the portfolio: {not_saved}")
+        return FastJSONResponse(status_code=404, content=f"Tickers not found in the portfolio: {' '.join(not_saved)}")
+
+    batch = dict.fromkeys(tickers)
+    timed_out = []
+    failed = []
+
+    async for ticker, ticker_info, error in metadata_pool.map(metadata_cache.get, tickers):
+        if isinstance(error, FetchTimeout):
+            timed_out.append(ticker)
+        elif error is not None:
+            failed.append(ticker)
+        else:
+            batch[ticker] = {field: ticker_info.get(info_fields.get(field, field)) for field in fields}
+
+    if timed_out or failed:
+        headers = {"Cache-Control": "no-store"}
+
+        if timed_out:
+            headers["X-Tickers-Timed-Out"] = ",".join(sorted(timed_out))
+
+        if failed:
+            headers["X-Tickers-Failed"] = ",".join(sorted(failed))
+
+        return FastJSONResponse(content=batch, headers=headers)
+
+    # the ETag is a hash of the batch itself, a client that has it already gets its 304 without serializing anything
+    headers, not_modified = conditional(request, make_etag("batch", batch), max_age=metadata_max_age)
+
+    return not_modified or FastJSONResponse(content=batch, headers=headers)
+
 
 # GET endpoint for checking price to earnings
+# (the single field routes load the metadata on the metadata pool: a cache miss goes upstream, off the event loop)
 @router.get("/{ticker}/price-to-earnings", tags=["Ticker info"])
-async def get_forward_pe(ticker: str):
-    ticker_object = input_file.ticker_object(ticker)
-    ticker_info = ticker_object.info
-    forward_pe = ticker_info["forwardPE"]
+async def get_forward_pe(request: Request, ticker: str):
+    ticker_info = await metadata_pool.run(input_file.ticker_info, ticker)
+    forward_pe = ticker_info.get("forwardPE")
 
-    return JSONResponse(content=forward_pe)
+    return metadata_response(request, forward_pe)
 
 
 # GET endpoint for market cap
 @router.get("/{ticker}/market-cap", tags=["Ticker info"])
-async def get_market_cap(ticker: str):
-    ticker_object = input_file.ticker_object(ticker)
-    ticker_info = ticker_object.info
-    market_cap = ticker_info["marketCap"]
+async def get_market_cap(request: Request, ticker: str):
+    ticker_info = await metadata_pool.run(input_file.ticker_info, ticker)
+    market_cap = ticker_info.get("marketCap")
 
-    return JSONResponse(content=market_cap)
+    return metadata_response(request, market_cap)
 
 
 # GET endpoint for last dividend value
 @router.get("/{ticker}/last-dividend-value", tags=["Ticker info"])
-async def get_last_dividend_value(ticker: str):
-    ticker_object = input_file.ticker_object(ticker)
-    ticker_info = ticker_object.info
-    dividends_value = ticker_info["lastDividendValue"]
+async def get_last_dividend_value(request: Request, ticker: str):
+    ticker_info = await metadata_pool.run(input_file.ticker_info, ticker)
+    dividends_value = ticker_info.get("lastDividendValue")
 
-    return JSONResponse(content=dividends_value)
+    return metadata_response(request, dividends_value)
 
 
 # GET endpoint for dividends evolution of a ticker
+# layout "map" (default) answers {date: dividend}, layout "columns" answers {"dates": [...], "dividends": [...]}
 @router.get("/{ticker}/dividends", tags=["Ticker info"])
-async def get_historical_dividends(ticker: str):
-    ticker_object = input_file.ticker_object(ticker)
-    ticker_dividends = ticker_object.dividends
+async def get_historical_dividends(request: Request, ticker: str, layout: str = "map"):
+    if layout not in response_layouts:
+        return FastJSONResponse(status_code=400, content=f"The layout can only be one of {response_layouts}.")
+
+    # checked here, a 404 doesn't need a thread
+    input_file.check_saved(ticker.upper())
+
+    ticker_dividends = await metadata_pool.run(input_file.ticker_dividends, ticker)
 
-    # from pandas.core.series.Series to dict
-    ticker_dividends = ticker_dividends.to_dict()
+    # they only change on a new dividend, which is when they were last modified. A ticker that never paid any gets an
+    # empty series with a plain RangeIndex, not dates.
+    last_modified = day_start(ticker_dividends.index[-1].date()) if len(ticker_dividends) else None
+    headers, not_modified = conditional(request, make_etag("dividends", layout, numpy.asarray(ticker_dividends.index),
+                                                           ticker_dividends.to_numpy()),
+                                        last_modified, dividends_max_age)
 
-    # dict keys in a json can't be of type Timestamp so we have to make a new one, with string keys
-    dividends_map = {}
-    timestamp_list = list(ticker_dividends.keys())
+    if not_modified:
+        return not_modified
 
-    for timestamp in timestamp_list:
-        # timestamp object to string
-        timestamp_string = timestamp.to_pydatetime()
-        timestamp_string = timestamp_string.strftime("%d %b %Y")
+    # dict keys in a json can't be of type Timestamp, the dates are formatted all at once
+    dates = format_dates(ticker_dividends.index)
 
-        dividends_map[timestamp_string] = ticker_dividends[timestamp]
+    if layout == "columns":
+        return FastJSONResponse(content={"dates": dates, "dividends": ticker_dividends.to_numpy()}, headers=headers)
 
-    return JSONResponse(content=dividends_map)
+    return FastJSONResponse(content=dict(zip(dates, ticker_dividends.tolist())), headers=headers)
 
 
 # GET endpoint for high/low for a given period, on a saved ticker
+# layout "map" (default) answers {date: [low, high]}, layout "columns" answers {"dates": [...], "low": [...],
+# "high": [...]}
 @router.get("/{ticker}/high-low", tags=["Ticker info"])
-async def get_high_low(ticker: str, period: str):
-    ticker_object = input_file.ticker_object(ticker)
+async def get_high_low(request: Request, ticker: str, period: str, layout: str = "map"):
+    ticker = ticker.upper()
+    input_file.check_saved(ticker)
+
+    if layout not in response_layouts:
+        return FastJSONResponse(status_code=400, content=f"The layout can only be one of {response_layouts}.")
 
     try:
-        ticker_history = ticker_object.history(period=period)
+        start, end, last_bars = period_range(period)
     except ValueError as e:
         logging.error(e)
-        return JSONResponse(status_code=401, content=e)
+        return FastJSONResponse(status_code=401, content=str(e))
+
+    # compact float32 columns, straight out of the history cache, no DataFrame. Loading them may read the stored
+    # history or go upstream, so off the event loop.
+    ticker_history = await run_in_threadpool(in_context(history_store.series, ticker, start, end))
+
+    # "1d" and "5d" mean trading days, not calendar days
+    if last_bars:
+        ticker_history = ticker_history[-last_bars:]
 
-    high = ticker_history["High"]
-    low = ticker_history["Low"]
+    low = ticker_history.low
+    high = ticker_history.high
 
-    high_map = high.to_dict()
-    low_map = low.to_dict()
+    # the range always includes today, whose bar still changes
+    headers, not_modified = conditional(request, make_etag("high-low", layout, ticker_history.days, low, high),
+                                        max_age=open_history_max_age)
 
-    # merging high and low dicts into one with the same timestamp and a touple as value
-    high_low_map = {}
-    timestamp_list = list(low_map.keys())
+    if not_modified:
+        return not_modified
 
-    for timestamp in timestamp_list:
-        # timestamp object to string
-        timestamp_string = timestamp.to_pydatetime()
-        timestamp_string = timestamp_string.strftime("%d %b %Y")
+    dates = format_dates(ticker_history.dates())
 
-        high_low_map[timestamp_string] = (low_map[timestamp], high_map[timestamp])
+    if layout == "columns":
+        return FastJSONResponse(content={"dates": dates, "low": low, "high": high}, headers=headers)
 
-    return JSONResponse(content=high_low_map)
+    # one [low, high] pair per date, the pairs handed to orjson as float32 arrays so they print like the columns do
+    return FastJSONResponse(content=dict(zip(dates, numpy.column_stack((low, high)))), headers=headers)
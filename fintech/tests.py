@@ -1,11 +1,59 @@
+import asyncio
 import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from datetime import date, datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from unittest.mock import patch
+import numpy
+import pandas
+import yagmail
 import yfinance
+from fastapi import Request
 from fastapi.testclient import TestClient
 from app import app
 import logging
 import yfinance as yf
+from benchmarks import SyntheticMarket, compare
+from routers.export import export_history
+from routers.ticker_info import get_market_cap, get_high_low
+from routers.portfolio import analytics_cache
+from routers.helpers.analytics import portfolio_analytics
+from routers.helpers.cache import TTLCache
+from routers.helpers.downsample import lttb, min_max, downsample_columns
+from routers.helpers.graph_cache import GraphCache
+from routers.helpers.helpers import Input, EmailSender
+from routers.helpers.history import HistoryStore
+from routers.helpers.index import PortfolioIndex
+from routers.helpers.input import input_file, metadata_cache, metadata_pool, portfolio_index, history_store
+from routers.helpers.market_data import MarketDataClient, MarketDataProvider
+from routers.helpers.logs import JsonFormatter, SamplingFilter, count_upstream_call
+from routers.helpers.mailer import MailQueue
+from routers.helpers.metrics import Histogram, Registry, upstream_call, upstream_duration
+from routers.helpers.serialization import FastJSONResponse, format_dates, decode_chart_data, export_rows
+from routers.helpers.renderer import GraphRenderer, RenderBusy, RenderTimeout
+from routers.helpers.scheduler import RefreshScheduler, RefreshJob
+from routers.helpers.series import CompactSeries, SeriesCache
+from routers.helpers.shared import SharedStore
+from routers.helpers.upstream import TokenBucket, UpstreamGateway, UpstreamError, UpstreamTimeout, CircuitOpen
+
+# the local SMTP server the mail queue tests send to
+try:
+    from aiosmtpd.controller import Controller
+except ImportError:
+    Controller = None
+
+# the pooled market data client, tested against a local stand-in server
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 # A far better approach for testing would have been setting up a clone of the server, in a different folder,
 # making an identical test server, but with different resource files.
@@ -197,7 +245,7 @@ class TestGraphs(unittest.TestCase):
         valid_email = "dev.alex.serban%40gmail.com"
 
         response = client.post(self.route + f"tsla%20aapl/history/send_graph/?email={valid_email}&start=2016-02-02")
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 202)
 
         log_end("EMAILING A GRAPH")
 
@@ -346,4 +394,1801 @@ class TestIntegrationContract(unittest.TestCase):
 
         self.assertListEqual(list(actual_keys), list(mocked_keys))
 
-        log_end("INTEGRATION CONTRACT WITH THE YAHOO API")
\ No newline at end of file
+        log_end("INTEGRATION CONTRACT WITH THE YAHOO API")
+
+class TestMetadataCache(unittest.TestCase):
+    def test_hits_misses_and_expiry(self):
+        log_start("METADATA CACHE HITS AND MISSES")
+
+        calls = []
+        cache = TTLCache(lambda key: calls.append(key) or {"symbol": key}, ttl=0.05, max_size=10)
+
+        self.assertEqual(cache.get("TSLA"), {"symbol": "TSLA"})
+        self.assertEqual(cache.get("TSLA"), {"symbol": "TSLA"})
+        self.assertEqual(calls, ["TSLA"])
+
+        # once the entry expires we go upstream again
+        time.sleep(0.06)
+        cache.get("TSLA")
+        self.assertEqual(calls, ["TSLA", "TSLA"])
+
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["loads"]), (1, 2, 2))
+
+        log_end("METADATA CACHE HITS AND MISSES")
+
+    def test_stale_while_revalidate(self):
+        log_start("METADATA CACHE STALE WHILE REVALIDATE")
+
+        versions = iter(range(10))
+        reloaded = threading.Event()
+
+        def loader(key):
+            value = {"symbol": key, "version": next(versions)}
+            reloaded.set()
+            return value
+
+        cache = TTLCache(loader, ttl=0.05, max_size=10, stale_ttl=60)
+        self.assertEqual(cache.get("TSLA")["version"], 0)
+
+        # expired: the stale value comes back right away and a new one is loaded in the background
+        time.sleep(0.06)
+        reloaded.clear()
+        self.assertEqual(cache.get("TSLA")["version"], 0)
+        self.assertTrue(reloaded.wait(1))
+        time.sleep(0.01)
+        self.assertEqual(cache.get("TSLA")["version"], 1)
+
+        # refresh() loads again even when the entry is fresh
+        self.assertEqual(cache.refresh("TSLA")["version"], 2)
+        self.assertEqual(cache.stats()["stale_hits"], 1)
+
+        log_end("METADATA CACHE STALE WHILE REVALIDATE")
+
+    def test_lru_eviction_and_invalidation(self):
+        log_start("METADATA CACHE EVICTION")
+
+        cache = TTLCache(lambda key: key.lower(), ttl=60, max_size=2)
+        cache.get("TSLA")
+        cache.get("AAPL")
+
+        # touching TSLA makes AAPL the least recently used one
+        cache.get("TSLA")
+        cache.get("PEP")
+        self.assertIn("TSLA", cache)
+        self.assertNotIn("AAPL", cache)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        cache.invalidate("TSLA")
+        self.assertNotIn("TSLA", cache)
+
+        log_end("METADATA CACHE EVICTION")
+
+    def test_single_flight(self):
+        log_start("METADATA CACHE SINGLE FLIGHT")
+
+        calls = []
+
+        def slow_loader(key):
+            calls.append(key)
+            time.sleep(0.1)
+            return {"symbol": key}
+
+        cache = TTLCache(slow_loader, ttl=60, max_size=10)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("TSLA"))) for _ in range(8)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 8 concurrent misses, only one upstream call
+        self.assertEqual(calls, ["TSLA"])
+        self.assertEqual(len(results), 8)
+
+        log_end("METADATA CACHE SINGLE FLIGHT")
+
+    def test_shared_between_processes(self):
+        log_start("METADATA CACHE SHARED STORE")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "cache.sqlite3")
+
+        # two caches on the same database stand in for two worker processes
+        calls = []
+        first = TTLCache(lambda key: calls.append(key) or {"symbol": key}, ttl=60, shared=SharedStore(path))
+        second = TTLCache(lambda key: calls.append(key) or {"symbol": key}, ttl=60, shared=SharedStore(path))
+
+        self.assertEqual(first.get("TSLA"), {"symbol": "TSLA"})
+        self.assertEqual(second.get("TSLA"), {"symbol": "TSLA"})
+        self.assertEqual(calls, ["TSLA"])
+        self.assertEqual(second.stats()["shared_hits"], 1)
+
+        # a refresh only goes upstream when the shared value is older than max_age
+        second.refresh("TSLA", max_age=60)
+        self.assertEqual(calls, ["TSLA"])
+        second.refresh("TSLA")
+        self.assertEqual(calls, ["TSLA", "TSLA"])
+
+        # an invalidation reaches the other workers too
+        first.invalidate("TSLA")
+        TTLCache(lambda key: calls.append(key) or {"symbol": key}, ttl=60, shared=SharedStore(path)).get("TSLA")
+        self.assertEqual(calls, ["TSLA", "TSLA", "TSLA"])
+
+        log_end("METADATA CACHE SHARED STORE")
+
+
+# fake .info responses for the offline tests, "SLOW" takes longer than any timeout we set and "BROKEN" always fails
+fake_metadata = {
+    "AAPL": {"country": "United States", "sector": "Technology", "marketCap": 2000, "exchange": "NMS"},
+    "PEP": {"country": "United States", "sector": "Consumer Defensive", "marketCap": 200, "exchange": "NMS"},
+    "SAP": {"country": "Germany", "sector": "Technology", "marketCap": 150, "exchange": "NYQ"},
+}
+
+
+def fake_fetch_ticker_info(ticker):
+    if ticker == "SLOW":
+        time.sleep(0.5)
+    if ticker == "BROKEN":
+        raise ValueError("upstream error")
+
+    return fake_metadata.get(ticker, {})
+
+
+# fake daily bars for every business day of [start, end), the close price of a day is its number of days since epoch
+def fake_fetch_ticker_history(ticker, start, end):
+    days = pandas.bdate_range(start, end, inclusive="left", name="Date")
+    close = (days.values.astype("datetime64[D]").astype(float))
+
+    return pandas.DataFrame({"Open": close, "High": close + 1, "Low": close - 1, "Close": close,
+                             "Adj Close": close, "Volume": 1000.0}, index=days)
+
+
+# runs the test with a temporary portfolio file holding the given tickers, an offline metadata cache and an offline
+# history store
+class OfflinePortfolioTestCase(unittest.TestCase):
+    tickers = []
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        portfolio_path = os.path.join(directory.name, "tickers.txt")
+        with open(portfolio_path, "w") as portfolio:
+            portfolio.writelines(f"{ticker}\n" for ticker in self.tickers)
+
+        # runs last, once the real portfolio file is patched back
+        self.addCleanup(input_file.read)
+
+        for target, attribute, value in [(input_file, "source", portfolio_path),
+                                         (metadata_cache, "loader", fake_fetch_ticker_info),
+                                         (metadata_cache, "shared",
+                                          SharedStore(os.path.join(directory.name, "cache.sqlite3"), "metadata")),
+                                         (metadata_pool, "timeout", 0.2),
+                                         (history_store, "directory", os.path.join(directory.name, "history")),
+                                         (history_store, "fetch", fake_fetch_ticker_history)]:
+            patcher = patch.object(target, attribute, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.portfolio_path = portfolio_path
+
+        input_file.read()
+        metadata_cache.clear()
+        portfolio_index.clear()
+        self.addCleanup(metadata_cache.clear)
+        self.addCleanup(portfolio_index.clear)
+
+
+class TestPortfolioFanOut(OfflinePortfolioTestCase):
+    route = "/fintech/portfolio"
+    tickers = ["AAPL", "SLOW", "PEP", "BROKEN", "SAP"]
+
+    def test_filters_with_failing_tickers(self):
+        log_start("PORTFOLIO FAN-OUT")
+
+        response = client.get(self.route + "/tickers?sector=Technology")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), ["AAPL", "SAP"])
+
+        # the tickers we couldn't get metadata for are reported, not failing the request
+        self.assertEqual(response.headers["X-Tickers-Timed-Out"], "SLOW")
+        self.assertEqual(response.headers["X-Tickers-Failed"], "BROKEN")
+
+        response = client.get(self.route + "/tickers?country=United%20States&market_cap_max=1000")
+        self.assertEqual(json.loads(response.content), ["PEP"])
+
+        # no filters, every ticker is returned
+        response = client.get(self.route + "/tickers")
+        self.assertEqual(json.loads(response.content), self.tickers)
+
+        log_end("PORTFOLIO FAN-OUT")
+
+    def test_sort_and_pagination(self):
+        log_start("PORTFOLIO SORT AND PAGINATION")
+
+        response = client.get(self.route + "/tickers?sort=-market_cap&limit=2")
+        self.assertEqual(json.loads(response.content), ["AAPL", "PEP"])
+        self.assertEqual(response.headers["X-Total-Count"], "3")
+
+        response = client.get(self.route + "/tickers?sort=market_cap&offset=1")
+        self.assertEqual(json.loads(response.content), ["PEP", "AAPL"])
+
+        response = client.get(self.route + "/tickers?sort=country")
+        self.assertEqual(response.status_code, 400)
+
+        log_end("PORTFOLIO SORT AND PAGINATION")
+
+
+class TestPortfolioIndex(unittest.TestCase):
+    def test_incremental_updates(self):
+        log_start("PORTFOLIO INDEX")
+
+        index = PortfolioIndex()
+        for ticker, ticker_info in fake_metadata.items():
+            index.update(ticker, ticker_info)
+
+        # no sector, exchange or market cap means the ticker passes those filters
+        index.update("BTC-USD", {"country": "United States"})
+
+        self.assertEqual(index.query(sector="Technology")[1], ["AAPL", "SAP", "BTC-USD"])
+        self.assertEqual(index.query(market_cap_min=150, market_cap_max=200)[1], ["PEP", "SAP", "BTC-USD"])
+        self.assertEqual(index.query(country="United States", exchange="NMS", sort="-market_cap")[1],
+                         ["AAPL", "PEP", "BTC-USD"])
+
+        # market cap changes are picked up, deleted tickers are gone
+        index.refresh("SAP", dict(fake_metadata["SAP"], marketCap=5000))
+        index.remove("AAPL")
+        self.assertEqual(index.query(market_cap_min=1000), (2, ["SAP", "BTC-USD"]))
+
+        # refresh() never adds new tickers
+        index.refresh("TSLA", {"marketCap": 10})
+        self.assertEqual(index.missing(["TSLA", "SAP"]), ["TSLA"])
+
+        log_end("PORTFOLIO INDEX")
+
+
+class TestPortfolioStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.source = os.path.join(directory.name, "tickers.txt")
+
+        with open(self.source, "w") as portfolio:
+            portfolio.write("TSLA\nAAPL\n")
+
+    def test_journal_replay_and_compaction(self):
+        log_start("PORTFOLIO STORE JOURNAL")
+
+        store = Input(self.source)
+        self.assertEqual(store.add("PEP").status_code, 200)
+        self.assertEqual(store.add("PEP").status_code, 400)
+        self.assertEqual(store.delete("TSLA").status_code, 200)
+        self.assertEqual(store.delete("TSLA").status_code, 404)
+
+        # the portfolio file is untouched until compaction, a fresh store replays the journal on top of it
+        with open(self.source) as portfolio:
+            self.assertEqual(portfolio.read(), "TSLA\nAAPL\n")
+        self.assertEqual(Input(self.source).tickers(), ["AAPL", "PEP"])
+
+        store.compact()
+        with open(self.source) as portfolio:
+            self.assertEqual(portfolio.read(), "AAPL\nPEP\n")
+        self.assertEqual(os.path.getsize(store.journal), 0)
+        self.assertEqual(Input(self.source).tickers(), ["AAPL", "PEP"])
+
+        log_end("PORTFOLIO STORE JOURNAL")
+
+    def test_membership_in_memory(self):
+        log_start("PORTFOLIO STORE MEMBERSHIP")
+
+        store = Input(self.source)
+        store.read()
+
+        # once loaded, checking a ticker doesn't need the files anymore
+        os.remove(self.source)
+        with patch("builtins.open", side_effect=AssertionError("touched the disk")):
+            self.assertTrue(store.check_ticker("AAPL"))
+            self.assertFalse(store.check_ticker("PEP"))
+
+        log_end("PORTFOLIO STORE MEMBERSHIP")
+
+    def test_concurrent_adds(self):
+        log_start("PORTFOLIO STORE CONCURRENT ADDS")
+
+        store = Input(self.source)
+        store.compaction_threshold = 16
+        tickers = [f"T{number}" for number in range(64)]
+
+        threads = [threading.Thread(target=store.add, args=(ticker,)) for ticker in tickers + tickers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(Input(self.source).tickers()), sorted(["TSLA", "AAPL"] + tickers))
+
+        log_end("PORTFOLIO STORE CONCURRENT ADDS")
+
+    def test_workers_see_each_other(self):
+        log_start("PORTFOLIO STORE WORKERS")
+
+        # two stores on the same files stand in for two worker processes
+        first = Input(self.source)
+        second = Input(self.source)
+        first.sync_interval = second.sync_interval = 0
+        first.compaction_threshold = second.compaction_threshold = 4
+
+        self.assertEqual(first.add("PEP").status_code, 200)
+        self.assertTrue(second.check_ticker("PEP"))
+        self.assertEqual(second.add("PEP").status_code, 400)
+
+        self.assertEqual(second.delete("TSLA").status_code, 200)
+        self.assertFalse(first.check_ticker("TSLA"))
+
+        # enough entries for the journal to get compacted, by either of them
+        for number in range(6):
+            (first if number % 2 else second).add(f"T{number}")
+
+        expected = ["AAPL", "PEP"] + [f"T{number}" for number in range(6)]
+        self.assertEqual(first.tickers(), expected)
+        self.assertEqual(second.tickers(), expected)
+
+        log_end("PORTFOLIO STORE WORKERS")
+
+
+class TestHistoryStore(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        self.fetched = []
+
+        def fetch(ticker, start, end):
+            self.fetched.append((start, end))
+            return fake_fetch_ticker_history(ticker, start, end)
+
+        self.store = HistoryStore(directory.name, fetch)
+
+    def test_gap_fill(self):
+        log_start("HISTORY STORE GAP FILL")
+
+        history = self.store.history("TSLA", date(2020, 1, 1), date(2020, 2, 1))
+        self.assertEqual(self.fetched, [(date(2020, 1, 1), date(2020, 2, 1))])
+        self.assertEqual(len(history), 23)
+        self.assertEqual(history.index[0], pandas.Timestamp("2020-01-01"))
+
+        # a range inside the covered one is read locally
+        history = self.store.history("TSLA", date(2020, 1, 6), date(2020, 1, 11))
+        self.assertEqual(len(self.fetched), 1)
+        self.assertEqual(list(history["Close"]), [18267.0, 18268.0, 18269.0, 18270.0, 18271.0])
+
+        # only the missing days on both sides get fetched, and merged in
+        history = self.store.history("TSLA", date(2019, 12, 1), date(2020, 3, 1))
+        self.assertEqual(self.fetched[1:], [(date(2019, 12, 1), date(2020, 1, 1)),
+                                            (date(2020, 2, 1), date(2020, 3, 1))])
+        self.assertTrue(history.index.is_monotonic_increasing)
+        self.assertEqual(len(history), len(pandas.bdate_range("2019-12-01", "2020-02-29")))
+
+        log_end("HISTORY STORE GAP FILL")
+
+    def test_download_shape(self):
+        log_start("HISTORY STORE DOWNLOAD")
+
+        history = self.store.download(["TSLA", "AAPL"], date(2020, 1, 1), date(2020, 1, 8))
+        self.assertEqual(list(history["Close"].columns), ["TSLA", "AAPL"])
+        self.assertEqual(len(history), 5)
+
+        log_end("HISTORY STORE DOWNLOAD")
+
+
+class TestCompactSeries(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+        self.fetched = []
+
+        def fetch(ticker, start, end):
+            self.fetched.append((ticker, start, end))
+            return fake_fetch_ticker_history(ticker, start, end)
+
+        self.fetch = fetch
+        self.cache = SeriesCache(10 ** 6)
+        self.store = HistoryStore(self.directory, fetch, series_cache=self.cache)
+
+    def test_compact_layout(self):
+        log_start("COMPACT SERIES")
+
+        series = self.store.series("TSLA", date(2020, 1, 1), date(2020, 2, 1))
+        self.assertEqual(len(series), 23)
+        self.assertEqual((series.days.dtype, series.low.dtype, series.volume.dtype),
+                         (numpy.int32, numpy.float32, numpy.float64))
+        self.assertEqual(series.nbytes, 23 * 32)
+
+        # the same values as the DataFrame of the store
+        frame = self.store.history("TSLA", date(2020, 1, 1), date(2020, 2, 1))
+        pandas.testing.assert_frame_equal(series.to_frame(), frame, check_dtype=False)
+
+        # slices are views, by date range and by position
+        week = series.between(date(2020, 1, 6), date(2020, 1, 11))
+        self.assertEqual(week.close.tolist(), [18267.0, 18268.0, 18269.0, 18270.0, 18271.0])
+        self.assertTrue(numpy.shares_memory(week.close, series.close))
+        self.assertEqual(series[-2:].dates().tolist(), [date(2020, 1, 30), date(2020, 1, 31)])
+
+        self.assertEqual(len(CompactSeries.empty().between(date(2020, 1, 1), date(2020, 2, 1))), 0)
+
+        log_end("COMPACT SERIES")
+
+    def test_cache_follows_the_store(self):
+        log_start("COMPACT SERIES CACHE")
+
+        self.store.series("TSLA", date(2020, 1, 1), date(2020, 2, 1))
+
+        # read again from memory, nothing fetched, not even the file opened
+        with patch.object(numpy, "load", side_effect=AssertionError("read from disk")):
+            series = self.store.series("TSLA", date(2020, 1, 6), date(2020, 1, 11))
+        self.assertEqual((len(series), len(self.fetched)), (5, 1))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+        # another worker tops the stored history up: ours is not answered anymore
+        HistoryStore(self.directory, self.fetch).window("TSLA", date(2020, 1, 1), date(2020, 3, 1))
+
+        series = self.store.series("TSLA", date(2020, 1, 1), date(2020, 3, 1))
+        self.assertEqual(len(self.fetched), 2)
+        self.assertEqual(series.dates()[-1], numpy.datetime64("2020-02-28"))
+
+        log_end("COMPACT SERIES CACHE")
+
+    def test_memory_budget(self):
+        log_start("COMPACT SERIES BUDGET")
+
+        # a month of bars takes 23 * 32 bytes, two of them don't fit
+        self.cache.max_bytes = 1000
+
+        for ticker in ("TSLA", "AAPL"):
+            self.store.series(ticker, date(2020, 1, 1), date(2020, 2, 1))
+
+        stats = self.cache.stats()
+        self.assertEqual((stats["size"], stats["bytes"], stats["evictions"]), (1, 23 * 32, 1))
+
+        # the least recently used one went
+        self.store.series("AAPL", date(2020, 1, 1), date(2020, 2, 1))
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+        # bigger than the whole budget: answered, not kept
+        series = self.store.series("PEP", date(2019, 1, 1), date(2020, 2, 1))
+        self.assertGreater(series.nbytes, 1000)
+        self.assertEqual(self.cache.stats()["size"], 1)
+
+        log_end("COMPACT SERIES BUDGET")
+
+
+class TestHighLow(OfflinePortfolioTestCase):
+    route = "/fintech/ticker/"
+    tickers = ["TSLA"]
+
+    def test_high_low_from_store(self):
+        log_start("HIGH-LOW FROM THE HISTORY STORE")
+
+        response = client.get(self.route + "TSLA/high-low?period=5d")
+        self.assertEqual(response.status_code, 200)
+
+        high_low = json.loads(response.content)
+        self.assertEqual(len(high_low), 5)
+        self.assertTrue(all(high - low == 2 for low, high in high_low.values()))
+
+        response = client.get(self.route + "TSLA/high-low?period=7w")
+        self.assertEqual(response.status_code, 401)
+
+        log_end("HIGH-LOW FROM THE HISTORY STORE")
+
+    def test_high_low_columns(self):
+        log_start("HIGH-LOW COLUMNS")
+
+        high_low = json.loads(client.get(self.route + "TSLA/high-low?period=1y").content)
+        columns = json.loads(client.get(self.route + "TSLA/high-low?period=1y&layout=columns").content)
+
+        self.assertEqual(columns["dates"], list(high_low))
+        self.assertEqual(list(zip(columns["low"], columns["high"])), [tuple(pair) for pair in high_low.values()])
+
+        response = client.get(self.route + "TSLA/high-low?period=1y&layout=rows")
+        self.assertEqual(response.status_code, 400)
+
+        log_end("HIGH-LOW COLUMNS")
+
+    def test_serialization(self):
+        log_start("VECTORIZED SERIALIZATION")
+
+        # same strings as strftime on every timestamp, timezones and dates before 1970 included
+        for index in [pandas.date_range("1965-12-25", periods=800, freq="D"),
+                      pandas.date_range("2020-02-27 23:00", periods=5, freq="h", tz="America/New_York"),
+                      pandas.DatetimeIndex([])]:
+            self.assertEqual(format_dates(index), [timestamp.strftime("%d %b %Y") for timestamp in index])
+
+        body = FastJSONResponse(content={"values": numpy.array([1.5, numpy.nan]), "count": numpy.int64(2)}).body
+        self.assertEqual(json.loads(body), {"values": [1.5, None], "count": 2})
+
+        log_end("VECTORIZED SERIALIZATION")
+
+
+
+class TestPortfolioIndexAcrossWorkers(OfflinePortfolioTestCase):
+    route = "/fintech/portfolio"
+    tickers = ["AAPL", "PEP", "SAP"]
+
+    def test_deleted_by_another_worker(self):
+        log_start("PORTFOLIO INDEX ACROSS WORKERS")
+
+        self.assertEqual(json.loads(client.get(self.route + "/tickers?country=United%20States").content),
+                         ["AAPL", "PEP"])
+
+        # another worker deletes PEP, this one's index still has it
+        other_worker = Input(self.portfolio_path)
+        self.assertEqual(other_worker.delete("PEP").status_code, 200)
+
+        with patch.object(input_file, "sync_interval", 0):
+            self.assertEqual(json.loads(client.get(self.route + "/tickers").content), ["AAPL", "SAP"])
+
+            response = client.get(self.route + "/tickers?country=United%20States")
+            self.assertEqual(json.loads(response.content), ["AAPL"])
+
+            response = client.get(self.route + "/tickers?sort=market_cap")
+            self.assertEqual(json.loads(response.content), ["SAP", "AAPL"])
+            self.assertEqual(response.headers["X-Total-Count"], "2")
+
+        self.assertNotIn("PEP", portfolio_index)
+
+        log_end("PORTFOLIO INDEX ACROSS WORKERS")
+
+
+# the longest the event loop went without running while the route's coroutine ran: a route that makes a blocking call
+# right on the loop stalls it (and every other client) for the whole call
+def event_loop_stall(route) -> float:
+    async def measure():
+        beats = [time.monotonic()]
+        stop = asyncio.Event()
+
+        async def heartbeat():
+            while not stop.is_set():
+                await asyncio.sleep(0.01)
+                beats.append(time.monotonic())
+
+        beating = asyncio.ensure_future(heartbeat())
+        await route()
+        beats.append(time.monotonic())
+        stop.set()
+        await beating
+
+        return max(later - earlier for earlier, later in zip(beats, beats[1:]))
+
+    return asyncio.new_event_loop().run_until_complete(measure())
+
+
+def get_request(path: str = "/") -> Request:
+    return Request({"type": "http", "method": "GET", "path": path, "headers": [], "query_string": b""})
+
+
+class TestEventLoopStalls(OfflinePortfolioTestCase):
+    tickers = ["AAPL"]
+
+    def test_metadata_miss_off_the_loop(self):
+        log_start("METADATA MISS OFF THE EVENT LOOP")
+
+        def slow_fetch(ticker):
+            time.sleep(0.5)
+            return fake_fetch_ticker_info(ticker)
+
+        with patch.object(metadata_cache, "loader", slow_fetch):
+            stall = event_loop_stall(lambda: get_market_cap(get_request(), "AAPL"))
+
+        self.assertLess(stall, 0.25)
+
+        log_end("METADATA MISS OFF THE EVENT LOOP")
+
+    def test_history_miss_off_the_loop(self):
+        log_start("HISTORY MISS OFF THE EVENT LOOP")
+
+        def slow_fetch(ticker, start, end):
+            time.sleep(0.5)
+            return fake_fetch_ticker_history(ticker, start, end)
+
+        with patch.object(history_store, "fetch", slow_fetch):
+            stall = event_loop_stall(lambda: get_high_low(get_request(), "AAPL", "1mo"))
+
+        self.assertLess(stall, 0.25)
+
+        log_end("HISTORY MISS OFF THE EVENT LOOP")
+
+
+class TestTickerBatch(OfflinePortfolioTestCase):
+    route = "/fintech/ticker/"
+    tickers = ["AAPL", "PEP", "SLOW", "BROKEN"]
+
+    def test_batch_fields(self):
+        log_start("TICKER BATCH")
+
+        response = client.get(self.route + "batch?tickers=AAPL,pep,AAPL&fields=market-cap,sector,forwardPE")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {
+            "AAPL": {"market-cap": 2000, "sector": "Technology", "forwardPE": None},
+            "PEP": {"market-cap": 200, "sector": "Consumer Defensive", "forwardPE": None},
+        })
+
+        # the single field routes answer null for a missing field too, instead of failing
+        response = client.get(self.route + "AAPL/price-to-earnings")
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(json.loads(response.content))
+
+        log_end("TICKER BATCH")
+
+    def test_batch_failures(self):
+        log_start("TICKER BATCH FAILURES")
+
+        response = client.get(self.route + "batch?tickers=AAPL,TSLA,MSFT")
+        self.assertEqual(response.status_code, 404)
+        self.assertIn("TSLA MSFT", json.loads(response.content))
+
+        response = client.get(self.route + "batch?tickers=AAPL,SLOW,BROKEN")
+        self.assertEqual(response.status_code, 200)
+
+        batch = json.loads(response.content)
+        self.assertEqual(list(batch["AAPL"]), ["price-to-earnings", "market-cap", "last-dividend-value"])
+        self.assertIsNone(batch["SLOW"])
+        self.assertIsNone(batch["BROKEN"])
+        self.assertEqual(response.headers["X-Tickers-Timed-Out"], "SLOW")
+        self.assertEqual(response.headers["X-Tickers-Failed"], "BROKEN")
+
+        log_end("TICKER BATCH FAILURES")
+
+
+class TestHistoryExport(OfflinePortfolioTestCase):
+    route = "/fintech/export/tickers/"
+    tickers = ["TSLA", "AAPL"]
+
+    def test_ndjson_and_csv(self):
+        log_start("HISTORY EXPORT")
+
+        response = client.get(self.route + "TSLA%20AAPL/history?start=2020-01-01&end=2020-12-31")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("application/x-ndjson"))
+
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        trading_days = len(pandas.bdate_range("2020-01-01", "2020-12-31"))
+        self.assertEqual(len(rows), 2 * trading_days)
+        self.assertEqual(rows[0]["ticker"], "TSLA")
+        self.assertEqual(rows[-1]["ticker"], "AAPL")
+
+        # both ends of the range are included
+        self.assertEqual((rows[0]["date"], rows[trading_days - 1]["date"]), ("2020-01-01", "2020-12-31"))
+        self.assertEqual(rows[0]["high"] - rows[0]["low"], 2)
+
+        response = client.get(self.route + "TSLA/history?start=2020-01-01&end=2020-01-31&format=csv")
+        lines = response.text.splitlines()
+        self.assertEqual(lines[0], "ticker,date,open,high,low,close,adj_close,volume")
+        self.assertEqual(len(lines), 1 + len(pandas.bdate_range("2020-01-01", "2020-01-31")))
+        self.assertTrue(lines[1].startswith("TSLA,2020-01-01,"))
+
+        response = client.get(self.route + "TSLA%20MSFT/history?start=2020-01-01")
+        self.assertEqual(response.status_code, 404)
+
+        response = client.get(self.route + "TSLA/history?start=2020-01-01&format=xml")
+        self.assertEqual(response.status_code, 400)
+
+        log_end("HISTORY EXPORT")
+
+    def test_stops_when_client_disconnects(self):
+        log_start("HISTORY EXPORT DISCONNECT")
+
+        fetched = []
+
+        def recording_fetch(ticker, start, end):
+            fetched.append(ticker)
+            return fake_fetch_ticker_history(ticker, start, end)
+
+        # connected for the first ticker and its first chunk, gone after that
+        class GoneAfterFirstChunk:
+            checks = 0
+
+            async def is_disconnected(self):
+                self.checks += 1
+                return self.checks > 2
+
+        async def read_export():
+            response = await export_history(GoneAfterFirstChunk(), "TSLA AAPL", "2000-01-01", "2020-12-31", "ndjson")
+            return [chunk async for chunk in response.body_iterator]
+
+        with patch.object(history_store, "fetch", recording_fetch):
+            chunks = asyncio.run(read_export())
+
+        # the header and one chunk of TSLA, AAPL is never fetched
+        self.assertEqual(len(chunks), 2)
+        self.assertEqual(fetched, ["TSLA"])
+
+        log_end("HISTORY EXPORT DISCONNECT")
+
+    def test_backpressure_through_the_app(self):
+        log_start("HISTORY EXPORT BACKPRESSURE")
+
+        fetched = []
+        produced = []
+
+        def recording_fetch(ticker, start, end):
+            fetched.append(ticker)
+            return fake_fetch_ticker_history(ticker, start, end)
+
+        def counting_rows(*args):
+            produced.append(args[0])
+            return export_rows(*args)
+
+        # a slow client of the whole app (middleware included), reading `read_chunks` chunks before going away. Returns
+        # how many chunks were produced by the time it got each of them.
+        async def slow_client(read_chunks):
+            scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "root_path": "",
+                     "path": "/fintech/export/tickers/TSLA AAPL/history", "raw_path": b"",
+                     "query_string": b"start=2000-01-01&end=2020-12-31", "headers": [(b"host", b"testserver")],
+                     "client": ("127.0.0.1", 50000), "server": ("testserver", 80)}
+            produced_when_read = []
+            gone = asyncio.Event()
+            requested = False
+
+            async def receive():
+                nonlocal requested
+
+                if not requested:
+                    requested = True
+                    return {"type": "http.request", "body": b"", "more_body": False}
+
+                await gone.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                if message["type"] == "http.response.body" and message.get("body"):
+                    produced_when_read.append(len(produced))
+                    await asyncio.sleep(0.01)
+
+                    if len(produced_when_read) >= read_chunks:
+                        gone.set()
+
+            await app(scope, receive, send)
+
+            return produced_when_read
+
+        with patch.object(history_store, "fetch", recording_fetch), patch("routers.export.export_rows", counting_rows):
+            produced_when_read = asyncio.run(slow_client(read_chunks=3))
+
+        # a chunk is only produced once the one before it went out, not ahead of the client (the ndjson header is
+        # empty, the first chunk read is the first one produced)
+        self.assertEqual(produced_when_read, [1, 2, 3])
+
+        # gone after three chunks of TSLA: nothing more is produced and AAPL is never fetched
+        self.assertEqual(len(produced), 3)
+        self.assertEqual(fetched, ["TSLA"])
+
+        log_end("HISTORY EXPORT BACKPRESSURE")
+
+
+class TestPortfolioAnalytics(OfflinePortfolioTestCase):
+    route = "/fintech/portfolio/analytics"
+    tickers = ["TSLA", "AAPL"]
+
+    def setUp(self):
+        super().setUp()
+        analytics_cache.clear()
+        self.addCleanup(analytics_cache.clear)
+
+    def test_against_pandas(self):
+        log_start("ANALYTICS AGAINST PANDAS")
+
+        random = numpy.random.default_rng(1)
+        days = pandas.bdate_range("2020-01-01", periods=300)
+        close = pandas.DataFrame(100 * numpy.exp(numpy.cumsum(random.normal(0, 0.02, (300, 3)), axis=0)),
+                                 index=days, columns=["A", "B", "C"])
+        close.iloc[:50, 2] = numpy.nan
+        close.iloc[100, 1] = numpy.nan
+
+        # A pays a dividend of 2 on day 200: the adjusted closes before it are scaled down
+        adjusted = close.copy()
+        adjusted.iloc[:200, 0] = close.iloc[:200, 0] * (1 - 2 / close.iloc[199, 0])
+
+        analytics = portfolio_analytics(pandas.concat({"Close": close, "Adj Close": adjusted}, axis=1))
+        returns = adjusted.ffill().pct_change(fill_method=None)
+
+        volatility = [analytics["metrics"][ticker]["annualized_volatility"] for ticker in "ABC"]
+        drawdown = [analytics["metrics"][ticker]["max_drawdown"] for ticker in "ABC"]
+        numpy.testing.assert_allclose(volatility, returns.std() * numpy.sqrt(252))
+        numpy.testing.assert_allclose(drawdown, (adjusted.ffill() / adjusted.ffill().cummax() - 1).min())
+        numpy.testing.assert_allclose(analytics["correlation"], returns.corr())
+
+        years = (days[-1] - days[0]).days / 365.25
+        self.assertAlmostEqual(analytics["metrics"]["A"]["dividend_yield"], 2 / years / close.iloc[-1, 0])
+        self.assertEqual(analytics["metrics"]["B"]["dividend_yield"], 0)
+
+        log_end("ANALYTICS AGAINST PANDAS")
+
+    def test_route_is_memoized(self):
+        log_start("ANALYTICS ROUTE")
+
+        response = client.get(self.route + "?start=2020-01-01&end=2021-01-01")
+        self.assertEqual(response.status_code, 200)
+
+        analytics = json.loads(response.content)
+        self.assertEqual(analytics["tickers"], ["AAPL", "TSLA"])
+        self.assertEqual(analytics["metrics"]["TSLA"]["max_drawdown"], 0)
+        self.assertEqual(len(analytics["correlation"]), 2)
+
+        response = client.get(self.route + "?start=2020-01-01&end=2021-01-01&tickers=tsla,aapl")
+        self.assertEqual(json.loads(response.content), analytics)
+        self.assertEqual((analytics_cache.stats()["hits"], analytics_cache.stats()["loads"]), (1, 1))
+
+        response = client.get(self.route + "?start=2020-01-01&end=2021-01-01&tickers=TSLA&daily_returns=true")
+        self.assertEqual(len(json.loads(response.content)["daily_returns"]["returns"]["TSLA"]),
+                         len(pandas.bdate_range("2020-01-01", "2020-12-31")) - 1)
+
+        self.assertEqual(client.get(self.route + "?start=2020-01-01&tickers=MSFT").status_code, 404)
+        self.assertEqual(client.get(self.route + "?start=2020-13-01").status_code, 400)
+
+        log_end("ANALYTICS ROUTE")
+
+
+class TestGraphCache(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_keys_and_eviction(self):
+        log_start("GRAPH CACHE")
+
+        cache = GraphCache(self.directory, max_bytes=250)
+
+        # the ticker order doesn't matter, the dates and options do
+        key = cache.request_key(["TSLA", "AAPL"], date(2020, 1, 1), date(2021, 1, 1))
+        self.assertEqual(key, cache.request_key(["AAPL", "TSLA"], date(2020, 1, 1), date(2021, 1, 1)))
+        self.assertNotEqual(key, cache.request_key(["AAPL", "TSLA"], date(2020, 1, 1), date(2021, 1, 2)))
+        self.assertNotEqual(key, cache.request_key(["AAPL", "TSLA"], date(2020, 1, 1), date(2021, 1, 1), {"dpi": 1}))
+
+        self.assertIsNone(cache.get(key, "0" * 16))
+        path = cache.put(key, "0" * 16, b"x" * 100)
+        self.assertEqual(cache.get(key, "0" * 16), path)
+        self.assertEqual(cache.get(key), path)
+        self.assertIsNone(cache.get(key, "1" * 16))
+
+        # over budget, the least recently used graph goes
+        other_key = cache.request_key(["PEP"], date(2020, 1, 1), date(2021, 1, 1))
+        cache.put(other_key, "0" * 16, b"x" * 100)
+        cache.get(key)
+        cache.put(other_key, "1" * 16, b"x" * 100)
+
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted([os.path.basename(path), f"{other_key}_{'1' * 16}.png"]))
+        self.assertEqual(cache.stats()["bytes"], 200)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+        # a restarted cache picks the graphs up again
+        self.assertEqual(GraphCache(self.directory).get(key), path)
+
+        log_end("GRAPH CACHE")
+
+
+class TestCachedGraphs(OfflinePortfolioTestCase):
+    route = "/fintech/graphs/tickers/"
+    tickers = ["TSLA", "AAPL"]
+
+    def test_closed_range_served_from_cache(self):
+        log_start("CACHED GRAPHS")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        with patch("routers.graphs.graph_cache", GraphCache(directory.name)) as cache:
+            response = client.get(self.route + "tsla%20aapl/history/?start=2020-01-01&end=2020-03-01")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["content-type"], "image/png")
+
+            # same graph, other ticker order: no data needed at all
+            with patch.object(history_store, "fetch", side_effect=AssertionError("went upstream")):
+                cached_response = client.get(self.route + "aapl%20tsla/history/?start=2020-01-01&end=2020-03-01")
+
+            self.assertEqual(cached_response.content, response.content)
+            self.assertEqual((cache.stats()["hits"], cache.stats()["misses"]), (1, 1))
+
+            response = client.get(self.route + "tsla/history/?start=2020-01-01&downsample=every-other")
+            self.assertEqual(response.status_code, 400)
+
+        log_end("CACHED GRAPHS")
+
+    def test_chart_data(self):
+        log_start("CHART DATA")
+
+        with patch("routers.graphs.graph_renderer.render", side_effect=AssertionError("rendered")):
+            response = client.get(self.route + "tsla%20aapl/history/?start=2010-01-01&end=2020-01-01&format=data")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "application/vnd.fintech.chart-data")
+
+        header, dates, values = decode_chart_data(response.content)
+        self.assertEqual(header["tickers"], ["AAPL", "TSLA"])
+        self.assertEqual(header["title"], "AAPL TSLA history between 2010-01-01 and 2020-01-01")
+
+        # downsampled to about a point per pixel of the graph, on a date axis the tickers share
+        self.assertLessEqual(len(dates), 2 * 1600)
+        self.assertEqual(values.shape, (len(dates), 2))
+        self.assertEqual(str(dates[0]), "2010-01-01")
+        numpy.testing.assert_array_equal(values[:, 0], dates.astype(numpy.int64).astype(numpy.float32))
+
+        response = client.get(self.route + "tsla/history/?start=2019-12-01&end=2020-01-01&format=data&downsample=none")
+        self.assertEqual(len(decode_chart_data(response.content)[1]), len(pandas.bdate_range("2019-12-01",
+                                                                                             "2019-12-31")))
+
+        response = client.post(self.route + "tsla/history/send_graph/?start=2020-01-01&format=data&email=a@b.com")
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(client.get(self.route + "tsla/history/?start=2020-01-01&format=svg").status_code, 400)
+
+        log_end("CHART DATA")
+
+
+
+class TestConditionalRequests(OfflinePortfolioTestCase):
+    tickers = ["TSLA", "AAPL"]
+
+    def test_graphs_revalidated_before_rendering(self):
+        log_start("CONDITIONAL GRAPHS")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        route = "/fintech/graphs/tickers/tsla%20aapl/history/"
+
+        with patch("routers.graphs.graph_cache", GraphCache(directory.name)):
+            # a closed range can be kept for long, and was last modified when it ended
+            response = client.get(route + "?start=2020-01-01&end=2020-03-01")
+            etag = response.headers["etag"]
+            self.assertEqual(response.headers["cache-control"], "public, max-age=604800")
+            self.assertEqual(response.headers["last-modified"], "Sun, 01 Mar 2020 00:00:00 GMT")
+
+            with patch("routers.graphs.graph_renderer.render", side_effect=AssertionError("rendered")), \
+                    patch.object(history_store, "fetch", side_effect=AssertionError("went upstream")):
+                response = client.get(route + "?start=2020-01-01&end=2020-03-01", headers={"If-None-Match": etag})
+                self.assertEqual((response.status_code, response.content, response.headers["etag"]), (304, b"", etag))
+
+                response = client.get(route + "?start=2020-01-01&end=2020-03-01",
+                                      headers={"If-Modified-Since": "Mon, 02 Mar 2020 00:00:00 GMT"})
+                self.assertEqual(response.status_code, 304)
+
+            response = client.get(route + "?start=2020-01-01&end=2020-03-01",
+                                  headers={"If-Modified-Since": "Sat, 29 Feb 2020 00:00:00 GMT"})
+            self.assertEqual(response.status_code, 200)
+
+            # an open range is revalidated from the data, still without rendering
+            start = (date.today() - timedelta(days=30)).isoformat()
+            start = f"{start}&end={(date.today() + timedelta(days=1)).isoformat()}"
+            response = client.get(route + f"?start={start}")
+            self.assertEqual(response.headers["cache-control"], "public, max-age=60")
+            self.assertNotIn("last-modified", response.headers)
+
+            with patch("routers.graphs.graph_renderer.render", side_effect=AssertionError("rendered")):
+                response = client.get(route + f"?start={start}", headers={"If-None-Match": response.headers["etag"]})
+            self.assertEqual(response.status_code, 304)
+
+            # the chart data of the same graph is another representation
+            response = client.get(route + f"?start={start}&format=data", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers["etag"], etag)
+
+        log_end("CONDITIONAL GRAPHS")
+
+    def test_ticker_data_revalidated(self):
+        log_start("CONDITIONAL TICKER DATA")
+
+        response = client.get("/fintech/ticker/AAPL/high-low?period=1mo")
+        etag = response.headers["etag"]
+        self.assertEqual(response.headers["cache-control"], "public, max-age=60")
+
+        with patch("routers.ticker_info.format_dates", side_effect=AssertionError("serialized")):
+            response = client.get("/fintech/ticker/AAPL/high-low?period=1mo",
+                                  headers={"If-None-Match": f'W/{etag}, "other"'})
+        self.assertEqual(response.status_code, 304)
+
+        # another layout is another representation
+        response = client.get("/fintech/ticker/AAPL/high-low?period=1mo&layout=columns",
+                              headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 200)
+
+        response = client.get("/fintech/ticker/AAPL/market-cap")
+        self.assertEqual(json.loads(response.content), 2000)
+        response = client.get("/fintech/ticker/AAPL/market-cap", headers={"If-None-Match": response.headers["etag"]})
+        self.assertEqual(response.status_code, 304)
+
+        response = client.get("/fintech/ticker/batch?tickers=AAPL,TSLA&fields=market-cap")
+        with patch("routers.ticker_info.FastJSONResponse.render", side_effect=AssertionError("serialized")):
+            self.assertEqual(client.get("/fintech/ticker/batch?tickers=AAPL,TSLA&fields=market-cap",
+                                        headers={"If-None-Match": response.headers["etag"]}).status_code, 304)
+
+        # other fields are another batch
+        self.assertEqual(client.get("/fintech/ticker/batch?tickers=AAPL,TSLA&fields=market-cap,sector",
+                                    headers={"If-None-Match": response.headers["etag"]}).status_code, 200)
+
+        log_end("CONDITIONAL TICKER DATA")
+
+    def test_dividends_of_a_ticker_without_any(self):
+        log_start("DIVIDENDS NONE PAID")
+
+        dividends = pandas.Series([0.5], index=pandas.DatetimeIndex(["2021-01-04"], name="Date"), name="Dividends")
+
+        # yfinance answers an empty series with a RangeIndex for a ticker that never paid dividends
+        with patch("routers.helpers.helpers.gateway.dividends", return_value=pandas.Series(dtype=float)):
+            response = client.get("/fintech/ticker/TSLA/dividends")
+            self.assertEqual((response.status_code, json.loads(response.content)), (200, {}))
+            self.assertNotIn("last-modified", response.headers)
+
+            response = client.get("/fintech/ticker/TSLA/dividends?layout=columns")
+            self.assertEqual(json.loads(response.content), {"dates": [], "dividends": []})
+
+            etag = response.headers["etag"]
+            response = client.get("/fintech/ticker/TSLA/dividends?layout=columns", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+
+        with patch("routers.helpers.helpers.gateway.dividends", return_value=dividends):
+            response = client.get("/fintech/ticker/TSLA/dividends")
+            self.assertEqual(json.loads(response.content), {"04 Jan 2021": 0.5})
+            self.assertEqual(response.headers["last-modified"], "Mon, 04 Jan 2021 00:00:00 GMT")
+
+            # a new dividend is a new representation
+            response = client.get("/fintech/ticker/TSLA/dividends?layout=columns", headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 200)
+
+        log_end("DIVIDENDS NONE PAID")
+
+
+class TestGraphRenderer(unittest.TestCase):
+    def test_render_on_worker_processes(self):
+        log_start("GRAPH RENDERER")
+
+        close = fake_fetch_ticker_history("TSLA", date(2020, 1, 1), date(2020, 3, 1))["Close"]
+        arguments = ([(close.index.to_numpy(), close.to_numpy())], ["TSLA"], "TSLA history",
+                     {"figsize": (16, 9), "dpi": 100, "marker": "."})
+
+        renderer = GraphRenderer(workers=1, max_queued=1, timeout=60)
+        self.addCleanup(renderer.shutdown)
+
+        async def render_twice():
+            # the second graph doesn't fit in the queue while the first one renders
+            return await asyncio.gather(renderer.render(*arguments), renderer.render(*arguments),
+                                        return_exceptions=True)
+
+        png, busy = asyncio.run(render_twice())
+        self.assertTrue(png.startswith(b"\x89PNG"))
+        self.assertIsInstance(busy, RenderBusy)
+
+        log_end("GRAPH RENDERER")
+
+    def test_timed_out_render_recycles_the_workers(self):
+        log_start("GRAPH RENDERER RECYCLING")
+
+        renderer = GraphRenderer(workers=1, max_queued=4, timeout=30)
+        self.addCleanup(renderer.shutdown)
+
+        async def stuck_then_render():
+            worker = await renderer.run(os.getpid)
+
+            # a render that runs out of time doesn't keep the only worker busy for the ones after it
+            renderer.timeout = 0.5
+            with self.assertRaises(RenderTimeout):
+                await renderer.run(time.sleep, 60)
+
+            renderer.timeout = 30
+            started = time.monotonic()
+
+            return worker, await renderer.run(os.getpid), time.monotonic() - started
+
+        worker, new_worker, took = asyncio.run(stuck_then_render())
+        self.assertNotEqual(worker, new_worker)
+        self.assertLess(took, 20)
+
+        log_end("GRAPH RENDERER RECYCLING")
+
+
+class TestDownsampling(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.default_rng(7)
+        self.x = numpy.arange(20000, dtype=float)
+        self.y = numpy.cumsum(random.normal(size=20000))
+
+    def test_lttb(self):
+        log_start("LTTB DOWNSAMPLING")
+
+        kept = lttb(self.x, self.y, 1600)
+        self.assertEqual(len(kept), 1600)
+        self.assertEqual((kept[0], kept[-1]), (0, 19999))
+        self.assertTrue(numpy.all(numpy.diff(kept) > 0))
+
+        # nothing to do when we already are under the budget
+        self.assertEqual(len(lttb(self.x[:100], self.y[:100], 1600)), 100)
+
+        log_end("LTTB DOWNSAMPLING")
+
+    def test_min_max(self):
+        log_start("MIN-MAX DOWNSAMPLING")
+
+        kept = min_max(self.y, 1600)
+        self.assertLessEqual(len(kept), 1602)
+        self.assertIn(numpy.argmin(self.y), kept)
+        self.assertIn(numpy.argmax(self.y), kept)
+
+        log_end("MIN-MAX DOWNSAMPLING")
+
+    def test_columns_with_gaps(self):
+        log_start("DOWNSAMPLING COLUMNS")
+
+        dates = numpy.arange("2000-01-01", "2020-01-01", dtype="datetime64[D]")
+        columns = numpy.stack([numpy.arange(len(dates), dtype=float)] * 2, axis=1)
+        columns[::2, 1] = numpy.nan
+
+        series = downsample_columns(dates, columns, "lttb", 500)
+        self.assertEqual([len(values) for _, values in series], [500, 500])
+        self.assertFalse(numpy.isnan(series[1][1]).any())
+        self.assertEqual(series[0][0][-1], dates[-1])
+
+        log_end("DOWNSAMPLING COLUMNS")
+
+
+# collects whatever the local SMTP server receives
+class RecordingHandler:
+    def __init__(self):
+        self.envelopes = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.envelopes.append(envelope)
+        return "250 OK"
+
+
+@unittest.skipIf(Controller is None, "aiosmtpd is not installed")
+class TestMailQueue(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as free_socket:
+            free_socket.bind(("127.0.0.1", 0))
+            self.port = free_socket.getsockname()[1]
+
+        self.handler = RecordingHandler()
+        self.controller = Controller(self.handler, hostname="127.0.0.1", port=self.port)
+        self.controller.start()
+        self.addCleanup(self.controller.stop)
+
+        self.connections = 0
+
+        graph = tempfile.NamedTemporaryFile(suffix=".png", delete=False)
+        graph.write(b"\x89PNG fake graph")
+        graph.close()
+        self.graph_path = graph.name
+        self.addCleanup(os.remove, graph.name)
+
+    # opens a connection to the local server, the first `failures` attempts fail
+    def connect(self, failures=0):
+        self.connections += 1
+
+        if self.connections <= failures:
+            raise ConnectionRefusedError("server not ready")
+
+        return yagmail.SMTP("sender@example.com", host="127.0.0.1", port=self.port, smtp_ssl=False,
+                            smtp_starttls=False, smtp_skip_login=True)
+
+    def wait_for(self, mail_queue, jobs):
+        for _ in range(200):
+            if all(mail_queue.status(job.id)["status"] in MailQueue.finished_statuses for job in jobs):
+                return
+            time.sleep(0.05)
+
+    def test_batched_delivery(self):
+        log_start("MAIL QUEUE DELIVERY")
+
+        mail_queue = MailQueue(self.connect, workers=1, batch_size=10)
+        self.addCleanup(mail_queue.stop)
+
+        jobs = [mail_queue.submit(EmailSender(f"user{number}@example.com", "Graph", "Here", None), self.graph_path)
+                for number in range(5)]
+        self.wait_for(mail_queue, jobs)
+
+        self.assertEqual([mail_queue.status(job.id)["status"] for job in jobs], ["sent"] * 5)
+        self.assertEqual(len(self.handler.envelopes), 5)
+
+        # one worker, one connection for all of them
+        self.assertEqual(self.connections, 1)
+
+        log_end("MAIL QUEUE DELIVERY")
+
+    def test_retries_with_backoff(self):
+        log_start("MAIL QUEUE RETRIES")
+
+        mail_queue = MailQueue(lambda: self.connect(failures=2), workers=1, backoff=0.01, max_attempts=3)
+        self.addCleanup(mail_queue.stop)
+
+        job = mail_queue.submit(EmailSender("user@example.com", "Graph", "Here", None), self.graph_path)
+        self.wait_for(mail_queue, [job])
+
+        self.assertEqual(mail_queue.status(job.id)["status"], "sent")
+        self.assertEqual(mail_queue.status(job.id)["attempts"], 3)
+
+        failing_queue = MailQueue(lambda: self.connect(failures=100), workers=1, backoff=0.01, max_attempts=2)
+        self.addCleanup(failing_queue.stop)
+
+        job = failing_queue.submit(EmailSender("user@example.com", "Graph", "Here", None))
+        self.wait_for(failing_queue, [job])
+        self.assertEqual(failing_queue.status(job.id)["status"], "failed")
+
+        log_end("MAIL QUEUE RETRIES")
+
+
+class TestStructuredLogging(OfflinePortfolioTestCase):
+    tickers = ["TSLA"]
+
+    def test_request_log_line(self):
+        log_start("STRUCTURED REQUEST LOGS")
+
+        def counted_fetch(ticker, start, end):
+            count_upstream_call()
+            return fake_fetch_ticker_history(ticker, start, end)
+
+        with patch.object(history_store, "fetch", counted_fetch), \
+                self.assertLogs("fintech.requests", level="INFO") as logs:
+            client.get("/fintech/ticker/TSLA/high-low?period=1mo")
+
+        record = logs.records[-1]
+        self.assertEqual((record.path, record.status, record.upstream_calls), ("/fintech/ticker/TSLA/high-low", 200, 1))
+
+        line = json.loads(JsonFormatter().format(record))
+        self.assertEqual(line["request_id"], record.request_id)
+        self.assertEqual(line["logger"], "fintech.requests")
+        self.assertIn("duration_ms", line)
+
+        log_end("STRUCTURED REQUEST LOGS")
+
+    def test_sampling(self):
+        log_start("LOG SAMPLING")
+
+        sampling = SamplingFilter({"fintech.requests": 0})
+        info = logging.LogRecord("fintech.requests", logging.INFO, "", 0, "request", None, None)
+        warning = logging.LogRecord("fintech.requests", logging.WARNING, "", 0, "request", None, None)
+        other = logging.LogRecord("fintech.portfolio", logging.INFO, "", 0, "lookup", None, None)
+
+        self.assertFalse(sampling.filter(info))
+        self.assertTrue(sampling.filter(warning))
+        self.assertTrue(sampling.filter(other))
+
+        log_end("LOG SAMPLING")
+
+
+class TestMetrics(OfflinePortfolioTestCase):
+    tickers = ["TSLA"]
+
+    def test_histogram(self):
+        log_start("METRICS HISTOGRAM")
+
+        registry = Registry()
+        latency = registry.register(Histogram("latency_seconds", "Latency.", ["route"], buckets=(0.1, 1)))
+
+        for value in (0.05, 0.5, 0.5, 5):
+            latency.observe(value, route="/a")
+
+        registry.register_cache("fake", lambda: {"hits": 3, "misses": 1, "evictions": 0, "hit_ratio": 0.75})
+        registry.register_cache("sized", lambda: {"hits": 0, "misses": 0, "evictions": 0, "hit_ratio": 0.0,
+                                                  "bytes": 2048, "max_bytes": 4096})
+        text = registry.render()
+
+        self.assertIn('latency_seconds_bucket{route="/a",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="1"} 3', text)
+        self.assertIn('latency_seconds_bucket{route="/a",le="+Inf"} 4', text)
+        self.assertIn('latency_seconds_count{route="/a"} 4', text)
+        self.assertIn('fintech_cache_hit_ratio{cache="fake"} 0.75', text)
+        self.assertIn('fintech_cache_bytes{cache="sized"} 2048', text)
+        self.assertIn('fintech_cache_max_bytes{cache="sized"} 4096', text)
+        self.assertNotIn('fintech_cache_bytes{cache="fake"}', text)
+
+        log_end("METRICS HISTOGRAM")
+
+    def test_metrics_endpoint(self):
+        log_start("METRICS ENDPOINT")
+
+        def timed_fetch(ticker, start, end):
+            with upstream_call("history"):
+                return fake_fetch_ticker_history(ticker, start, end)
+
+        history_calls = upstream_duration.count(operation="history")
+
+        with patch.object(history_store, "fetch", timed_fetch):
+            client.get("/fintech/ticker/TSLA/high-low?period=1mo")
+
+        self.assertEqual(upstream_duration.count(operation="history"), history_calls + 1)
+
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+
+        # one series per route, not per ticker
+        self.assertIn('fintech_requests_total{method="GET",route="/fintech/ticker/{ticker}/high-low",status="200"}',
+                      response.text)
+        self.assertIn('fintech_upstream_duration_seconds_count{operation="history"}', response.text)
+        self.assertIn('fintech_cache_hit_ratio{cache="metadata"}', response.text)
+        self.assertIn('fintech_cache_hit_ratio{cache="graphs"}', response.text)
+
+        # the caches under a byte budget report their size and their budget
+        for cache in ("graphs", "history"):
+            self.assertIn(f'fintech_cache_bytes{{cache="{cache}"}}', response.text)
+            self.assertIn(f'fintech_cache_max_bytes{{cache="{cache}"}}', response.text)
+
+        log_end("METRICS ENDPOINT")
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_synthetic_market_and_compare(self):
+        log_start("BENCHMARKS")
+
+        # the same seed gives the same market, whatever was asked before
+        market = SyntheticMarket(seed=7, years=2)
+        history = market.history("T00001", start=date(2020, 1, 1), end=date(2020, 2, 1))
+        SyntheticMarket(seed=7, years=2).info("T00002")
+
+        self.assertTrue(history.equals(SyntheticMarket(seed=7, years=2).history("T00001", start=date(2020, 1, 1),
+                                                                               end=date(2020, 2, 1))))
+        self.assertEqual(market.info("T00001"), SyntheticMarket(seed=7).info("T00001"))
+        self.assertNotEqual(market.info("T00001"), SyntheticMarket(seed=8).info("T00001"))
+        self.assertEqual(len(market.dividends("T00001")), 8)
+
+        baseline = {"fast": {"median": 1.0}, "slow": {"median": 1.0}, "gone": {"median": 1.0}}
+        results = {"fast": {"median": 0.5}, "slow": {"median": 1.5}, "new": {"median": 1.0}}
+        self.assertEqual(compare(results, baseline, 0.2), ["slow"])
+
+        log_end("BENCHMARKS")
+
+
+class TestRefreshScheduler(unittest.TestCase):
+    def test_warm_up_and_due_refreshes(self):
+        log_start("REFRESH SCHEDULER")
+
+        portfolio = ["TSLA", "AAPL"]
+        refreshed = []
+
+        scheduler = RefreshScheduler(lambda: portfolio,
+                                     [RefreshJob("metadata", lambda ticker: refreshed.append(("metadata", ticker)), 60),
+                                      RefreshJob("history", lambda ticker: refreshed.append(("history", ticker)), 0)],
+                                     rate=1000, jitter=0)
+
+        # the first pass warms everything up
+        self.assertEqual(scheduler.run_pending(), 4)
+        self.assertEqual(refreshed, [("metadata", "TSLA"), ("metadata", "AAPL"),
+                                     ("history", "TSLA"), ("history", "AAPL")])
+
+        # only what is due runs again, and a new ticker gets warmed up
+        refreshed.clear()
+        portfolio.append("PEP")
+        scheduler.run_pending()
+        self.assertEqual(refreshed, [("metadata", "PEP"), ("history", "TSLA"), ("history", "AAPL"),
+                                     ("history", "PEP")])
+
+        # a deleted ticker is forgotten
+        portfolio.remove("TSLA")
+        scheduler.run_pending()
+        self.assertNotIn(("metadata", "TSLA"), scheduler._due)
+
+        log_end("REFRESH SCHEDULER")
+
+    def test_today_bar_reused_within_ttl(self):
+        log_start("HISTORY TODAY TTL")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        fetched = []
+
+        def fetch(ticker, start, end):
+            fetched.append((start, end))
+            return fake_fetch_ticker_history(ticker, start, end)
+
+        store = HistoryStore(directory.name, fetch, today_ttl=60)
+        today = date.today()
+        start = today - timedelta(days=30)
+        end = today + timedelta(days=1)
+
+        store.history("TSLA", start, end)
+        store.history("TSLA", start, end)
+        self.assertEqual(len(fetched), 1)
+
+        # a refresh fetches today's bar again
+        store.window("TSLA", start, end, today_max_age=0)
+        self.assertEqual(fetched[-1], (today, end))
+
+        log_end("HISTORY TODAY TTL")
+
+
+
+# local stand-in for the market data provider of the upstream gateway, recording every call it gets. Every call takes
+# `delay` seconds, so concurrent ones overlap, and fails with `error` when one is set.
+class StubProvider:
+    def __init__(self, delay: float = 0.1):
+        self.delay = delay
+        self.error = None
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _record(self, *call):
+        with self._lock:
+            self.calls.append(call)
+
+        time.sleep(self.delay)
+
+        if self.error is not None:
+            raise self.error
+
+    def info(self, ticker):
+        self._record("info", ticker)
+        return fake_metadata.get(ticker, {})
+
+    def dividends(self, ticker):
+        self._record("dividends", ticker)
+        return pandas.Series([0.5], index=pandas.DatetimeIndex(["2021-01-04"]), name="Dividends")
+
+    def download(self, tickers, start, end, interval="1d"):
+        self._record("download", tuple(tickers), start, end)
+
+        if "BROKEN" in tickers:
+            raise ValueError("upstream error")
+
+        known = [ticker for ticker in tickers if ticker != "UNKNOWN"]
+        frames = [fake_fetch_ticker_history(ticker, start, end) for ticker in known]
+
+        return pandas.concat(frames, axis=1, keys=known).swaplevel(axis=1)
+
+
+class TestUpstreamGateway(unittest.TestCase):
+    @staticmethod
+    def concurrently(function, arguments: list) -> list:
+        results = [None] * len(arguments)
+
+        def run(position):
+            try:
+                results[position] = function(*arguments[position])
+            except Exception as e:
+                results[position] = e
+
+        threads = [threading.Thread(target=run, args=(position,)) for position in range(len(arguments))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_identical_calls_coalesced(self):
+        log_start("UPSTREAM COALESCING")
+
+        provider = StubProvider()
+        gateway = UpstreamGateway(provider, rate=100, burst=100)
+
+        results = self.concurrently(gateway.info, [("AAPL",)] * 8)
+
+        self.assertEqual(provider.calls, [("info", "AAPL")])
+        self.assertEqual(results, [fake_metadata["AAPL"]] * 8)
+        self.assertEqual(gateway.stats()["coalesced"], 7)
+
+        # once it is done, the next call goes upstream again
+        gateway.info("AAPL")
+        self.assertEqual(len(provider.calls), 2)
+
+        log_end("UPSTREAM COALESCING")
+
+    def test_history_batched_into_one_download(self):
+        log_start("UPSTREAM BATCHING")
+
+        provider = StubProvider()
+        gateway = UpstreamGateway(provider, rate=100, burst=100, batch_window=0.1)
+        start, end = date(2021, 1, 1), date(2021, 2, 1)
+        tickers = ["AAPL", "PEP", "SAP", "UNKNOWN"]
+
+        results = self.concurrently(gateway.history, [(ticker, start, end) for ticker in tickers + ["AAPL"]])
+
+        # one download for all of them, the same ticker twice only once
+        self.assertEqual(len(provider.calls), 1)
+        self.assertEqual(sorted(provider.calls[0][1]), sorted(tickers))
+
+        expected = fake_fetch_ticker_history("PEP", start, end)
+        self.assertTrue(numpy.array_equal(results[1]["Close"].to_numpy(), expected["Close"].to_numpy()))
+        self.assertTrue(results[0].equals(results[4]))
+        self.assertEqual(len(results[3]), 0)
+
+        # another range is another download, and a failing one fails every ticker in it
+        results = self.concurrently(gateway.history, [("AAPL", start, date(2021, 3, 1)),
+                                                      ("BROKEN", start, date(2021, 3, 1))])
+        self.assertEqual(len(provider.calls), 2)
+        self.assertTrue(all(isinstance(result, UpstreamError) and isinstance(result.__cause__, ValueError)
+                            for result in results))
+
+        log_end("UPSTREAM BATCHING")
+
+    def test_cold_download_batched(self):
+        log_start("UPSTREAM BATCHING COLD DOWNLOAD")
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        provider = StubProvider()
+        gateway = UpstreamGateway(provider, rate=100, burst=100, batch_window=0.1)
+        store = HistoryStore(directory.name, gateway.history)
+        tickers = ["AAPL", "PEP", "SAP", "TSLA", "MSFT"]
+
+        history = store.download(tickers, date(2021, 1, 1), date(2021, 2, 1))
+
+        # none of them stored yet: they all go upstream in one download, not one each
+        self.assertEqual([sorted(call[1]) for call in provider.calls], [sorted(tickers)])
+        self.assertEqual(list(history["Close"].columns), tickers)
+
+        # and once stored, not at all
+        store.download(tickers, date(2021, 1, 4), date(2021, 1, 30))
+        self.assertEqual(len(provider.calls), 1)
+
+        log_end("UPSTREAM BATCHING COLD DOWNLOAD")
+
+    def test_token_bucket(self):
+        log_start("UPSTREAM RATE LIMIT")
+
+        bucket = TokenBucket(rate=20, capacity=2)
+
+        # the burst goes through right away, the rest at 20 a second
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+
+        start_time = time.monotonic()
+        for _ in range(4):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.18)
+
+        provider = StubProvider(delay=0)
+        gateway = UpstreamGateway(provider, rate=20, burst=1)
+        for ticker in ("AAPL", "PEP", "SAP"):
+            gateway.dividends(ticker)
+        self.assertGreater(gateway.stats()["throttled_seconds"], 0.08)
+
+        log_end("UPSTREAM RATE LIMIT")
+
+
+
+class TestUpstreamResilience(OfflinePortfolioTestCase):
+    tickers = ["AAPL", "PEP"]
+
+    def test_deadline_and_circuit_breaker(self):
+        log_start("UPSTREAM CIRCUIT BREAKER")
+
+        provider = StubProvider(delay=1)
+        gateway = UpstreamGateway(provider, rate=1000, burst=1000, deadlines={"info": 0.1}, failure_threshold=2,
+                                  reset_timeout=0.3)
+
+        # a slow upstream costs the deadline, not the library's timeout
+        for _ in range(2):
+            start_time = time.monotonic()
+            with self.assertRaises(UpstreamTimeout):
+                gateway.info("AAPL")
+            self.assertLess(time.monotonic() - start_time, 0.5)
+
+        # open: the calls fail right away, without going upstream
+        with self.assertRaises(CircuitOpen):
+            gateway.info("AAPL")
+        self.assertEqual(len(provider.calls), 2)
+        self.assertEqual(gateway.stats()["circuits"]["info"], "open")
+
+        # a failing probe opens it again
+        time.sleep(0.35)
+        provider.delay, provider.error = 0, ValueError("upstream error")
+        with self.assertRaises(UpstreamError):
+            gateway.info("AAPL")
+        self.assertEqual(gateway.stats()["circuits"]["info"], "open")
+
+        # and a working one closes it
+        time.sleep(0.35)
+        provider.error = None
+        self.assertEqual(gateway.info("AAPL"), fake_metadata["AAPL"])
+        self.assertEqual(gateway.stats()["circuits"]["info"], "closed")
+
+        log_end("UPSTREAM CIRCUIT BREAKER")
+
+    def test_stale_answers_while_upstream_is_down(self):
+        log_start("UPSTREAM DEGRADED MODE")
+
+        provider = StubProvider(delay=0)
+        gateway = UpstreamGateway(provider, rate=1000, burst=1000, batch_window=0,
+                                  deadlines={"info": 0.2, "history": 0.2}, failure_threshold=1, reset_timeout=60)
+
+        with patch.object(metadata_cache, "loader", gateway.info), \
+                patch.object(history_store, "fetch", gateway.history):
+            self.assertEqual(client.get("/fintech/ticker/AAPL/market-cap").status_code, 200)
+            self.assertEqual(client.get("/fintech/ticker/AAPL/high-low?period=1mo").status_code, 200)
+
+            # upstream gets slow, with everything expired: the last known data comes back within the deadline
+            provider.delay = 2
+            start_time = time.monotonic()
+
+            with patch.object(metadata_cache, "ttl", 0), patch.object(metadata_cache, "stale_ttl", 0), \
+                    patch.object(history_store, "today_ttl", 0):
+                response = client.get("/fintech/ticker/AAPL/market-cap")
+                self.assertEqual((response.status_code, json.loads(response.content)), (200, 2000))
+                self.assertRegex(response.headers["x-stale-data"], r"^metadata=\d+$")
+                self.assertEqual(response.headers["cache-control"], "no-cache")
+
+                # the circuit is open by now, the stored history is answered right away
+                response = client.get("/fintech/ticker/AAPL/high-low?period=1mo")
+                self.assertEqual(response.status_code, 200)
+                self.assertRegex(response.headers["x-stale-data"], r"^history=\d+$")
+
+            self.assertLess(time.monotonic() - start_time, 1.5)
+
+            # nothing to fall back on
+            response = client.get("/fintech/ticker/PEP/market-cap")
+            self.assertEqual(response.status_code, 503)
+            self.assertIn("retry-after", response.headers)
+
+        log_end("UPSTREAM DEGRADED MODE")
+
+
+# the days of the stand-in server's charts, at 14:30 UTC (the US open) of three trading days
+stand_in_days = [date(2021, 1, 4), date(2021, 1, 5), date(2021, 1, 6)]
+stand_in_timestamps = [int(datetime(day.year, day.month, day.day, 14, 30, tzinfo=timezone.utc).timestamp())
+                       for day in stand_in_days]
+
+
+# local stand-in for Yahoo Finance's API, answering the quoteSummary and chart endpoints like it does (for AAPL and
+# PEP, 404 for anything else). It counts the connections it gets, to see the client reuse them.
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = 0
+    fail = False
+
+    def setup(self):
+        super().setup()
+        type(self).connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self, status, content):
+        body = json.dumps(content).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        ticker = path.rsplit("/", 1)[-1]
+        price = {"AAPL": 130.0, "PEP": 140.0}.get(ticker)
+
+        if type(self).fail:
+            return self.answer(500, {"error": "upstream error"})
+
+        if path.startswith("/v10/finance/quoteSummary/"):
+            if price is None:
+                return self.answer(404, {"quoteSummary": {"result": None, "error": {"code": "Not Found"}}})
+
+            return self.answer(200, {"quoteSummary": {"result": [{
+                "price": {"marketCap": {"raw": int(price * 1e10), "fmt": "1.3T"}, "currency": "USD"},
+                "summaryDetail": {"forwardPE": {"raw": price / 5, "fmt": "26"}, "dividendRate": {}},
+                "defaultKeyStatistics": {"lastDividendValue": {"raw": 0.205, "fmt": "0.21"}},
+            }], "error": None}})
+
+        if path.startswith("/v8/finance/chart/"):
+            if price is None:
+                return self.answer(404, {"chart": {"result": None, "error": {"code": "Not Found"}}})
+
+            return self.answer(200, {"chart": {"result": [{
+                "meta": {"symbol": ticker, "gmtoffset": -18000},
+                "timestamp": stand_in_timestamps,
+                "events": {"dividends": {str(stand_in_timestamps[1]): {"amount": 0.205,
+                                                                       "date": stand_in_timestamps[1]}}},
+                "indicators": {
+                    "quote": [{"open": [price, price + 1, None], "high": [price + 2, price + 3, None],
+                               "low": [price - 2, price - 1, None], "close": [price + 1, price + 2, None],
+                               "volume": [100, 200, None]}],
+                    "adjclose": [{"adjclose": [price, price + 1, None]}],
+                },
+            }], "error": None}})
+
+        self.answer(404, {})
+
+
+@unittest.skipIf(httpx is None, "httpx is not installed")
+class TestMarketDataClient(unittest.TestCase):
+    def setUp(self):
+        StandInHandler.connections = 0
+        StandInHandler.fail = False
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        self.provider = MarketDataProvider(MarketDataClient(f"http://127.0.0.1:{self.server.server_port}"))
+        self.addCleanup(self.provider.close)
+
+    def test_answers_what_the_routers_read(self):
+        log_start("MARKET DATA CLIENT")
+
+        info = self.provider.info("AAPL")
+        self.assertEqual((info["marketCap"], info["forwardPE"], info["lastDividendValue"]), (1300000000000, 26, 0.205))
+        self.assertNotIn("dividendRate", info)
+
+        # an unknown ticker has no metadata, no marketCap to be added with
+        self.assertEqual(self.provider.info("NOPE"), {})
+
+        dividends = self.provider.dividends("AAPL")
+        self.assertEqual(dividends.index.tolist(), [pandas.Timestamp("2021-01-05")])
+        self.assertEqual(dividends.tolist(), [0.205])
+
+        # the bars on the exchange's dates, without the empty one, the unknown ticker left out
+        frame = self.provider.download(["AAPL", "PEP", "NOPE"], date(2021, 1, 4), date(2021, 1, 7))
+        self.assertEqual(set(frame.columns.get_level_values(1)), {"AAPL", "PEP"})
+
+        history = frame.xs("PEP", axis=1, level=1)
+        self.assertEqual(list(history.columns), ["Open", "High", "Low", "Close", "Adj Close", "Volume"])
+        self.assertEqual(history.index.tolist(), [pandas.Timestamp(day) for day in stand_in_days[:2]])
+        self.assertEqual(history["Low"].tolist(), [138.0, 139.0])
+        self.assertEqual(history["Adj Close"].tolist(), [140.0, 141.0])
+
+        log_end("MARKET DATA CLIENT")
+
+    def test_through_the_gateway(self):
+        log_start("MARKET DATA CLIENT GATEWAY")
+
+        gateway = UpstreamGateway(self.provider, rate=1000, burst=1000, batch_window=0.05)
+        results = TestUpstreamGateway.concurrently(gateway.history, [(ticker, date(2021, 1, 4), date(2021, 1, 7))
+                                                                     for ticker in ("AAPL", "PEP", "NOPE")])
+
+        self.assertEqual([len(history) for history in results], [2, 2, 0])
+        self.assertEqual(results[0]["Close"].tolist(), [131.0, 132.0])
+
+        # sequential calls go over the kept alive connections instead of opening new ones
+        for _ in range(10):
+            gateway.info("AAPL")
+        self.assertLessEqual(StandInHandler.connections, 3)
+
+        StandInHandler.fail = True
+        with self.assertRaises(UpstreamError):
+            gateway.info("PEP")
+
+        log_end("MARKET DATA CLIENT GATEWAY")
+
+# what importing the app may take at most (seconds), and the libraries it must leave to the warm-up or the first request
+import_time_budget = 1.0
+lazy_modules = ("pandas", "yfinance", "yagmail", "dotenv", "matplotlib", "httpx")
+
+
+class TestStartup(unittest.TestCase):
+    # {module: cumulative import time in seconds} of importing the app in a fresh interpreter (python -X importtime)
+    @staticmethod
+    def import_times() -> dict:
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith("import time:") or "imported package" in line:
+                continue
+
+            _, cumulative, module = line[len("import time:"):].split("|")
+            times[module.strip()] = int(cumulative) / 1e6
+
+        return times
+
+    def test_import_time_budget(self):
+        log_start("STARTUP IMPORT TIME")
+
+        # the first run may have to compile the bytecode, the second one is what a worker pays
+        self.import_times()
+        times = self.import_times()
+
+        self.assertEqual([module for module in lazy_modules if module in times], [])
+        self.assertLess(times["app"], import_time_budget)
+
+        log_end("STARTUP IMPORT TIME")